@@ -0,0 +1,234 @@
+# Content-addressed cache of stage outputs.
+# A stage declares what its outputs depend on:
+#   inputs  upstream files or directories, identified by their content hash
+#   config  keys of config_project.yaml / config_jackhmmer_thresholds.yaml
+#   code    source files of the stage, identified by their content hash
+# The hash of all of these is the key of the outputs. Outputs are stored in
+# ARTIFACT_CACHE_DIR/<stage>/<key>/ and hard linked (or copied) to their usual
+# paths, so a stage runs only if something it depends on has changed, and
+# switching back to an earlier config restores its outputs without rerunning.
+# Content hashes of large files are remembered by (size, mtime), each file is
+# only read again after it changed. Least recently used entries are removed
+# once the cache is larger than ARTIFACT_CACHE_MAX_GB.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from load_configs import (
+    ARTIFACT_CACHE_DIR,
+    ARTIFACT_CACHE_MAX_GB,
+    project_config,
+    thresholds_config,
+)
+
+
+class Stage(NamedTuple):
+    name: str
+    inputs: list[Path]
+    config_keys: list[str]
+    code: list[Path]
+    outputs: list[Path]
+
+
+def _file_hash(file_p: Path, memo: dict) -> str:
+    stat = file_p.stat()
+    key = str(file_p.resolve())
+    known = memo.get(key)
+    if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+    h = hashlib.sha256()
+    with file_p.open("rb") as f:
+        while chunk := f.read(1024**2):
+            h.update(chunk)
+    memo[key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return memo[key][2]
+
+
+def fingerprint(path: Path, memo: dict) -> str:
+    """Content hash of a file, or of all files (and their names) in a dir."""
+    if not path.exists():
+        return "missing"
+    if path.is_file():
+        return _file_hash(path, memo)
+    h = hashlib.sha256()
+    for f in sorted(p for p in path.rglob("*") if p.is_file()):
+        h.update(f"{f.relative_to(path)}\t{_file_hash(f, memo)}\n".encode())
+    return h.hexdigest()
+
+
+# Held from _load_memo to _save_memo, stages are keyed from several threads
+# (step 3 references, pipeline.py nodes)
+_memo_lock = threading.Lock()
+
+
+def _load_memo(cache_dir: Path) -> dict:
+    memo_p = cache_dir / "fingerprints.json"
+    if memo_p.exists():
+        with memo_p.open() as mf:
+            return json.load(mf)
+    return {}
+
+
+def _save_memo(cache_dir: Path, memo: dict):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # A temporary file of its own, other processes may save at the same time
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, suffix=".tmp", delete=False
+    ) as mf:
+        json.dump(memo, mf)
+    Path(mf.name).replace(cache_dir / "fingerprints.json")
+
+
+def content_key(
+    paths: list[Path], cache_dir: Path = ARTIFACT_CACHE_DIR
+) -> str:
+    """
+    Hash of the content of paths, to key data derived from them that is
+    kept in cache_dir outside of a stage.
+    """
+    with _memo_lock:
+        memo = _load_memo(cache_dir)
+        key = hashlib.sha256(
+            "\n".join(fingerprint(p, memo) for p in paths).encode()
+        ).hexdigest()
+        _save_memo(cache_dir, memo)
+    return key
+
+
+def config_values(keys: list[str]) -> dict:
+    configs = {**project_config, **thresholds_config}
+    return {k: configs[k] for k in keys}
+
+
+def stage_key(stage: Stage, cache_dir: Path = ARTIFACT_CACHE_DIR) -> str:
+    with _memo_lock:
+        memo = _load_memo(cache_dir)
+        description = {
+            "stage": stage.name,
+            "inputs": {str(p): fingerprint(p, memo) for p in stage.inputs},
+            "config": config_values(stage.config_keys),
+            "code": {p.name: fingerprint(p, memo) for p in stage.code},
+            "outputs": [p.name for p in stage.outputs],
+        }
+        _save_memo(cache_dir, memo)
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _link_or_copy(source: Path, target: Path):
+    # Also the copy function of copytree, which passes str
+    source, target = Path(source), Path(target)
+    if source.is_dir():
+        if target.exists():
+            shutil.rmtree(target)
+        shutil.copytree(source, target, copy_function=_link_or_copy)
+        return
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        # Different file system
+        shutil.copy2(source, target)
+
+
+def _entry_dir(stage: Stage, key: str, cache_dir: Path) -> Path:
+    return cache_dir / stage.name / key
+
+
+def restore(stage: Stage, key: str, cache_dir: Path = ARTIFACT_CACHE_DIR):
+    """
+    Put the cached outputs of stage at their paths.
+
+    Returns:
+        bool: False if there is no complete entry for key
+    """
+    entry_dir = _entry_dir(stage, key, cache_dir)
+    meta_p = entry_dir / "meta.json"
+    if not meta_p.exists():
+        return False
+    for output_p in stage.outputs:
+        output_p.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(entry_dir / output_p.name, output_p)
+    with meta_p.open() as mf:
+        meta = json.load(mf)
+    meta["last_used"] = time.time()
+    with meta_p.open("w") as mf:
+        json.dump(meta, mf)
+    print(f"{stage.name}: up to date, outputs restored from {entry_dir}")
+    return True
+
+
+def store(stage: Stage, key: str, cache_dir: Path = ARTIFACT_CACHE_DIR):
+    """Add the outputs of a finished stage to the cache."""
+    entry_dir = _entry_dir(stage, key, cache_dir)
+    tmp_dir = entry_dir.parent / f"{key}.tmp"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    for output_p in stage.outputs:
+        _link_or_copy(output_p, tmp_dir / output_p.name)
+    size = sum(f.stat().st_size for f in tmp_dir.rglob("*") if f.is_file())
+    # meta.json marks a complete entry
+    with (tmp_dir / "meta.json").open("w") as mf:
+        json.dump(
+            {
+                "stage": stage.name,
+                "outputs": [str(p) for p in stage.outputs],
+                "size": size,
+                "last_used": time.time(),
+            },
+            mf,
+        )
+    if entry_dir.exists():
+        shutil.rmtree(entry_dir)
+    tmp_dir.rename(entry_dir)
+    evict(cache_dir, keep=entry_dir)
+
+
+def evict(
+    cache_dir: Path = ARTIFACT_CACHE_DIR,
+    max_bytes: float = ARTIFACT_CACHE_MAX_GB * 1024**3,
+    keep: Path | None = None,
+):
+    """
+    Remove least recently used entries until the cache fits in max_bytes.
+    Files that are hard linked at their usual path stay there.
+    """
+    entries = []
+    for meta_p in cache_dir.glob("*/*/meta.json"):
+        with meta_p.open() as mf:
+            meta = json.load(mf)
+        entries.append((meta["last_used"], meta["size"], meta_p.parent))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if entry_dir == keep:
+            continue
+        print(f"Cache over {max_bytes / 1024**3:.1f} GB, removing {entry_dir}")
+        shutil.rmtree(entry_dir)
+        total -= size
+
+
+def run_cached(stage: Stage, run, cache_dir: Path = ARTIFACT_CACHE_DIR):
+    """Call run() to make the outputs of stage, unless they are cached."""
+    key = stage_key(stage, cache_dir)
+    if restore(stage, key, cache_dir):
+        return
+    # Outputs at their usual path may be hard links into the cache, they are
+    # removed so that run() writes new files instead of into the cache
+    for output_p in stage.outputs:
+        if output_p.is_dir():
+            shutil.rmtree(output_p)
+        else:
+            output_p.unlink(missing_ok=True)
+    run()
+    store(stage, key, cache_dir)
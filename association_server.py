@@ -0,0 +1,332 @@
+# Resident association server.
+# Loads the presence stores written by step 3 once and answers correlation
+# requests for new phenotype vectors over local HTTP, without rerunning step
+# 0 or 3:
+#   python association_server.py [--port 8765]
+#   curl -s localhost:8765/correlate -d '{"phenotypes": {"assay": {"MBT1":
+#       0.7, "MBT2": 1.3, ...}}, "top": 20}'
+# Request (POST /correlate, JSON):
+#   phenotypes  {name: {strain: value}}, read as step 3 reads the phenotype
+#               table: with QUANTITATIVE_ASSOCIATION strains without a value
+#               are left out of the test of that phenotype, otherwise values
+#               > 0 are kept and all other strains are 0
+#   reference   reference strain (default: the first of REFERENCE_STRAINS)
+#   top         genes per phenotype in the answer, by p (default 50)
+# Answer: {name: {"n_strains": n, "genes": [{"gene", "r", "p"}, ...]}}.
+# GET /status lists the loaded references.
+# Requests arriving within BATCH_WAIT_S of each other are stacked into one
+# phenotype matrix and correlated with a single matrix product; the last
+# CACHE_SIZE answers are kept.
+
+import argparse
+import hashlib
+import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from load_configs import REFERENCE_STRAINS
+from presence_store import read_presence_store
+from step_3_calculate_correlation import (
+    gen_phenotype_table,
+    mask_groups,
+    pvalue_from_r,
+    reference_paths,
+    standardise_rows,
+    variable_patterns,
+)
+
+# Requests collected into one batch after the first one arrived
+BATCH_WAIT_S = 0.005
+# Answers kept for repeated requests
+CACHE_SIZE = 256
+# Presence patterns standardised over a subset of strains, kept per subset
+MASK_CACHE_SIZE = 8
+
+
+class ReferenceModel(NamedTuple):
+    patterns: np.ndarray  # variable presence patterns x strains
+    z_patterns: np.ndarray  # standardised over all strains
+    genes: pd.Index
+    rows: np.ndarray  # pattern of each gene
+    strains: pd.Index
+
+
+def load_reference(strain: str) -> ReferenceModel:
+    _, presence_store, _ = reference_paths(strain)
+    presence = read_presence_store(presence_store)
+    patterns, genes, rows = variable_patterns(presence)
+    print(
+        f"{strain}: {len(genes)} genes, {len(patterns)} patterns, "
+        f"{len(presence.strains)} strains from {presence_store}"
+    )
+    return ReferenceModel(
+        patterns,
+        standardise_rows(patterns.astype(float)),
+        genes,
+        rows,
+        pd.Index(presence.strains),
+    )
+
+
+def correlate_matrix(
+    model: ReferenceModel,
+    phenotypes: np.ndarray,
+    mask_cache: OrderedDict | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    r and p of every gene with every phenotype (strains x phenotypes, NaN
+    for no value), one matrix product per group of phenotypes with values
+    for the same strains.
+
+    Args:
+        mask_cache (OrderedDict | None): standardised patterns of strain
+            subsets seen before, updated
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: r and p, both genes x phenotypes
+    """
+    r = np.full((len(model.patterns), phenotypes.shape[1]), np.nan)
+    p = np.full_like(r, np.nan)
+    for mask, columns in mask_groups(phenotypes):
+        n = int(mask.sum())
+        if n < 3:
+            continue
+        mask_cache = OrderedDict() if mask_cache is None else mask_cache
+        key = mask.tobytes()
+        if mask.all():
+            z_patterns = model.z_patterns
+        elif key in mask_cache:
+            z_patterns = mask_cache[key]
+            mask_cache.move_to_end(key)
+        else:
+            z_patterns = standardise_rows(
+                model.patterns[:, mask].astype(float)
+            )
+            mask_cache[key] = z_patterns
+            if len(mask_cache) > MASK_CACHE_SIZE:
+                mask_cache.popitem(last=False)
+        z_phenotypes = standardise_rows(phenotypes[mask][:, columns].T)
+        r[:, columns] = np.clip(z_patterns @ z_phenotypes.T, -1.0, 1.0)
+        p[:, columns] = pvalue_from_r(r[:, columns], n)
+    return r[model.rows], p[model.rows]
+
+
+def rank_genes(
+    genes: pd.Index, r: np.ndarray, p: np.ndarray, top: int
+) -> list[dict]:
+    """The top genes by p, best first; genes without p are not ranked."""
+    candidates = np.flatnonzero(~np.isnan(p))
+    if len(candidates) > top:
+        candidates = candidates[np.argpartition(p[candidates], top - 1)[:top]]
+    best = candidates[np.lexsort((-np.abs(r[candidates]), p[candidates]))]
+    return [
+        {"gene": genes[i], "r": float(r[i]), "p": float(p[i])} for i in best
+    ]
+
+
+class Request(NamedTuple):
+    reference: str
+    phenotypes: pd.DataFrame  # strains x phenotypes
+    top: int
+    answer: Future
+
+
+class AssociationBatcher:
+    """
+    Collects requests for BATCH_WAIT_S after the first one and answers all
+    requests of a reference with one correlate_matrix call.
+    """
+
+    def __init__(self, models: dict[str, ReferenceModel]):
+        self.models = models
+        self.requests: queue.Queue[Request] = queue.Queue()
+        self.cache: OrderedDict[str, dict] = OrderedDict()
+        self.cache_lock = threading.Lock()
+        # Used by the batch thread only
+        self.mask_caches = {reference: OrderedDict() for reference in models}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, reference: str, phenotypes: pd.DataFrame, top: int):
+        """Answer dict of a request, from the cache or the next batch."""
+        model = self.models[reference]
+        phenotypes = phenotypes.reindex(model.strains)
+        key = hashlib.sha256(
+            json.dumps([reference, top, list(phenotypes.columns)]).encode()
+            + phenotypes.to_numpy(dtype=float).tobytes()
+        ).hexdigest()
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        answer = Future()
+        self.requests.put(Request(reference, phenotypes, top, answer))
+        result = answer.result()
+        with self.cache_lock:
+            self.cache[key] = result
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return result
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            try:
+                while True:
+                    batch.append(self.requests.get(timeout=BATCH_WAIT_S))
+            except queue.Empty:
+                pass
+            for reference in {request.reference for request in batch}:
+                requests = [b for b in batch if b.reference == reference]
+                try:
+                    self._answer(reference, requests)
+                except Exception as e:
+                    for request in requests:
+                        request.answer.set_exception(e)
+
+    def _answer(self, reference: str, requests: list[Request]):
+        model = self.models[reference]
+        values = np.concatenate(
+            [request.phenotypes.to_numpy(dtype=float) for request in requests],
+            axis=1,
+        )
+        r, p = correlate_matrix(model, values, self.mask_caches[reference])
+        start = 0
+        for request in requests:
+            result = {}
+            for name, values_i in zip(
+                request.phenotypes.columns,
+                range(start, start + request.phenotypes.shape[1]),
+            ):
+                result[name] = {
+                    "n_strains": int(request.phenotypes[name].notna().sum()),
+                    "genes": rank_genes(
+                        model.genes,
+                        r[:, values_i],
+                        p[:, values_i],
+                        request.top,
+                    ),
+                }
+            start += request.phenotypes.shape[1]
+            request.answer.set_result(result)
+
+
+def make_handler(batcher: AssociationBatcher):
+    class AssociationHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/status":
+                self._reply(404, {"error": f"unknown path {self.path}"})
+                return
+            self._reply(
+                200,
+                {
+                    strain: {
+                        "genes": len(model.genes),
+                        "patterns": len(model.patterns),
+                        "strains": len(model.strains),
+                    }
+                    for strain, model in batcher.models.items()
+                },
+            )
+
+        def do_POST(self):
+            if self.path != "/correlate":
+                self._reply(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise ValueError("request is not a JSON object")
+                reference = str(
+                    request.get("reference", next(iter(batcher.models)))
+                )
+                if reference not in batcher.models:
+                    raise ValueError(f"reference {reference} is not loaded")
+                phenotype_strains = request["phenotypes"]
+                if not isinstance(phenotype_strains, dict) or not all(
+                    isinstance(values, dict)
+                    for values in phenotype_strains.values()
+                ):
+                    raise ValueError(
+                        "phenotypes is not an object of {strain: value} "
+                        "objects"
+                    )
+                model = batcher.models[reference]
+                unknown = sorted(
+                    {
+                        strain
+                        for values in phenotype_strains.values()
+                        for strain in values
+                    }.difference(model.strains)
+                )
+                if unknown:
+                    raise ValueError(
+                        f"strains without presence data: {', '.join(unknown)}"
+                    )
+                phenotypes = gen_phenotype_table(
+                    {
+                        str(name): values
+                        for name, values in phenotype_strains.items()
+                    },
+                    model.strains,
+                ).reindex(model.strains)
+                top = int(request.get("top", 50))
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {"error": f"{type(e).__name__}: {e}"})
+                return
+            try:
+                answer = batcher.submit(reference, phenotypes, top)
+            except Exception as e:
+                self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            self._reply(200, answer)
+
+        def log_message(self, format, *args):
+            # Quiet, one line per request is too much at this rate
+            pass
+
+    return AssociationHandler
+
+
+def main(port: int = 8765, references: list[str] = REFERENCE_STRAINS):
+    batcher = AssociationBatcher(
+        {strain: load_reference(strain) for strain in references}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(batcher))
+    print(f"Serving on http://127.0.0.1:{port}, Ctrl-C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Answer correlation requests for new phenotypes."
+    )
+    parser.add_argument(
+        "--port", type=int, default=8765, help="Local port (8765)."
+    )
+    parser.add_argument(
+        "--reference",
+        nargs="+",
+        default=REFERENCE_STRAINS,
+        help=f"Reference strains to load ({', '.join(REFERENCE_STRAINS)}).",
+    )
+    args = parser.parse_args()
+    main(args.port, args.reference)
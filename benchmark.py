@@ -0,0 +1,586 @@
+# Benchmark of the pipeline stages on synthetic data.
+#   python benchmark.py [--scale small|medium|large] [--stages ...]
+# The generator writes, for a scale (strains, proteins per strain,
+# phenotypes), into BENCHMARK_DIR/data/{scale}_{seed}:
+#   proteomes/{strain}.faa.gz  protein families with a U-shaped pangenome
+#                              (core and rare genes), paralogs, mutated
+#                              copies of a family sequence, some proteins
+#                              shorter than MIN_PROTEIN_LEN
+#   phenotype.tsv              binary and continuous phenotypes following
+#                              a few accessory families, some values missing
+#   domtblout.txt              stands in for the jackhmmer search of the first
+#                              strain: every family member is hit with
+#                              domains covering the query, plus a skewed
+#                              (Zipf) number of weak hits per query with one
+#                              or two short domains, and repeated lines
+# The data is made once per scale and seed. Each stage then runs in a fresh
+# process: its inputs are loaded, then the stage alone is timed. Wall time,
+# peak memory (max RSS of the process plus the max RSS of each worker,
+# sampled from /proc; both are also recorded apart) and throughput are
+# printed and appended to BENCHMARK_DIR/history.jsonl, one line per stage
+# with the git commit, to compare runs across commits.
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from column_store import write_table
+from load_configs import DOMTBLOUT_FILE, MIN_PROTEIN_LEN, NCPU
+from step_0_gather_proteome import build_database
+from step_2_parse_domtbl import (
+    cal_cov,
+    gen_match_table,
+    load_hit_store,
+    parse_dom_table_mt,
+    read_domtbl,
+)
+from step_3_calculate_correlation import (
+    cal_correlation,
+    cal_correlations,
+    gen_phenotype_table,
+    gen_presense_absence_table,
+)
+
+BENCHMARK_DIR = DOMTBLOUT_FILE.parent / "benchmark"
+# Seconds between samples of the worker peak RSS
+WORKER_POLL_S = 0.05
+
+
+class Scale(NamedTuple):
+    strains: int
+    proteins: int  # families, about 3/4 of them in a strain
+    phenotypes: int
+
+
+SCALES = {
+    "small": Scale(20, 400, 4),
+    "medium": Scale(100, 2000, 8),
+    "large": Scale(500, 4000, 16),
+}
+
+_AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+
+
+def random_sequence(rng: np.random.Generator, length: int) -> np.ndarray:
+    return _AMINO_ACIDS[rng.integers(0, 20, length)]
+
+
+def mutate(
+    rng: np.random.Generator, sequence: np.ndarray, rate: float
+) -> np.ndarray:
+    """Substitutions at rate, and up to 5 % cut off either end."""
+    sequence = sequence.copy()
+    is_mutated = rng.random(len(sequence)) < rate
+    sequence[is_mutated] = random_sequence(rng, is_mutated.sum())
+    cut = rng.integers(0, max(1, len(sequence) // 20), 2)
+    return sequence[cut[0] : len(sequence) - cut[1]]
+
+
+def write_proteome(proteome_p: Path, proteins: list[tuple[str, bytes]]):
+    with gzip.open(proteome_p, "wt", compresslevel=1) as out:
+        for protein_id, sequence in proteins:
+            sequence = sequence.decode()
+            out.write(f">{protein_id} hypothetical protein\n")
+            for i in range(0, len(sequence), 60):
+                out.write(f"{sequence[i : i + 60]}\n")
+
+
+def domtbl_line(
+    target: str,
+    tlen: int,
+    query: str,
+    qlen: int,
+    full_e: float,
+    dom_n: int,
+    dom_total: int,
+    dom_e: float,
+    ali_from: int,
+    ali_to: int,
+) -> str:
+    score = max(0.0, -np.log10(dom_e) * 3.3)
+    return (
+        f"{target:<20} -          {tlen:5d} {query:<20} -          "
+        f"{qlen:5d} {full_e:9.2g} {score:6.1f} {0.1:5.1f} {dom_n:3d} "
+        f"{dom_total:3d} {dom_e:9.2g} {dom_e:9.2g} {score:6.1f} {0.1:5.1f} "
+        f"{ali_from:5d} {ali_to:5d} {ali_from:5d} {ali_to:5d} "
+        f"{ali_from:5d} {ali_to:5d} 0.97 hypothetical protein\n"
+    )
+
+
+def generate(data_dir: Path, scale: Scale, seed: int):
+    rng = np.random.default_rng(seed)
+    n_families = scale.proteins
+    strains = [f"BS{k:03d}" for k in range(scale.strains)]
+    # U-shaped: most families in almost all strains or in very few
+    family_freq = rng.beta(0.3, 0.3, n_families)
+    family_len = np.clip(
+        rng.lognormal(np.log(300), 0.5, n_families).astype(int), 30, 3000
+    )
+    families = [random_sequence(rng, n) for n in family_len]
+    has_family = rng.random((scale.strains, n_families)) < family_freq
+    has_family[0, rng.random(n_families) < 0.8] = True
+
+    proteome_dir = data_dir / "proteomes"
+    proteome_dir.mkdir(parents=True, exist_ok=True)
+    # {family: [(target, tlen)]}, proteins of the reference are the queries
+    members: dict[int, list[tuple[str, int]]] = {}
+    proteins: list[tuple[str, int]] = []
+    queries: list[tuple[str, int, int]] = []
+    for k, strain in enumerate(strains):
+        strain_proteins = []
+        for family in np.flatnonzero(has_family[k]):
+            copies = 1 + (rng.geometric(0.5) if rng.random() < 0.05 else 0)
+            for _ in range(copies):
+                sequence = mutate(rng, families[family], 0.1).tobytes()
+                protein_id = f"{strain}_{len(strain_proteins) + 1:05d}"
+                strain_proteins.append((protein_id, sequence))
+                target = f"{strain}_{protein_id}"
+                # Short proteins are not in the database of step 0
+                if len(sequence) >= MIN_PROTEIN_LEN:
+                    members.setdefault(family, []).append(
+                        (target, len(sequence))
+                    )
+                    proteins.append((target, len(sequence)))
+                if k == 0:
+                    queries.append((protein_id, len(sequence), family))
+        write_proteome(proteome_dir / f"{strain}.faa.gz", strain_proteins)
+
+    lines = []
+    n_weak = np.minimum(rng.zipf(1.8, len(queries)), 2000)
+    for (query, qlen, family), n_extra in zip(queries, n_weak):
+        for target, tlen in members.get(family, []):
+            full_e = 10 ** -rng.uniform(20, 150)
+            n_dom = min(int(rng.geometric(0.6)), 6)
+            edges = np.linspace(1, qlen, n_dom + 1).astype(int)
+            for d in range(n_dom):
+                ali_from = edges[d] + int(rng.integers(0, 5))
+                ali_to = max(ali_from, edges[d + 1] - int(rng.integers(0, 5)))
+                lines.append(
+                    domtbl_line(
+                        target,
+                        tlen,
+                        query,
+                        qlen,
+                        full_e,
+                        d + 1,
+                        n_dom,
+                        full_e * 10 ** rng.uniform(0, 10),
+                        ali_from,
+                        ali_to,
+                    )
+                )
+        for i in rng.integers(0, len(proteins), n_extra):
+            target, tlen = proteins[i]
+            full_e = 10 ** -rng.uniform(0, 15)
+            n_dom = int(rng.integers(1, 3))
+            for d in range(n_dom):
+                ali_from = int(rng.integers(1, max(2, qlen - 30)))
+                ali_to = min(qlen, ali_from + int(rng.integers(20, 120)))
+                lines.append(
+                    domtbl_line(
+                        target,
+                        tlen,
+                        query,
+                        qlen,
+                        full_e,
+                        d + 1,
+                        n_dom,
+                        full_e * 10 ** rng.uniform(0, 3),
+                        ali_from,
+                        ali_to,
+                    )
+                )
+    # 2 % of the lines are reported again, as in a later iteration
+    is_repeated = rng.random(len(lines)) < 0.02
+    with (data_dir / "domtblout.txt").open("w") as out:
+        out.write("# target name accession tlen query name ...\n")
+        for line, repeated in zip(lines, is_repeated):
+            out.write(line * (2 if repeated else 1))
+        out.write("# [ok]\n")
+
+    phenotypes = {}
+    accessory = np.flatnonzero((family_freq > 0.2) & (family_freq < 0.8))
+    for j in range(scale.phenotypes):
+        causal = rng.choice(accessory, min(3, len(accessory)), replace=False)
+        signal = has_family[:, causal].sum(axis=1).astype(float)
+        if j % 4 == 3:
+            values = signal + rng.normal(0, 1, scale.strains)
+        else:
+            values = ((signal > 0) ^ (rng.random(scale.strains) < 0.1)) * 1.0
+        values[rng.random(scale.strains) < 0.05] = np.nan
+        phenotypes[f"Phenotype{j + 1}"] = values
+    pd.DataFrame(phenotypes, index=pd.Index(strains, name="ID")).to_csv(
+        data_dir / "phenotype.tsv", sep="\t"
+    )
+    (data_dir / "queries.txt").write_text(
+        "".join(f"{query}\n" for query, _, _ in queries)
+    )
+
+
+def prepare(scale_name: str, seed: int) -> Path:
+    """Generated data and the tables the later stages start from."""
+    scale = SCALES[scale_name]
+    data_dir = BENCHMARK_DIR / "data" / f"{scale_name}_{seed}"
+    meta = {"scale": scale._asdict(), "seed": seed}
+    meta_p = data_dir / "meta.json"
+    if meta_p.exists() and json.loads(meta_p.read_text()) == meta:
+        return data_dir
+    print(f"Generating {scale_name} data in {data_dir}.")
+    generate(data_dir, scale, seed)
+    domtbl_df = read_domtbl(data_dir / "domtblout.txt")
+    write_table(domtbl_df, data_dir / "hits.cols")
+    write_table(gen_match_table(domtbl_df), data_dir / "matches.cols")
+    meta_p.write_text(json.dumps(meta))
+    return data_dir
+
+
+class StageTimer:
+    """
+    Wall time and peak RSS of the with block. The peak includes the inputs
+    loaded before it; the worker processes of the stage (children of the
+    forkserver, which ru_maxrss of RUSAGE_CHILDREN does not see) are sampled
+    every WORKER_POLL_S and their peaks added.
+    """
+
+    def __enter__(self):
+        self.input_rss_mb = _status_mb("VmRSS")
+        try:
+            # Reset the peak (VmHWM) to the current RSS
+            Path("/proc/self/clear_refs").write_text("5")
+        except OSError:
+            pass
+        # {pid: peak MB} of the processes started by the stage
+        self.worker_mb: dict[int, float] = {}
+        self._before = set(_descendants(os.getpid()))
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_workers)
+        self._sampler.start()
+        self.start = time.perf_counter()
+        return self
+
+    def _sample_workers(self):
+        while True:
+            for pid in _descendants(os.getpid()):
+                if pid not in self._before:
+                    self.worker_mb[pid] = max(
+                        self.worker_mb.get(pid, 0.0),
+                        _status_mb("VmHWM", pid),
+                    )
+            if self._done.wait(WORKER_POLL_S):
+                return
+
+    def __exit__(self, *exc):
+        self.wall_s = time.perf_counter() - self.start
+        self._done.set()
+        self._sampler.join()
+        self.main_peak_rss_mb = _status_mb("VmHWM")
+        self.workers_peak_rss_mb = sum(self.worker_mb.values())
+        self.peak_rss_mb = self.main_peak_rss_mb + self.workers_peak_rss_mb
+
+
+def _descendants(pid: int) -> list[int]:
+    """Processes below pid, from the parent pids in /proc/*/stat."""
+    children: dict[int, list[int]] = {}
+    for stat_p in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            stat = stat_p.read_text()
+        except OSError:
+            continue
+        # The process name may contain spaces, the parent pid follows it
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(stat_p.parent.name))
+    found, todo = [], [pid]
+    while todo:
+        for child in children.get(todo.pop(), []):
+            found.append(child)
+            todo.append(child)
+    return found
+
+
+def _status_mb(field: str, pid: int | str = "self") -> float:
+    """
+    Memory field of /proc/{pid}/status. ru_maxrss is no alternative on Linux,
+    it keeps the peak of the parent process across fork and exec.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as sf:
+            for line in sf:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != "self":
+        # Exited since, its last sample stands
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _strains(data_dir: Path) -> list[str]:
+    return sorted(
+        p.name[: -len(".faa.gz")] for p in data_dir.glob("*/*.faa.gz")
+    )
+
+
+def _queries(data_dir: Path) -> list[str]:
+    return (data_dir / "queries.txt").read_text().split()
+
+
+def _phenotype_df(data_dir: Path) -> pd.DataFrame:
+    df = pd.read_csv(data_dir / "phenotype.tsv", sep="\t", index_col=0)
+    return gen_phenotype_table(
+        {ph: values.dropna().to_dict() for ph, values in df.items()},
+        _strains(data_dir),
+    )
+
+
+def _presence_df(data_dir: Path) -> pd.DataFrame:
+    return gen_presense_absence_table(
+        _queries(data_dir), _strains(data_dir), data_dir / "matches.cols"
+    )
+
+
+def bench_build_database(data_dir: Path, timer: StageTimer, ncpu: int):
+    all_strains = {
+        st: data_dir / "proteomes" / f"{st}.faa.gz"
+        for st in _strains(data_dir)
+    }
+    db_p = data_dir / "db.fasta"
+    manifest_p = data_dir / "db_manifest.json"
+    for file_p in (db_p, manifest_p):
+        file_p.unlink(missing_ok=True)
+    with timer:
+        build_database(
+            all_strains,
+            db_p,
+            manifest_p,
+            dedup=False,
+            members_p=data_dir / "db_members.tsv.gz",
+            ncpu=ncpu,
+        )
+    with db_p.open("rb") as db:
+        return sum(1 for line in db if line.startswith(b">")), "proteins"
+
+
+def bench_read_domtbl(data_dir: Path, timer: StageTimer, ncpu: int):
+    domtbl_p = data_dir / "domtblout.txt"
+    with domtbl_p.open("rb") as dt:
+        n_lines = sum(1 for line in dt if not line.startswith(b"#"))
+    with timer:
+        read_domtbl(domtbl_p)
+    return n_lines, "lines"
+
+
+def bench_cal_cov(data_dir: Path, timer: StageTimer, ncpu: int):
+    domtbl_df = load_hit_store(data_dir / "hits.cols")
+    with timer:
+        cal_cov(domtbl_df)
+    return len(domtbl_df), "hits"
+
+
+def bench_parse_dom_table_mt(data_dir: Path, timer: StageTimer, ncpu: int):
+    domtbl_df = load_hit_store(data_dir / "hits.cols")
+    with timer:
+        parse_dom_table_mt(domtbl_df, ncpu=ncpu)
+    return len(domtbl_df), "hits"
+
+
+def bench_gen_presense_absence_table(
+    data_dir: Path, timer: StageTimer, ncpu: int
+):
+    queries, strains = _queries(data_dir), _strains(data_dir)
+    with timer:
+        gen_presense_absence_table(queries, strains, data_dir / "matches.cols")
+    return len(queries) * len(strains), "cells"
+
+
+def bench_cal_correlation(data_dir: Path, timer: StageTimer, ncpu: int):
+    phenotype_df = _phenotype_df(data_dir)
+    presence_df = _presence_df(data_dir)
+    phenotype_strains = {
+        ph: values.to_dict() for ph, values in phenotype_df.items()
+    }
+    all_strains = dict.fromkeys(phenotype_df.index)
+    with timer:
+        for phenotype in phenotype_df.columns:
+            cal_correlation(
+                phenotype, phenotype_strains, all_strains, presence_df
+            )
+    return presence_df.shape[0] * phenotype_df.shape[1], "tests"
+
+
+def bench_cal_correlations(data_dir: Path, timer: StageTimer, ncpu: int):
+    phenotype_df = _phenotype_df(data_dir)
+    presence_df = _presence_df(data_dir)
+    with timer:
+        cal_correlations(phenotype_df, presence_df)
+    return presence_df.shape[0] * phenotype_df.shape[1], "tests"
+
+
+STAGES = {
+    "build_database": bench_build_database,
+    "read_domtbl": bench_read_domtbl,
+    "cal_cov": bench_cal_cov,
+    "parse_dom_table_mt": bench_parse_dom_table_mt,
+    "gen_presense_absence_table": bench_gen_presense_absence_table,
+    "cal_correlation": bench_cal_correlation,
+    "cal_correlations": bench_cal_correlations,
+}
+
+
+def run_stage(name: str, data_dir: Path, ncpu: int) -> dict:
+    """Run in a fresh process, memory of earlier stages is not counted."""
+    timer = StageTimer()
+    items, unit = STAGES[name](data_dir, timer, ncpu)
+    return {
+        "wall_s": timer.wall_s,
+        "peak_rss_mb": timer.peak_rss_mb,
+        "main_peak_rss_mb": timer.main_peak_rss_mb,
+        "workers_peak_rss_mb": timer.workers_peak_rss_mb,
+        "input_rss_mb": timer.input_rss_mb,
+        "items": items,
+        "unit": unit,
+        "throughput": items / timer.wall_s if timer.wall_s > 0 else None,
+    }
+
+
+def git_commit() -> str:
+    """Short hash of HEAD, +dirty with uncommitted changes to tracked files."""
+    repo_dir = Path(__file__).parent
+    try:
+        commit = subprocess.run(
+            ["git", "-C", str(repo_dir), "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        changes = subprocess.run(
+            ["git", "-C", str(repo_dir), "status", "--porcelain", "-uno"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}+dirty" if changes else commit
+
+
+def load_history(history_p: Path) -> list[dict]:
+    if not history_p.exists():
+        return []
+    with history_p.open() as hf:
+        return [json.loads(line) for line in hf if line.strip()]
+
+
+def main(
+    scale_name: str,
+    stages: list[str],
+    seed: int = 0,
+    repeat: int = 1,
+    ncpu: int = NCPU,
+    history_p: Path = BENCHMARK_DIR / "history.jsonl",
+):
+    data_dir = prepare(scale_name, seed)
+    history = load_history(history_p)
+    commit = git_commit()
+    run = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scale": scale_name,
+        "seed": seed,
+        "ncpu": ncpu,
+    }
+    spawn = multiprocessing.get_context("spawn")
+    rows = []
+    for name in stages:
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=spawn) as executer:
+                result = executer.submit(
+                    run_stage, name, data_dir, ncpu
+                ).result()
+            record = {**run, "stage": name, **result}
+            with history_p.open("a") as hf:
+                hf.write(json.dumps(record) + "\n")
+            earlier = [
+                h
+                for h in history
+                if h["stage"] == name
+                and h["scale"] == scale_name
+                and h["seed"] == seed
+                and h["commit"] != commit
+            ]
+            change = ""
+            if earlier:
+                before = earlier[-1]
+                change = (
+                    f"{before['wall_s'] / result['wall_s']:.2f}x vs "
+                    f"{before['commit']}"
+                )
+            rows.append(
+                (
+                    name,
+                    f"{result['wall_s']:.3f}",
+                    f"{result['peak_rss_mb']:.0f}",
+                    f"{result['throughput']:.3g} {result['unit']}/s",
+                    change,
+                )
+            )
+    print(
+        pd.DataFrame(
+            rows,
+            columns=["stage", "wall s", "peak MB", "throughput", "speedup"],
+        ).to_string(index=False)
+    )
+    print(f"History in {history_p}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline stages on synthetic data."
+    )
+    parser.add_argument(
+        "--scale",
+        choices=list(SCALES),
+        default="small",
+        help="Strains, proteins per strain and phenotypes: "
+        + ", ".join(f"{k} {tuple(s)}" for k, s in SCALES.items())
+        + " (small).",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to time (all).",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the generator (0)."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs of each stage (1)."
+    )
+    parser.add_argument(
+        "--ncpu",
+        type=int,
+        default=NCPU,
+        help=f"Processes of the parallel stages ({NCPU}).",
+    )
+    args = parser.parse_args()
+    BENCHMARK_DIR.mkdir(parents=True, exist_ok=True)
+    main(args.scale, args.stages, args.seed, args.repeat, args.ncpu)
@@ -0,0 +1,246 @@
+# Typed, compressed, columnar store of the intermediate tables.
+# A store is a directory with:
+#   schema.json        columns with their dtype, and the row groups with their
+#                      row count and per column min/max
+#   {column}.dict.txt  values of a dictionary encoded column, sorted, one per
+#                      line; the column holds int32 codes into it, -1 for a
+#                      missing value
+#   rg{k:05d}.npz      compressed arrays of one row group, one per column
+#   rg{k:05d}.{column}.npy  instead of the npz in uncompressed stores, read
+#                      memory-mapped
+# Text columns (strain and protein names, descriptions) are dictionary
+# encoded, numbers and booleans keep their numpy dtype. Readers load only the
+# columns they ask for and skip row groups whose min/max cannot match the
+# filters, e.g.
+#   read_table(match_store, ["Query", "Target strain"], {"Query": queries})
+# Dictionary columns come back as pd.Categorical.
+
+import json
+import shutil
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Rows per row group, the unit of reading and of skipping by filters
+ROW_GROUP_SIZE = 1_000_000
+
+
+def _is_dictionary(values: pd.Series) -> bool:
+    return not (
+        pd.api.types.is_numeric_dtype(values)
+        or pd.api.types.is_bool_dtype(values)
+    ) or isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def _save_npz(npz_p: Path, arrays: dict[str, np.ndarray]):
+    """
+    np.savez_compressed with fixed member timestamps, the same table always
+    gives the same bytes (and the same artifact cache key downstream).
+    """
+    with zipfile.ZipFile(npz_p, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, values in arrays.items():
+            info = zipfile.ZipInfo(f"{name}.npy")
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, "w", force_zip64=True) as f:
+                np.lib.format.write_array(
+                    f, np.ascontiguousarray(values), allow_pickle=False
+                )
+
+
+def write_table(
+    df: pd.DataFrame,
+    store_p: Path,
+    row_group_size: int = ROW_GROUP_SIZE,
+    compress: bool = True,
+):
+    """
+    Write the columns of df (not the index) to store_p. The store is made
+    in a temporary directory and renamed, readers never see a partial one.
+
+    Args:
+        compress (bool): Row groups as compressed npz. Otherwise as .npy
+            files, which read_table memory-maps; with a single row group the
+            numeric columns are returned memory-mapped.
+    """
+    tmp_p = store_p.parent / f"{store_p.name}.tmp"
+    if tmp_p.exists():
+        shutil.rmtree(tmp_p)
+    tmp_p.mkdir(parents=True)
+
+    columns = {}
+    schema = {
+        "columns": {},
+        "n_rows": len(df),
+        "compressed": compress,
+        "row_groups": [],
+    }
+    for name in df.columns:
+        values = df[name]
+        if _is_dictionary(values):
+            # Missing values get code -1, not the text "nan" or "None"
+            codes, dictionary = pd.factorize(
+                values.astype(str).where(values.notna()), sort=True
+            )
+            if any("\n" in v for v in dictionary):
+                raise ValueError(f"Column {name} has a value with a newline.")
+            (tmp_p / f"{name}.dict.txt").write_bytes(
+                "".join(f"{v}\n" for v in dictionary).encode()
+            )
+            columns[name] = codes.astype(np.int32)
+            schema["columns"][name] = {"dtype": "dictionary"}
+        else:
+            columns[name] = values.to_numpy()
+            schema["columns"][name] = {"dtype": columns[name].dtype.str}
+
+    for k, start in enumerate(range(0, max(len(df), 1), row_group_size)):
+        group = {
+            name: values[start : start + row_group_size]
+            for name, values in columns.items()
+        }
+        if compress:
+            _save_npz(tmp_p / f"rg{k:05d}.npz", group)
+        else:
+            for name, values in group.items():
+                np.save(tmp_p / f"rg{k:05d}.{name}.npy", values)
+        stats = {}
+        for name, values in group.items():
+            if values.dtype.kind == "f":
+                values = values[~np.isnan(values)]
+            if len(values):
+                stats[name] = [values.min().item(), values.max().item()]
+        n_rows = len(next(iter(group.values()))) if group else 0
+        schema["row_groups"].append({"rows": n_rows, "stats": stats})
+    with (tmp_p / "schema.json").open("w") as sf:
+        json.dump(schema, sf, indent=1)
+
+    if store_p.exists():
+        shutil.rmtree(store_p)
+    tmp_p.rename(store_p)
+
+
+def read_dictionary(store_p: Path, column: str) -> np.ndarray:
+    # Values may hold other line breaks (\r, \x1c, \u2028, ...)
+    text = (store_p / f"{column}.dict.txt").read_bytes().decode()
+    return np.array(text.split("\n")[:-1], dtype=object)
+
+
+def read_schema(store_p: Path) -> dict:
+    with (store_p / "schema.json").open() as sf:
+        return json.load(sf)
+
+
+def _filter_codes(
+    store_p: Path, schema: dict, filters: dict
+) -> dict[str, list | tuple]:
+    """Filter values of dictionary columns as codes."""
+    coded = {}
+    for name, condition in filters.items():
+        if schema["columns"][name]["dtype"] != "dictionary":
+            coded[name] = condition
+            continue
+        dictionary = pd.Index(read_dictionary(store_p, name))
+        if isinstance(condition, tuple):
+            lo, hi = condition
+            coded[name] = (
+                dictionary.searchsorted(lo, side="left"),
+                dictionary.searchsorted(hi, side="right") - 1,
+            )
+        else:
+            codes = dictionary.get_indexer(list(condition))
+            coded[name] = codes[codes >= 0]
+    return coded
+
+
+def _read_row_group(
+    store_p: Path, schema: dict, k: int, names: list[str]
+) -> dict[str, np.ndarray]:
+    if schema.get("compressed", True):
+        with np.load(store_p / f"rg{k:05d}.npz") as group:
+            # Members of the npz are decompressed on access only
+            return {name: group[name] for name in names}
+    return {
+        name: np.load(store_p / f"rg{k:05d}.{name}.npy", mmap_mode="r")
+        for name in names
+    }
+
+
+def _may_match(stats: dict, filters: dict) -> bool:
+    """False if the min/max of a row group rule out a filter."""
+    for name, condition in filters.items():
+        if name not in stats:
+            # Empty group or all NaN
+            return False
+        lo, hi = stats[name]
+        if isinstance(condition, tuple):
+            if condition[1] < lo or condition[0] > hi:
+                return False
+        else:
+            condition = np.asarray(condition)
+            if not np.any((condition >= lo) & (condition <= hi)):
+                return False
+    return True
+
+
+def read_table(
+    store_p: Path,
+    columns: list[str] | None = None,
+    filters: dict[str, list | tuple] | None = None,
+) -> pd.DataFrame:
+    """
+    Read columns (all by default) of the rows matching all filters.
+
+    Args:
+        filters (dict[str, list | tuple]): {column: allowed values} or
+            {column: (min, max)}, both ends included. Row groups that
+            cannot match are not read.
+    """
+    schema = read_schema(store_p)
+    columns = list(schema["columns"]) if columns is None else columns
+    filters = filters or {}
+    coded = _filter_codes(store_p, schema, filters)
+    parts = {name: [] for name in columns}
+    for k, row_group in enumerate(schema["row_groups"]):
+        if filters and not _may_match(row_group["stats"], coded):
+            continue
+        group = _read_row_group(
+            store_p, schema, k, list(dict.fromkeys([*columns, *coded]))
+        )
+        is_row = np.ones(row_group["rows"], dtype=bool)
+        for name, condition in coded.items():
+            values = group[name]
+            if isinstance(condition, tuple):
+                is_row &= (values >= condition[0]) & (values <= condition[1])
+            else:
+                is_row &= np.isin(values, condition)
+        for name in columns:
+            parts[name].append(group[name][is_row] if coded else group[name])
+
+    data = {}
+    for name in columns:
+        dtype = schema["columns"][name]["dtype"]
+        if dtype == "dictionary":
+            values = (
+                np.concatenate(parts[name])
+                if parts[name]
+                else np.empty(0, dtype=np.int32)
+            )
+            data[name] = pd.Categorical.from_codes(
+                values, categories=read_dictionary(store_p, name)
+            )
+        elif len(parts[name]) == 1:
+            # No copy, stays memory-mapped in uncompressed stores
+            data[name] = parts[name][0]
+        else:
+            data[name] = (
+                np.concatenate(parts[name])
+                if parts[name]
+                else np.empty(0, dtype=np.dtype(dtype))
+            )
+    return pd.DataFrame(data, copy=False)
+
+
+def export_tsv(store_p: Path, tsv_p: Path):
+    """The table as TSV with a row number index, like DataFrame.to_csv."""
+    read_table(store_p).to_csv(tsv_p, sep="\t")
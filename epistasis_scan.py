@@ -0,0 +1,347 @@
+# Pairwise gene interaction (epistasis) scan.
+# For every pair of presence patterns (step 3 presence store, distinct and
+# variable patterns only) two pair patterns are scored against each
+# phenotype (a strain has it if its value is > 0):
+#   and  both genes present
+#   xor  exactly one of them present
+# Patterns are strain bitsets (see phenotype_combinations.py). With
+# n_ij = popcount(x_i & x_j) and t_ij = popcount(x_i & x_j & y) both pair
+# patterns follow from counts, e.g. popcount(x_i ^ x_j) = a_i + a_j - 2 n_ij,
+# so a pair costs two AND + popcount per word, and n_ij is shared by all
+# phenotypes.
+# Pairs are done in tiles of EPISTASIS_TILE x EPISTASIS_TILE patterns on NCPU
+# processes. n_ij and the number of strains with the phenotype bound the
+# largest |r| a pair pattern can reach; pairs that cannot beat the current
+# EPISTASIS_TOP_K-th best |r| of a phenotype are not counted further. Only
+# the top EPISTASIS_TOP_K pattern pairs per phenotype are kept and written
+# to epistasis_{phenotype}.tsv, one row per pattern pair with the genes of
+# both patterns as comma separated lists (a pair of large co-inherited
+# cassettes would be |genes_a| x |genes_b| gene pairs).
+
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from artifact_cache import Stage, run_cached
+from load_configs import (
+    EPISTASIS_TILE,
+    EPISTASIS_TOP_K,
+    GATHER_MATCH_TSV,
+    NCPU,
+    REFERENCE_STRAINS,
+    STRAINS_STORE,
+)
+from phenotype_combinations import pack_bits, popcount
+from presence_store import read_presence_store
+from step_3_calculate_correlation import (
+    gen_phenotype_table,
+    load_experimental_data,
+    pvalue_from_r,
+    reference_paths,
+    variable_patterns,
+)
+
+INTERACTIONS = ["and", "xor"]
+
+# Bitsets and counts, set once per worker process
+_scan_x: np.ndarray = np.empty((0, 0), dtype=np.uint64)  # patterns x words
+_scan_xy: np.ndarray = np.empty((0, 0, 0), dtype=np.uint64)  # ph x pat x w
+_scan_a: np.ndarray = np.empty(0, dtype=np.int64)  # strains per pattern
+_scan_c: np.ndarray = np.empty((0, 0), dtype=np.int64)  # ph x patterns
+_scan_m: np.ndarray = np.empty(0, dtype=np.int64)  # strains per phenotype
+_scan_n: int = 0
+
+
+def _init_scan_worker(
+    x: np.ndarray, xy: np.ndarray, m: np.ndarray, n_strains: int
+):
+    global _scan_x, _scan_xy, _scan_a, _scan_c, _scan_m, _scan_n
+    _scan_x, _scan_xy, _scan_m, _scan_n = x, xy, m, n_strains
+    _scan_a = popcount(x).sum(axis=-1, dtype=np.int64)
+    _scan_c = popcount(xy).sum(axis=-1, dtype=np.int64)
+
+
+def phi(t: np.ndarray, n_z: np.ndarray, m: int, n: int) -> np.ndarray:
+    """Phi correlation from the 2x2 counts t = n_11, n_z = n_1., m = n_.1"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (n * t - n_z * m) / np.sqrt(
+            n_z.astype(float) * (n - n_z) * m * (n - m)
+        )
+
+
+def phi_bound(n_z: np.ndarray, m: int, n: int) -> np.ndarray:
+    """
+    Largest |phi| a binary vector with n_z of n strains present can have
+    with a phenotype of m strains, over all possible overlaps. Attained at
+    the largest or smallest possible overlap.
+    """
+    t_max = np.minimum(n_z, m)
+    t_min = np.maximum(0, n_z + m - n)
+    return np.maximum(
+        np.abs(phi(t_max, n_z, m, n)), np.abs(phi(t_min, n_z, m, n))
+    )
+
+
+def _top_k(
+    abs_r: np.ndarray, k: int, *columns: np.ndarray
+) -> tuple[np.ndarray, ...]:
+    """The k rows with the largest abs_r, of abs_r and the other columns."""
+    if len(abs_r) > k:
+        keep = np.argpartition(-abs_r, k - 1)[:k]
+        return (abs_r[keep], *(c[keep] for c in columns))
+    return (abs_r, *columns)
+
+
+def _scan_tile(
+    i0: int, j0: int, tile: int, thresholds: np.ndarray, k: int
+) -> list[tuple[np.ndarray, ...]]:
+    """
+    Score the pattern pairs i0:i0+tile x j0:j0+tile (i < j) for all
+    phenotypes.
+
+    Args:
+        thresholds (np.ndarray): per phenotype, |r| a pair needs to be kept
+
+    Returns:
+        list[tuple[np.ndarray, ...]]: per phenotype abs_r, r, i, j and
+            interaction (index in INTERACTIONS) of at most k pairs
+    """
+    x, n = _scan_x, _scan_n
+    rows = np.arange(i0, min(i0 + tile, len(x)))
+    cols = np.arange(j0, min(j0 + tile, len(x)))
+    n_ij = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    for w in range(x.shape[1]):
+        n_ij += popcount(x[rows, w, None] & x[None, cols, w])
+    a_i, a_j = _scan_a[rows, None], _scan_a[None, cols]
+    n_z = [n_ij, a_i + a_j - 2 * n_ij]  # as INTERACTIONS
+    is_pair = (rows[:, None] < cols[None, :]) & (
+        # A pair pattern in all or no strains is constant
+        ((n_z[0] > 0) & (n_z[0] < n))
+        | ((n_z[1] > 0) & (n_z[1] < n))
+    )
+
+    found = []
+    for ph, m in enumerate(_scan_m):
+        # Early pruning: pairs that cannot reach the threshold
+        bounds = [phi_bound(nz, m, n) for nz in n_z]
+        ii, jj = np.nonzero(
+            is_pair
+            & ((bounds[0] >= thresholds[ph]) | (bounds[1] >= thresholds[ph]))
+        )
+        t_ij = np.zeros(len(ii), dtype=np.int64)
+        for w in range(x.shape[1]):
+            t_ij += popcount(_scan_xy[ph, rows[ii], w] & x[cols[jj], w])
+        c = _scan_c[ph]
+        t = [t_ij, c[rows[ii]] + c[cols[jj]] - 2 * t_ij]
+        r = np.concatenate([phi(t[s], n_z[s][ii, jj], m, n) for s in range(2)])
+        interaction = np.repeat([0, 1], len(ii))
+        i, j = np.tile(rows[ii], 2), np.tile(cols[jj], 2)
+        abs_r = np.abs(r)
+        # NaN (constant pair pattern) is never kept
+        is_kept = abs_r >= thresholds[ph]
+        found.append(
+            _top_k(
+                abs_r[is_kept],
+                k,
+                r[is_kept],
+                i[is_kept],
+                j[is_kept],
+                interaction[is_kept],
+            )
+        )
+    return found
+
+
+def scan_pairs(
+    pattern_bits: np.ndarray,
+    phenotype_bits: np.ndarray,
+    n_strains: int,
+    top_k: int = EPISTASIS_TOP_K,
+    tile: int = EPISTASIS_TILE,
+    ncpu: int = NCPU,
+) -> list[pd.DataFrame]:
+    """
+    Top top_k pattern pairs by |r| for each phenotype.
+
+    Args:
+        pattern_bits (np.ndarray): patterns x words
+        phenotype_bits (np.ndarray): phenotypes x words
+
+    Returns:
+        list[pd.DataFrame]: per phenotype, pattern_a, pattern_b,
+            interaction, n_strains (with the pair pattern), phi_Corr., p
+            sorted by p
+    """
+    n_phenotypes = len(phenotype_bits)
+    m = popcount(phenotype_bits).sum(axis=1, dtype=np.int64)
+    xy = pattern_bits[None, :, :] & phenotype_bits[:, None, :]
+    # Constant phenotypes have no correlation, nothing passes inf
+    thresholds = np.where((m > 0) & (m < n_strains), 0.0, np.inf)
+    no_pairs = (np.empty(0), np.empty(0), *[np.empty(0, dtype=np.int64)] * 3)
+    best = [no_pairs] * n_phenotypes
+    tiles = [
+        (i0, j0)
+        for i0 in range(0, len(pattern_bits), tile)
+        for j0 in range(i0, len(pattern_bits), tile)
+    ]
+
+    def merge(found: list[tuple[np.ndarray, ...]]):
+        for ph, tile_best in enumerate(found):
+            abs_r, *columns = (
+                np.concatenate(c) for c in zip(best[ph], tile_best)
+            )
+            best[ph] = _top_k(abs_r, top_k, *columns)
+
+    # Not forked, this can run in a pipeline.py node thread
+    with ProcessPoolExecutor(
+        ncpu,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_scan_worker,
+        initargs=(pattern_bits, xy, m, n_strains),
+    ) as executer, tqdm(total=len(tiles), desc="Pair tiles") as pbar:
+        running = set()
+        for i0, j0 in tiles:
+            running.add(
+                executer.submit(_scan_tile, i0, j0, tile, thresholds, top_k)
+            )
+            # Keep a bounded number of tiles in flight, so that later tiles
+            # get the thresholds raised by earlier ones
+            if len(running) < 2 * ncpu:
+                continue
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                merge(future.result())
+                pbar.update()
+            for ph in range(n_phenotypes):
+                if len(best[ph][0]) >= top_k:
+                    thresholds[ph] = max(thresholds[ph], best[ph][0].min())
+        for future in running:
+            merge(future.result())
+            pbar.update()
+
+    pairs = []
+    for _, r, i, j, interaction in best:
+        n_z = np.where(
+            interaction == 0,
+            popcount(pattern_bits[i] & pattern_bits[j]).sum(axis=1),
+            popcount(pattern_bits[i] ^ pattern_bits[j]).sum(axis=1),
+        )
+        pair_df = pd.DataFrame(
+            {
+                "pattern_a": i,
+                "pattern_b": j,
+                "interaction": np.array(INTERACTIONS)[interaction],
+                "n_strains": n_z,
+                "phi_Corr.": r,
+                "p": pvalue_from_r(r, n_strains),
+            }
+        )
+        pairs.append(pair_df.sort_values(["p", "pattern_a", "pattern_b"]))
+    return pairs
+
+
+def binary_patterns(
+    patterns: np.ndarray, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct variable presence/absence patterns of a (hit count) pattern
+    table, and the new row of each gene; -1 for genes that became constant.
+    """
+    binary, inverse = np.unique(patterns > 0, axis=0, return_inverse=True)
+    is_variable = binary.min(axis=1) != binary.max(axis=1)
+    new_row = np.where(is_variable, np.cumsum(is_variable) - 1, -1)
+    return binary[is_variable], new_row[inverse.ravel()[rows]]
+
+
+def epistasis_paths(strain: str, phenotypes: list[str]) -> dict[str, Path]:
+    _, _, corr_prefix = reference_paths(strain)
+    prefix = corr_prefix.replace("corr_", "epistasis_", 1)
+    return {
+        phenotype: GATHER_MATCH_TSV.parent / f"{prefix}{phenotype}.tsv"
+        for phenotype in phenotypes
+    }
+
+
+def scan_reference(
+    strain: str, phenotype_strains: dict[str, dict[str, float]]
+):
+    _, presence_store, _ = reference_paths(strain)
+    pair_paths = epistasis_paths(strain, list(phenotype_strains))
+
+    def run_scan():
+        presence = read_presence_store(presence_store)
+        patterns, genes, rows = variable_patterns(presence)
+        # Hit counts (QUANTITATIVE_ASSOCIATION) are used as presence/absence
+        patterns, rows = binary_patterns(patterns, rows)
+        # Copy numbers that vary on genes present in all strains
+        is_variable = rows >= 0
+        genes, rows = genes[is_variable], rows[is_variable]
+        gene_lists = (
+            pd.Series(genes, index=rows).groupby(level=0).agg(",".join)
+        )
+        n_genes = np.bincount(rows, minlength=len(patterns))
+        n_strains = len(presence.strains)
+        phenotype_df = gen_phenotype_table(
+            phenotype_strains, presence.strains, quantitative=False
+        )
+        n_pairs = len(patterns) * (len(patterns) - 1) // 2
+        print(
+            f"{strain}: {len(patterns)} presence patterns, {n_pairs} pairs x "
+            f"{phenotype_df.shape[1]} phenotypes."
+        )
+        pairs = scan_pairs(
+            pack_bits(patterns),
+            pack_bits(phenotype_df.to_numpy().T > 0),
+            n_strains,
+        )
+        for phenotype, pair_df in zip(phenotype_df.columns, pairs):
+            # Each pattern stands for its genes
+            for side in "ab":
+                pattern = pair_df[f"pattern_{side}"].to_numpy()
+                pair_df[f"genes_{side}"] = gene_lists.loc[pattern].to_numpy()
+                pair_df[f"n_genes_{side}"] = n_genes[pattern]
+            pair_df[
+                [
+                    "genes_a",
+                    "genes_b",
+                    "n_genes_a",
+                    "n_genes_b",
+                    "interaction",
+                    "n_strains",
+                    "phi_Corr.",
+                    "p",
+                ]
+            ].to_csv(pair_paths[phenotype], sep="\t", index=False)
+            print(
+                f"{phenotype}: best pair p "
+                f"{pair_df['p'].min() if len(pair_df) else np.nan:.3g}, "
+                f"written to {pair_paths[phenotype]}"
+            )
+
+    epistasis_stage = Stage(
+        "epistasis_scan",
+        inputs=[presence_store, STRAINS_STORE],
+        config_keys=["EPISTASIS_TOP_K", "EPISTASIS_TILE"],
+        code=[
+            Path(__file__),
+            Path(__file__).parent / "phenotype_combinations.py",
+            Path(__file__).parent / "step_3_calculate_correlation.py",
+            Path(__file__).parent / "presence_store.py",
+        ],
+        outputs=list(pair_paths.values()),
+    )
+    run_cached(epistasis_stage, run_scan)
+
+
+def main():
+    _, phenotype_strains, _ = load_experimental_data()
+    for strain in REFERENCE_STRAINS:
+        scan_reference(strain, phenotype_strains)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Index sidecar for proteome fasta files.
+# Each proteome (*.faa.gz) is recompressed once as BGZF (blocked gzip, can be
+# seeked into without decompressing from the start) next to a TSV index:
+#   id      protein ID (first word of the header)
+#   length  sequence length
+#   offset  BGZF virtual offset of the record
+#   size    size of the record text in bytes (uncompressed)
+# Steps read the index to list protein IDs and lengths, and slice records
+# out of the BGZF file without parsing the proteome.
+
+import gzip
+from pathlib import Path
+
+import pandas as pd
+from Bio import bgzf
+
+
+def index_paths(index_dir: Path, strain: str) -> tuple[Path, Path]:
+    return index_dir / f"{strain}.faa.bgz", index_dir / f"{strain}.idx.tsv"
+
+
+def build_fasta_index(proteome_p: Path, bgzf_p: Path, index_p: Path):
+    rows = []
+    protein_id = None
+    with gzip.open(proteome_p, "rb") as source, bgzf.BgzfWriter(
+        bgzf_p, "wb"
+    ) as out:
+        for line in source:
+            if line.startswith(b">"):
+                if protein_id is not None:
+                    rows.append((protein_id, length, offset, size))
+                protein_id = line[1:].split(maxsplit=1)[0].decode()
+                offset = out.tell()
+                length = size = 0
+            else:
+                length += len(line.strip())
+            out.write(line)
+            size += len(line)
+        if protein_id is not None:
+            rows.append((protein_id, length, offset, size))
+    index_df = pd.DataFrame(rows, columns=["id", "length", "offset", "size"])
+    # Write then rename, the index only exists for a complete bgzf file
+    tmp_p = index_p.parent / f"{index_p.name}.tmp"
+    index_df.to_csv(tmp_p, sep="\t", index=False)
+    tmp_p.replace(index_p)
+
+
+def is_index_current(proteome_p: Path, index_p: Path) -> bool:
+    return (
+        index_p.exists()
+        and index_p.stat().st_mtime >= proteome_p.stat().st_mtime
+    )
+
+
+def read_fasta_index(index_p: Path) -> pd.DataFrame:
+    """Index rows in file order, indexed by protein ID."""
+    return pd.read_csv(index_p, sep="\t", dtype={"id": str}, index_col="id")
+
+
+def read_records(
+    bgzf_p: Path,
+    index_df: pd.DataFrame,
+    start: int = 0,
+    stop: int | None = None,
+) -> bytes:
+    """
+    Fasta text of records start:stop (positions in the index, which is in
+    file order) with one seek. Resuming at a protein is
+    read_records(bgzf_p, index_df, index_df.index.get_loc(protein_id)).
+    """
+    records = index_df.iloc[start:stop]
+    if records.empty:
+        return b""
+    with bgzf.BgzfReader(bgzf_p, "rb") as reader:
+        reader.seek(int(records["offset"].iloc[0]))
+        return reader.read(int(records["size"].sum()))
+
+
+def read_proteins(
+    bgzf_p: Path, index_df: pd.DataFrame, protein_ids: list[str]
+) -> bytes:
+    """Fasta text of the given proteins, one seek each."""
+    records = []
+    with bgzf.BgzfReader(bgzf_p, "rb") as reader:
+        for offset, size in index_df.loc[
+            protein_ids, ["offset", "size"]
+        ].itertuples(index=False):
+            reader.seek(int(offset))
+            records.append(reader.read(int(size)))
+    return b"".join(records)
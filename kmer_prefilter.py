@@ -0,0 +1,278 @@
+# K-mer prefilter of the jackhmmer database (PREFILTER).
+# The index holds the distinct k-mers (PREFILTER_K amino acids) of every
+# sequence of CONCATENATED_PROTEOMES_FILE, inverted: sorted k-mer codes, and
+# per code the numbers of the sequences having it. Only 1 in
+# PREFILTER_SAMPLE k-mers (chosen by a hash of the k-mer, the same ones for
+# database and queries) is kept, which makes the index PREFILTER_SAMPLE
+# times smaller. Length and byte range of every record are kept as well.
+# For a query shard, a target is a candidate if, for one of the queries, its
+# length is within LEN_DIFF (as step 2 filters) and they share at least
+# PREFILTER_MIN_SHARED sampled k-mers. The candidates are written as the
+# database of that shard; step 1 searches it with -Z of the full database,
+# so E-values are the same as in a full search.
+# Hits of later jackhmmer iterations need not share k-mers with the query,
+# check_recall (run by step 1) compares with a full search on a sample.
+
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from tqdm import tqdm
+
+from artifact_cache import Stage, run_cached
+from load_configs import (
+    CONCATENATED_PROTEOMES_FILE,
+    GATHER_T_E,
+    LEN_DIFF,
+    PREFILTER_INDEX_FILE,
+    PREFILTER_K,
+    PREFILTER_MIN_SHARED,
+    PREFILTER_SAMPLE,
+)
+
+# Database records per k-mer counting pass
+INDEX_CHUNK = 50_000
+# Queries per candidate pass, memory ~ queries x postings of their k-mers
+QUERY_CHUNK = 16
+
+_AMINO_ACIDS = b"ACDEFGHIKLMNPQRSTVWY"
+# Letter -> 0..19, anything else (X, *, gaps) -> 255
+_AMINO_CODES = np.full(256, 255, dtype=np.uint8)
+_AMINO_CODES[np.frombuffer(_AMINO_ACIDS, dtype=np.uint8)] = np.arange(20)
+_AMINO_CODES[np.frombuffer(_AMINO_ACIDS.lower(), dtype=np.uint8)] = np.arange(
+    20
+)
+
+
+class KmerIndex(NamedTuple):
+    kmers: np.ndarray  # sorted k-mer codes
+    # Postings of kmers[i] are targets[offsets[i] : offsets[i + 1]]
+    offsets: np.ndarray
+    targets: np.ndarray  # sequence numbers
+    lengths: np.ndarray  # sequence length
+    starts: np.ndarray  # byte offset of the record in the database
+    sizes: np.ndarray  # record size in bytes
+
+
+def kmer_codes(
+    sequences: list[bytes],
+    k: int = PREFILTER_K,
+    sample: int = PREFILTER_SAMPLE,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct sampled k-mers of each sequence, k-mers with other letters
+    than the 20 amino acids are left out. Codes fit int32 up to k = 7.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: sequence number and k-mer code,
+            sorted by sequence, then code
+    """
+    # "*" is no amino acid, windows across two sequences are dropped
+    letters = _AMINO_CODES[np.frombuffer(b"*".join(sequences), np.uint8)]
+    n = len(letters) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    codes = np.zeros(n, dtype=np.int64)
+    is_valid = np.ones(n, dtype=bool)
+    for j in range(k):
+        window = letters[j : j + n]
+        codes = codes * 20 + window
+        is_valid &= window < 20
+    # High bits of a multiplicative hash, the low ones follow the last letter
+    hashes = (codes.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> (
+        np.uint64(40)
+    )
+    is_valid &= hashes % np.uint64(sample) == 0
+    seq_starts = np.cumsum([0] + [len(s) + 1 for s in sequences[:-1]])
+    positions = np.flatnonzero(is_valid)
+    sequence = np.searchsorted(seq_starts, positions, side="right") - 1
+    keys = np.unique(sequence * 20**k + codes[positions])
+    return (keys // 20**k).astype(np.int32), (keys % 20**k).astype(np.int32)
+
+
+def iter_records(fasta_p: Path):
+    """(byte offset, size, name, sequence) of every record of a fasta."""
+    with fasta_p.open("rb") as fa:
+        start = offset = 0
+        name = None
+        sequence = []
+        for line in fa:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield start, offset - start, name, b"".join(sequence)
+                start = offset
+                name = line[1:].split(maxsplit=1)[0].decode()
+                sequence = []
+            else:
+                sequence.append(line.strip())
+            offset += len(line)
+        if name is not None:
+            yield start, offset - start, name, b"".join(sequence)
+
+
+def build_kmer_index(
+    db_p: Path = CONCATENATED_PROTEOMES_FILE,
+    index_p: Path = PREFILTER_INDEX_FILE,
+    k: int = PREFILTER_K,
+    sample: int = PREFILTER_SAMPLE,
+):
+    if k > 7:
+        raise ValueError(f"PREFILTER_K is {k}, at most 7 is supported.")
+    starts, sizes, lengths = [], [], []
+    pairs = []  # (sequence numbers, k-mer codes) per chunk
+    chunk: list[bytes] = []
+
+    def count_chunk():
+        sequence, codes = kmer_codes(chunk, k, sample)
+        pairs.append((sequence + len(lengths) - len(chunk), codes))
+        chunk.clear()
+
+    with tqdm(
+        total=db_p.stat().st_size,
+        desc="Indexing k-mers",
+        unit="B",
+        unit_scale=True,
+    ) as pbar:
+        for start, size, _, sequence in iter_records(db_p):
+            starts.append(start)
+            sizes.append(size)
+            lengths.append(len(sequence))
+            chunk.append(sequence)
+            pbar.update(size)
+            if len(chunk) == INDEX_CHUNK:
+                count_chunk()
+        count_chunk()
+
+    targets = np.concatenate([sequence for sequence, _ in pairs])
+    codes = np.concatenate([codes for _, codes in pairs])
+    pairs.clear()
+    # Stable, postings of a k-mer stay in sequence order
+    order = np.argsort(codes, kind="stable")
+    kmers, counts = np.unique(codes[order], return_counts=True)
+    index_p.parent.mkdir(parents=True, exist_ok=True)
+    tmp_p = index_p.parent / f"{index_p.stem}.tmp.npz"
+    np.savez(
+        tmp_p,
+        kmers=kmers,
+        offsets=np.concatenate([[0], np.cumsum(counts)]),
+        targets=targets[order],
+        lengths=np.array(lengths, dtype=np.int32),
+        starts=np.array(starts, dtype=np.int64),
+        sizes=np.array(sizes, dtype=np.int64),
+    )
+    tmp_p.replace(index_p)
+    print(
+        f"K-mer index {index_p}: {len(lengths)} sequences, {len(kmers)} "
+        f"k-mers, {len(targets)} postings."
+    )
+
+
+def read_kmer_index(index_p: Path = PREFILTER_INDEX_FILE) -> KmerIndex:
+    with np.load(index_p) as index:
+        return KmerIndex(*(index[name] for name in KmerIndex._fields))
+
+
+def kmer_index() -> KmerIndex:
+    """The index of the current database, built when it changed."""
+    index_stage = Stage(
+        "kmer_index",
+        inputs=[CONCATENATED_PROTEOMES_FILE],
+        config_keys=["PREFILTER_K", "PREFILTER_SAMPLE"],
+        code=[Path(__file__)],
+        outputs=[PREFILTER_INDEX_FILE],
+    )
+    run_cached(index_stage, build_kmer_index)
+    return read_kmer_index()
+
+
+def select_candidates(
+    index: KmerIndex,
+    queries: list[bytes],
+    min_shared: int = PREFILTER_MIN_SHARED,
+    len_diff: float = LEN_DIFF,
+    k: int = PREFILTER_K,
+    sample: int = PREFILTER_SAMPLE,
+) -> np.ndarray:
+    """Sorted numbers of the target sequences of any of the queries."""
+    n_targets = len(index.lengths)
+    found = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(queries), QUERY_CHUNK):
+        chunk = queries[start : start + QUERY_CHUNK]
+        query, codes = kmer_codes(chunk, k, sample)
+        pos = np.minimum(
+            np.searchsorted(index.kmers, codes), len(index.kmers) - 1
+        )
+        is_known = index.kmers[pos] == codes
+        query, pos = query[is_known], pos[is_known]
+        # All postings of the query k-mers, as (query, target) keys
+        first = index.offsets[pos]
+        sizes = index.offsets[pos + 1] - first
+        within = np.arange(sizes.sum()) - np.repeat(
+            np.cumsum(sizes) - sizes, sizes
+        )
+        targets = index.targets[np.repeat(first, sizes) + within]
+        keys, shared = np.unique(
+            np.repeat(query.astype(np.int64), sizes) * n_targets + targets,
+            return_counts=True,
+        )
+        query, target = np.divmod(keys, n_targets)
+        qlen = np.array([len(q) for q in chunk])[query]
+        tlen = index.lengths[target]
+        is_candidate = (shared >= min_shared) & (
+            np.abs(tlen - qlen) / np.minimum(tlen, qlen) <= len_diff
+        )
+        found.append(np.unique(target[is_candidate]))
+    return np.unique(np.concatenate(found))
+
+
+def write_database(
+    index: KmerIndex,
+    targets: np.ndarray,
+    out_p: Path,
+    db_p: Path = CONCATENATED_PROTEOMES_FILE,
+):
+    """Copy the records of targets out of the database, in database order."""
+    tmp_p = out_p.parent / f"{out_p.name}.tmp"
+    with db_p.open("rb") as db, tmp_p.open("wb") as out:
+        for target in targets:
+            db.seek(index.starts[target])
+            out.write(db.read(index.sizes[target]))
+    tmp_p.replace(out_p)
+
+
+def read_queries(fasta_p: Path) -> tuple[list[str], list[bytes]]:
+    """Names and sequences of a query fasta."""
+    records = [(name, seq) for _, _, name, seq in iter_records(fasta_p)]
+    return [name for name, _ in records], [seq for _, seq in records]
+
+
+def read_hit_pairs(
+    domtblout_p: Path, t_e: float = GATHER_T_E, len_diff: float = LEN_DIFF
+) -> set[tuple[str, str]]:
+    """(query, target) pairs that pass the first filter of step 2."""
+    pairs = set()
+    with domtblout_p.open() as dt:
+        for line in dt:
+            if line.startswith("#"):
+                continue
+            fields = line.split(None, 7)
+            tlen, qlen = int(fields[2]), int(fields[5])
+            if (
+                float(fields[6]) <= t_e
+                and abs(tlen - qlen) / min(tlen, qlen) <= len_diff
+            ):
+                pairs.add((fields[3], fields[0]))
+    return pairs
+
+
+@lru_cache(maxsize=4)
+def _count_records(db_p: Path, size: int, mtime_ns: int) -> int:
+    with db_p.open("rb") as db:
+        return sum(1 for line in db if line.startswith(b">"))
+
+
+def count_records(db_p: Path = CONCATENATED_PROTEOMES_FILE) -> int:
+    """Records in the database, counted again only when it changed."""
+    stat = db_p.stat()
+    return _count_records(db_p, stat.st_size, stat.st_mtime_ns)
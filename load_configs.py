@@ -17,6 +17,15 @@ GATHER_T_E = float(thresholds_config["GATHER_T_E"])
 GATHER_T_DOME = float(thresholds_config["GATHER_T_DOME"])
 GATHER_T_COV = float(thresholds_config["GATHER_T_COV"])
 LEN_DIFF = float(thresholds_config["LEN_DIFF"])
+SWEEP_GATHER_T_E = [float(t) for t in thresholds_config["SWEEP_GATHER_T_E"]]
+SWEEP_GATHER_T_DOME = [
+    float(t) for t in thresholds_config["SWEEP_GATHER_T_DOME"]
+]
+SWEEP_GATHER_T_COV = [
+    float(t) for t in thresholds_config["SWEEP_GATHER_T_COV"]
+]
+SWEEP_LEN_DIFF = [float(t) for t in thresholds_config["SWEEP_LEN_DIFF"]]
+SWEEP_TOP_N = int(thresholds_config["SWEEP_TOP_N"])
 
 NCPU = int(project_config["NCPU"])
 TARGET_STRAIN = str(project_config["TARGET_STRAIN"])
@@ -26,7 +35,54 @@ TEMP_PROTEOMICS_IN_TABLE_DIR = Path(project_config["TEMP_PROTEOMICS_IN_TABLE_DIR
 CONCATENATED_PROTEOMES_FILE = Path(project_config["CONCATENATED_PROTEOMES_FILE"])
 STRAINS_PICKLE_FILE = Path(project_config["STRAINS_PICKLE_FILE"])
 DOMTBLOUT_FILE = Path(project_config["DOMTBLOUT_FILE"])
+N_PERMUTATIONS = int(project_config["N_PERMUTATIONS"])
+PERMUTATION_BLOCK = int(project_config["PERMUTATION_BLOCK"])
+PERMUTATION_SEED = int(project_config["PERMUTATION_SEED"])
+LMM_ASSOCIATION = bool(project_config["LMM_ASSOCIATION"])
+QUANTITATIVE_ASSOCIATION = bool(project_config["QUANTITATIVE_ASSOCIATION"])
+PHENOTYPE_COMBINATIONS = [
+    str(e) for e in project_config["PHENOTYPE_COMBINATIONS"]
+]
+COMBINATION_MAX_SIZE = int(project_config["COMBINATION_MAX_SIZE"])
+COMBINATION_MAX_P = float(project_config["COMBINATION_MAX_P"])
+EPISTASIS_TOP_K = int(project_config["EPISTASIS_TOP_K"])
+EPISTASIS_TILE = int(project_config["EPISTASIS_TILE"])
+JACKHMMER_SHARD_SIZE = int(project_config["JACKHMMER_SHARD_SIZE"])
+JACKHMMER_JOBS = int(project_config["JACKHMMER_JOBS"])
+JACKHMMER_MEMORY_GB = float(project_config["JACKHMMER_MEMORY_GB"])
+DEDUP_PROTEOMES = bool(project_config["DEDUP_PROTEOMES"])
+PREFILTER = bool(project_config["PREFILTER"])
+PREFILTER_K = int(project_config["PREFILTER_K"])
+PREFILTER_SAMPLE = int(project_config["PREFILTER_SAMPLE"])
+PREFILTER_MIN_SHARED = int(project_config["PREFILTER_MIN_SHARED"])
+PREFILTER_RECALL_SAMPLE = int(project_config["PREFILTER_RECALL_SAMPLE"])
+ARTIFACT_CACHE_DIR = Path(project_config["ARTIFACT_CACHE_DIR"])
+ARTIFACT_CACHE_MAX_GB = float(project_config["ARTIFACT_CACHE_MAX_GB"])
+MISSING_PROTEOME = str(project_config["MISSING_PROTEOME"])
+EXPORT_TSV = bool(project_config["EXPORT_TSV"])
+# Reference strains whose proteins are scored, TARGET_STRAIN if none given
+REFERENCE_STRAINS = [
+    str(st) for st in project_config["REFERENCE_STRAINS"]
+] or [TARGET_STRAIN]
 
+DATABASE_MANIFEST = CONCATENATED_PROTEOMES_FILE.parent / (
+    f"{CONCATENATED_PROTEOMES_FILE.stem}_manifest.json"
+)
+DEDUP_MEMBERS_FILE = CONCATENATED_PROTEOMES_FILE.parent / (
+    f"{CONCATENATED_PROTEOMES_FILE.stem}_members.tsv.gz"
+)
+PROTEOME_INDEX_DIR = CONCATENATED_PROTEOMES_FILE.parent / (
+    f"{CONCATENATED_PROTEOMES_FILE.stem}_index"
+)
+PREFILTER_INDEX_FILE = CONCATENATED_PROTEOMES_FILE.parent / (
+    f"{CONCATENATED_PROTEOMES_FILE.stem}_kmers.npz"
+)
+# Column stores (column_store.py) of the intermediate tables
+STRAINS_STORE = STRAINS_PICKLE_FILE.parent / f"{STRAINS_PICKLE_FILE.stem}.cols"
+HIT_STORE_DIR = DOMTBLOUT_FILE.parent / f"{DOMTBLOUT_FILE.stem}_hits"
+SWEEP_DIR = DOMTBLOUT_FILE.parent / f"{DOMTBLOUT_FILE.stem}_sweep"
+JACKHMMER_SHARD_DIR = DOMTBLOUT_FILE.parent / f"{DOMTBLOUT_FILE.stem}_shards"
+QUERY_MEMBERS_FILE = DOMTBLOUT_FILE.parent / f"{DOMTBLOUT_FILE.stem}_queries.tsv"
 GATHER_DOMTBL_TSV = DOMTBLOUT_FILE.parent / (
     f"{DOMTBLOUT_FILE.stem}_E{str(GATHER_T_E)}"
     f"_DOME{str(GATHER_T_DOME)}_COV{str(GATHER_T_COV)}_LDIF{str(LEN_DIFF)}.tsv"
@@ -35,4 +91,12 @@ GATHER_MATCH_TSV = DOMTBLOUT_FILE.parent / (
     f"{DOMTBLOUT_FILE.stem}_matches_E{str(GATHER_T_E)}"
     f"_DOME{str(GATHER_T_DOME)}_COV{str(GATHER_T_COV)}_LDIF{str(LEN_DIFF)}.tsv"
 )
-PRESENCE_TSV = Path(GATHER_MATCH_TSV.parent / f"presence_{GATHER_MATCH_TSV.stem}.tsv")
+GATHER_DOMTBL_STORE = GATHER_DOMTBL_TSV.parent / (
+    f"{GATHER_DOMTBL_TSV.stem}.cols"
+)
+GATHER_MATCH_STORE = GATHER_MATCH_TSV.parent / f"{GATHER_MATCH_TSV.stem}.cols"
+LIVE_GATHER_DIR = GATHER_MATCH_TSV.parent / f"{GATHER_MATCH_TSV.stem}_live"
+# Hit counts in quantitative mode, kept apart from the presence/absence tables
+PRESENCE_KIND = "copies" if QUANTITATIVE_ASSOCIATION else "presence"
+PRESENCE_TSV = Path(GATHER_MATCH_TSV.parent / f"{PRESENCE_KIND}_{GATHER_MATCH_TSV.stem}.tsv")
+PRESENCE_STORE = PRESENCE_TSV.parent / f"{PRESENCE_TSV.stem}.bitstore"
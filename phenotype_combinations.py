@@ -0,0 +1,312 @@
+# Correlation with phenotype combinations.
+# A strain has a phenotype if its value is > 0. Phenotypes and the presence
+# patterns of step 3 (presence store) are packed into strain bitsets, 64
+# strains per uint64 word. A combination is a boolean expression over
+# phenotype columns (PHENOTYPE_COMBINATIONS), evaluated with bitwise
+# operations on the bitsets; every "and" of up to COMBINATION_MAX_SIZE
+# phenotypes, each as is or negated, is added. Combinations matching the same
+# strains are scored once.
+# For a gene x and a combination y, both binary, Pearson correlation (phi) is
+#   r = (n * n11 - n1 * m1) / sqrt(n1 * (n - n1) * m1 * (n - m1))
+# with n11 = popcount(x & y), n1 = popcount(x), m1 = popcount(y), so every
+# gene x combination pair costs one AND and one popcount per word.
+# Pairs with p <= COMBINATION_MAX_P are written to combinations.tsv, one row
+# per combination to combinations_index.tsv (per reference strain with
+# REFERENCE_STRAINS, combinations_{strain}*.tsv).
+
+import ast
+import keyword
+from functools import reduce
+from itertools import combinations, product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from artifact_cache import Stage, run_cached
+from load_configs import (
+    COMBINATION_MAX_P,
+    COMBINATION_MAX_SIZE,
+    GATHER_MATCH_TSV,
+    PHENOTYPE_COMBINATIONS,
+    REFERENCE_STRAINS,
+    STRAINS_STORE,
+    TARGET_STRAIN,
+)
+from presence_store import read_presence_store
+from step_3_calculate_correlation import (
+    gen_phenotype_table,
+    load_experimental_data,
+    pvalue_from_r,
+    reference_paths,
+    variable_patterns,
+)
+
+# Combinations per popcount pass, memory ~ patterns x block
+COMBINATION_BLOCK = 1024
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    # numpy < 2.0, count the bits of each byte from a table
+    _BYTE_BITS = np.unpackbits(
+        np.arange(256, dtype=np.uint8)[:, None], axis=1
+    ).sum(axis=1)
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        return (
+            _BYTE_BITS[np.ascontiguousarray(words).view(np.uint8)]
+            .reshape(*words.shape, 8)
+            .sum(axis=-1)
+        )
+
+
+_BIN_OPS = {
+    ast.BitAnd: np.bitwise_and,
+    ast.BitOr: np.bitwise_or,
+    ast.BitXor: np.bitwise_xor,
+}
+
+
+def pack_bits(rows: np.ndarray) -> np.ndarray:
+    """rows x strains (0/1) -> rows x words uint64 bitsets, padding bits 0"""
+    packed = np.packbits(np.asarray(rows, dtype=bool), axis=1)
+    n_words = -(-rows.shape[1] // 64)
+    padded = np.zeros((rows.shape[0], n_words * 8), dtype=np.uint8)
+    padded[:, : packed.shape[1]] = packed
+    return padded.view(np.uint64)
+
+
+def eval_expression(
+    expression: str, bitsets: dict[str, np.ndarray], all_strains: np.ndarray
+) -> np.ndarray:
+    """
+    Bitset of the strains matching a boolean expression of phenotype names,
+    e.g. "A & ~B" or "A | B | C". `and`, `or` and `not` work as well. Names
+    that are no Python identifiers are quoted: "'growth 37C' & ~B".
+
+    Args:
+        bitsets (dict[str, np.ndarray]): {phenotype: bitset}
+        all_strains (np.ndarray): bitset of all strains, for negation
+    """
+
+    def visit(node: ast.AST) -> np.ndarray:
+        if isinstance(node, ast.Expression):
+            return visit(node.body)
+        if isinstance(node, (ast.Name, ast.Constant)):
+            name = node.id if isinstance(node, ast.Name) else node.value
+            if name not in bitsets:
+                raise ValueError(
+                    f"Unknown phenotype {name!r} in {expression!r}."
+                )
+            return bitsets[name]
+        if isinstance(node, ast.UnaryOp) and isinstance(
+            node.op, (ast.Invert, ast.Not)
+        ):
+            return ~visit(node.operand) & all_strains
+        if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            return _BIN_OPS[type(node.op)](visit(node.left), visit(node.right))
+        if isinstance(node, ast.BoolOp):
+            op = (
+                np.bitwise_and
+                if isinstance(node.op, ast.And)
+                else np.bitwise_or
+            )
+            return reduce(op, [visit(value) for value in node.values])
+        raise ValueError(
+            f"Cannot evaluate {ast.unparse(node)!r} in {expression!r}."
+        )
+
+    return visit(ast.parse(expression, mode="eval"))
+
+
+def _quote(name: str) -> str:
+    if name.isidentifier() and not keyword.iskeyword(name):
+        return name
+    return repr(name)
+
+
+def enumerate_combinations(phenotypes: list[str], max_size: int) -> list[str]:
+    """Every "and" of 2 to max_size phenotypes, each one as is or negated."""
+    expressions = []
+    for size in range(2, max_size + 1):
+        for names in combinations(phenotypes, size):
+            for negated in product((False, True), repeat=size):
+                expressions.append(
+                    " & ".join(
+                        f"~{_quote(name)}" if is_neg else _quote(name)
+                        for name, is_neg in zip(names, negated)
+                    )
+                )
+    return expressions
+
+
+def score_combinations(
+    pattern_bits: np.ndarray,
+    combination_bits: np.ndarray,
+    n_strains: int,
+    max_p: float,
+    block_size: int = COMBINATION_BLOCK,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Phi correlation and its p-value (same as pearsonr) of every presence
+    pattern with every combination, from popcounts.
+
+    Args:
+        pattern_bits (np.ndarray): patterns x words
+        combination_bits (np.ndarray): combinations x words
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: pattern,
+            combination, r and p of the pairs with p <= max_p
+    """
+    n = n_strains
+    n_pattern = popcount(pattern_bits).sum(axis=1, dtype=np.int64)
+    n_combination = popcount(combination_bits).sum(axis=1, dtype=np.int64)
+    found = [
+        (
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0),
+            np.empty(0),
+        )
+    ]
+    for start in tqdm(
+        range(0, len(combination_bits), block_size),
+        desc="Combination blocks",
+    ):
+        block_bits = combination_bits[start : start + block_size]
+        n11 = np.zeros((len(pattern_bits), len(block_bits)), dtype=np.int64)
+        # One word of all pairs at a time, memory stays patterns x block
+        for w in range(pattern_bits.shape[1]):
+            n11 += popcount(pattern_bits[:, w, None] & block_bits[None, :, w])
+        n1 = n_pattern[:, None].astype(float)
+        m1 = n_combination[None, start : start + len(block_bits)].astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = (n * n11 - n1 * m1) / np.sqrt(n1 * (n - n1) * m1 * (n - m1))
+        p = pvalue_from_r(r, n)
+        pattern, combination = np.nonzero(p <= max_p)
+        found.append(
+            (
+                pattern,
+                combination + start,
+                r[pattern, combination],
+                p[pattern, combination],
+            )
+        )
+    pattern, combination, r, p = (np.concatenate(c) for c in zip(*found))
+    return pattern, combination, r, p
+
+
+def combination_paths(strain: str) -> tuple[Path, Path]:
+    """Gene x combination table and combination index of a reference."""
+    name = "combinations"
+    if REFERENCE_STRAINS != [TARGET_STRAIN]:
+        name = f"combinations_{strain}"
+    return (
+        GATHER_MATCH_TSV.parent / f"{name}.tsv",
+        GATHER_MATCH_TSV.parent / f"{name}_index.tsv",
+    )
+
+
+def combine_reference(
+    strain: str, phenotype_strains: dict[str, dict[str, float]]
+):
+    _, presence_store, _ = reference_paths(strain)
+    hits_p, index_p = combination_paths(strain)
+
+    def run_combinations():
+        presence = read_presence_store(presence_store)
+        patterns, genes, rows = variable_patterns(presence)
+        n_strains = len(presence.strains)
+        # Hit counts (QUANTITATIVE_ASSOCIATION) are used as presence/absence
+        pattern_bits = pack_bits(patterns > 0)
+        phenotype_df = gen_phenotype_table(
+            phenotype_strains, presence.strains, quantitative=False
+        )
+        bitsets = dict(
+            zip(phenotype_df.columns, pack_bits(phenotype_df.to_numpy().T > 0))
+        )
+        all_strains = pack_bits(np.ones((1, n_strains)))[0]
+        expressions = list(
+            dict.fromkeys(
+                PHENOTYPE_COMBINATIONS
+                + enumerate_combinations(
+                    phenotype_df.columns.tolist(), COMBINATION_MAX_SIZE
+                )
+            )
+        )
+        combination_bits = np.array(
+            [eval_expression(e, bitsets, all_strains) for e in expressions],
+            dtype=np.uint64,
+        ).reshape(len(expressions), len(all_strains))
+        unique_bits, inverse = np.unique(
+            combination_bits, axis=0, return_inverse=True
+        )
+        print(
+            f"{strain}: {len(expressions)} combinations "
+            f"({len(unique_bits)} distinct) x {len(patterns)} presence "
+            "patterns."
+        )
+        pattern, unique, r, p = score_combinations(
+            pattern_bits, unique_bits, n_strains, COMBINATION_MAX_P
+        )
+
+        # Distinct patterns and combinations -> genes and expressions
+        expression_df = pd.DataFrame(
+            {"combination": expressions, "unique": inverse.ravel()}
+        )
+        gene_df = pd.DataFrame({"gene": genes, "pattern": rows})
+        hits_df = (
+            pd.DataFrame(
+                {
+                    "pattern": pattern,
+                    "unique": unique,
+                    "phi_Corr.": r,
+                    "p": p,
+                }
+            )
+            .merge(expression_df, on="unique")
+            .merge(gene_df, on="pattern")
+            .sort_values(["p", "combination", "gene"])
+        )[["combination", "gene", "phi_Corr.", "p"]]
+        print(f"Writing {len(hits_df)} pairs with p <= {COMBINATION_MAX_P}.")
+        hits_df.to_csv(hits_p, sep="\t", index=False)
+
+        index_df = expression_df.set_index("combination")
+        index_df["n_strains"] = popcount(unique_bits).sum(axis=1)[
+            index_df["unique"]
+        ]
+        hits_by_combination = hits_df.groupby("combination")["p"]
+        index_df["n_genes"] = hits_by_combination.size()
+        index_df["min_p"] = hits_by_combination.min()
+        index_df["n_genes"] = index_df["n_genes"].fillna(0).astype(int)
+        index_df.drop(columns="unique").to_csv(index_p, sep="\t")
+
+    combination_stage = Stage(
+        "phenotype_combinations",
+        inputs=[presence_store, STRAINS_STORE],
+        config_keys=[
+            "PHENOTYPE_COMBINATIONS",
+            "COMBINATION_MAX_SIZE",
+            "COMBINATION_MAX_P",
+        ],
+        code=[
+            Path(__file__),
+            Path(__file__).parent / "step_3_calculate_correlation.py",
+            Path(__file__).parent / "presence_store.py",
+        ],
+        outputs=[hits_p, index_p],
+    )
+    run_cached(combination_stage, run_combinations)
+
+
+def main():
+    _, phenotype_strains, _ = load_experimental_data()
+    for strain in REFERENCE_STRAINS:
+        combine_reference(strain, phenotype_strains)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Run the whole pipeline in one process:
+#   python pipeline.py                 everything up to the correlations
+#   python pipeline.py gather          only what step 2 needs
+#   python pipeline.py correlate sweep also the threshold sweep
+#   python pipeline.py live            step 2 and 3 during the search
+#   python pipeline.py combinations    also the phenotype combinations
+#   python pipeline.py epistasis       also the gene pair scan
+# Steps are nodes of a DAG. Each node reads its inputs from the artifacts of
+# the nodes it requires (files, as when the steps are run as scripts) and
+# nodes whose requirements are done run at the same time, up to --jobs.
+# Nodes that are up to date finish quickly on their own (manifests of step 0
+# and 1, artifact cache of step 2 and 3).
+
+import argparse
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, NamedTuple
+
+import epistasis_scan
+import phenotype_combinations
+import step_0_gather_proteome
+import step_1_jackhmmer
+import step_2_live
+import step_2_parse_domtbl
+import step_3_calculate_correlation
+import sweep_thresholds
+from load_configs import (
+    CONCATENATED_PROTEOMES_FILE,
+    DOMTBLOUT_FILE,
+    GATHER_MATCH_STORE,
+    GATHER_MATCH_TSV,
+    JACKHMMER_SHARD_DIR,
+    LIVE_GATHER_DIR,
+    MISSING_PROTEOME,
+    PRESENCE_STORE,
+    PROTEOME_INDEX_DIR,
+    REFERENCE_STRAINS,
+    STRAINS_STORE,
+    SWEEP_DIR,
+)
+
+
+class Node(NamedTuple):
+    requires: list[str]
+    artifacts: list  # made by the node, for --list
+    run: Callable[[argparse.Namespace], None]
+
+
+def run_strains(args: argparse.Namespace):
+    step_0_gather_proteome.gather_strains(args.missing_proteome)
+
+
+def run_database(args: argparse.Namespace):
+    _, all_strains = step_0_gather_proteome.load_strains()
+    CONCATENATED_PROTEOMES_FILE.parent.mkdir(exist_ok=True)
+    step_0_gather_proteome.build_database(all_strains)
+
+
+def run_indexes(args: argparse.Namespace):
+    _, all_strains = step_0_gather_proteome.load_strains()
+    step_0_gather_proteome.build_proteome_indexes(all_strains)
+
+
+def run_search(args: argparse.Namespace):
+    if not step_1_jackhmmer.main():
+        raise RuntimeError("jackhmmer shards failed, run again to retry.")
+
+
+def run_live(args: argparse.Namespace):
+    """Search, with step 2 and 3 following the finished shards."""
+    # Queries are written before the follower reads them
+    step_1_jackhmmer.split_queries(REFERENCE_STRAINS, JACKHMMER_SHARD_DIR)
+    with ThreadPoolExecutor(1) as executer:
+        search = executer.submit(step_1_jackhmmer.main)
+        is_complete = step_2_live.follow(search.done)
+    if not search.result() or not is_complete:
+        raise RuntimeError("jackhmmer shards failed, run again to retry.")
+
+
+NODES = {
+    "strains": Node([], [STRAINS_STORE], run_strains),
+    "database": Node(["strains"], [CONCATENATED_PROTEOMES_FILE], run_database),
+    "indexes": Node(["strains"], [PROTEOME_INDEX_DIR], run_indexes),
+    "search": Node(["database", "indexes"], [DOMTBLOUT_FILE], run_search),
+    "gather": Node(
+        ["search"],
+        [GATHER_MATCH_STORE],
+        lambda args: step_2_parse_domtbl.main(),
+    ),
+    "correlate": Node(
+        ["gather", "indexes"],
+        [PRESENCE_STORE, GATHER_MATCH_TSV.parent / "corr_*.tsv"],
+        lambda args: step_3_calculate_correlation.main(),
+    ),
+    "live": Node(
+        ["database", "indexes"],
+        [LIVE_GATHER_DIR, GATHER_MATCH_STORE, PRESENCE_STORE],
+        run_live,
+    ),
+    "combinations": Node(
+        ["correlate"],
+        [GATHER_MATCH_TSV.parent / "combinations*.tsv"],
+        lambda args: phenotype_combinations.main(),
+    ),
+    "epistasis": Node(
+        ["correlate"],
+        [GATHER_MATCH_TSV.parent / "epistasis_*.tsv"],
+        lambda args: epistasis_scan.main(),
+    ),
+    "sweep": Node(
+        ["search", "indexes"],
+        [SWEEP_DIR],
+        lambda args: sweep_thresholds.main(),
+    ),
+}
+
+
+def required_nodes(targets: list[str]) -> list[str]:
+    """Targets and everything they require, requirements first."""
+    order = []
+
+    def visit(name: str):
+        if name in order:
+            return
+        for required in NODES[name].requires:
+            visit(required)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def run_dag(targets: list[str], args: argparse.Namespace, jobs: int = 2):
+    """
+    Start every node as soon as all it requires is done. A failed node
+    stops the run after the running nodes finished, nothing new starts.
+    """
+    todo = required_nodes(targets)
+    done: set[str] = set()
+    running = {}  # {future: name}
+    with ThreadPoolExecutor(jobs) as executer:
+        while todo or running:
+            ready = [
+                name
+                for name in todo
+                if all(r in done for r in NODES[name].requires)
+            ]
+            for name in ready[: jobs - len(running)]:
+                print(f"\n=== {name} ===")
+                running[executer.submit(NODES[name].run, args)] = name
+                todo.remove(name)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    todo.clear()
+                    wait(running)
+                    raise RuntimeError(f"{name} failed") from (
+                        future.exception()
+                    )
+                print(f"=== {name} done ===")
+                done.add(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline steps as one DAG."
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        default=["correlate"],
+        help=f"Nodes to make, with everything they require: "
+        f"{', '.join(NODES)} (correlate).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=2,
+        help="Nodes running at the same time (2).",
+    )
+    parser.add_argument(
+        "--missing-proteome",
+        choices=["ask", "skip", "fail"],
+        default=MISSING_PROTEOME,
+        help=f"Overrides MISSING_PROTEOME ({MISSING_PROTEOME}).",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="Show the DAG and exit."
+    )
+    args = parser.parse_args()
+    unknown = [t for t in args.targets if t not in NODES]
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+
+    if args.list:
+        for name, node in NODES.items():
+            print(
+                f"{name:10} requires {', '.join(node.requires) or '-':18} "
+                f"makes {', '.join(str(a) for a in node.artifacts)}"
+            )
+        sys.exit(0)
+    run_dag(args.targets, args, args.jobs)
@@ -0,0 +1,91 @@
+# Compact on-disk presence/absence table.
+# A store is a directory with:
+#   patterns.bits  distinct presence patterns, one bit per strain, each row
+#                  padded to whole bytes (numpy.packbits)
+#   patterns.counts  instead of patterns.bits for hit count tables
+#                  (QUANTITATIVE_ASSOCIATION), one uint16 per strain
+#   genes.tsv      gene\tpattern, the row in patterns.bits of each gene
+#   strains.txt    strain names in column order, one per line
+# Genes with identical presence patterns (core genes, co-inherited cassettes)
+# share one row, so the work on the patterns can be done once and expanded
+# to the genes afterwards.
+
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+class PresencePatterns(NamedTuple):
+    patterns: np.ndarray  # distinct patterns x strains
+    gene_pattern: pd.Series  # gene -> row in patterns
+    strains: list[str]
+
+
+def dedup_presence(presence_df: pd.DataFrame) -> PresencePatterns:
+    """
+    Collapse genes with identical presence rows into one pattern.
+    Strains are sorted, gene order is kept.
+    """
+    strains = sorted(presence_df.columns)
+    patterns, inverse = np.unique(
+        presence_df[strains].to_numpy(), axis=0, return_inverse=True
+    )
+    gene_pattern = pd.Series(
+        inverse.ravel(), index=presence_df.index, name="pattern"
+    )
+    return PresencePatterns(patterns, gene_pattern, strains)
+
+
+def expand_patterns(presence: PresencePatterns) -> pd.DataFrame:
+    """Back to a genes x strains DataFrame."""
+    return pd.DataFrame(
+        presence.patterns[presence.gene_pattern.to_numpy()],
+        index=presence.gene_pattern.index,
+        columns=presence.strains,
+    )
+
+
+def write_presence_store(presence: PresencePatterns, store_p: Path):
+    store_p.mkdir(parents=True, exist_ok=True)
+    bits_p, counts_p = store_p / "patterns.bits", store_p / "patterns.counts"
+    if np.isin(presence.patterns, (0, 1)).all():
+        np.packbits(presence.patterns.astype(np.uint8), axis=1).tofile(bits_p)
+        counts_p.unlink(missing_ok=True)
+    else:
+        if presence.patterns.max() > np.iinfo(np.uint16).max:
+            raise ValueError("Hit counts above 65535 do not fit the store.")
+        presence.patterns.astype(np.uint16).tofile(counts_p)
+        bits_p.unlink(missing_ok=True)
+    presence.gene_pattern.to_csv(store_p / "genes.tsv", sep="\t")
+    (store_p / "strains.txt").write_text("\n".join(presence.strains) + "\n")
+
+
+def read_presence_store(store_p: Path) -> PresencePatterns:
+    strains = (store_p / "strains.txt").read_text().splitlines()
+    gene_pattern = pd.read_csv(
+        store_p / "genes.tsv", sep="\t", index_col=0, dtype={"gene": str}
+    )["pattern"]
+    n_patterns = int(gene_pattern.max()) + 1 if len(gene_pattern) else 0
+    counts_p = store_p / "patterns.counts"
+    if counts_p.exists():
+        patterns = np.asarray(
+            np.memmap(
+                counts_p,
+                dtype=np.uint16,
+                mode="r",
+                shape=(n_patterns, len(strains)),
+            )
+        )
+        return PresencePatterns(patterns, gene_pattern, strains)
+    # Unpacked into a private array of one byte per strain, the packed file
+    # is 8 times smaller on disk but not in memory
+    bits = np.memmap(
+        store_p / "patterns.bits",
+        dtype=np.uint8,
+        mode="r",
+        shape=(n_patterns, (len(strains) + 7) // 8),
+    )
+    patterns = np.unpackbits(bits, axis=1, count=len(strains))
+    return PresencePatterns(patterns, gene_pattern, strains)
@@ -5,35 +5,62 @@
 # Then, make a database containing only *all tested strains*
 
 import gzip
-import pickle
+import hashlib
+import json
+import multiprocessing
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 
 import pandas as pd
 from Bio import SeqIO
 from tqdm import tqdm
 
+from column_store import read_table, write_table
+from fasta_index import build_fasta_index, index_paths, is_index_current
 from load_configs import (
     CONCATENATED_PROTEOMES_FILE,
+    DATABASE_MANIFEST,
+    DEDUP_MEMBERS_FILE,
+    DEDUP_PROTEOMES,
     MIN_PROTEIN_LEN,
+    MISSING_PROTEOME,
+    NCPU,
     PHENOTYPE_TABLE_FILE,
+    PROTEOME_INDEX_DIR,
     SOURCE_DATABASE_DIR,
-    STRAINS_PICKLE_FILE,
+    STRAINS_STORE,
     TEMP_PROTEOMICS_IN_TABLE_DIR,
 )
 
 
-def handle_missing_proteome(strain_name):
+def handle_missing_proteome(strain_name, policy=MISSING_PROTEOME):
     """
-    Handle missing proteome files by asking user for input.
+    Handle missing proteome files according to policy:
+    "skip" continue without the strain, "fail" exit, "ask" ask the user
+    (only with a terminal, unattended runs exit).
 
     Args:
         strain_name (str): Name of the strain with missing proteome
+        policy (str): "ask", "skip" or "fail"
 
     Returns:
         bool: True to continue, False to exit
     """
     print(f"\nWARNING: Proteome of strain '{strain_name}' not found.")
+    if policy == "skip":
+        return True
+    if policy == "fail":
+        print("MISSING_PROTEOME is 'fail', exiting program...")
+        return False
+    if not sys.stdin.isatty():
+        print(
+            "No terminal to ask, exiting program... Set MISSING_PROTEOME to "
+            "'skip' to continue without missing strains."
+        )
+        return False
     while True:
         choice = (
             input("Do you want to continue without this strain? (y/n/a): ")
@@ -52,16 +79,255 @@ def handle_missing_proteome(strain_name):
             print("Please enter 'y' (yes), 'n' (no), or 'a' (all missing).")
 
 
-# STRAINS_PICKLE = Path("step_0_gather_proteome_strains.pickle")
-# Saves a dict of dict:
-# {
-#    "Phenotype1": {"strain1": PosixPath("..."), "strain2": PosixPath("...")},
-#    "Phenotype2": {"strain3": PosixPath("..."), "strain4": PosixPath("...")},
-#    ...
-# }
-# With each strain mapped to its proteome file path
+def index_source_dir(source_dir: Path) -> dict[str, Path]:
+    """
+    Scan the source directory once. Every part of a file name split at
+    "_" and "." maps to the file, the first file in glob order wins (same as
+    looking up each strain with a glob).
+    """
+    source_index: dict[str, Path] = {}
+    for f in source_dir.glob("*.faa.gz"):
+        for token in re.split(r"_|\.", f.name):
+            source_index.setdefault(token, f)
+    return source_index
 
-if __name__ == "__main__":
+
+def file_md5(file_p: Path) -> str:
+    md5 = hashlib.md5()
+    with file_p.open("rb") as fh:
+        while chunk := fh.read(1024**2):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_proteome(
+    st: str, proteome_p: Path, dedup: bool, min_len: int = MIN_PROTEIN_LEN
+) -> tuple[str, list[tuple[str, str, str]]]:
+    """
+    Decompress and filter one proteome (runs in the process pool).
+
+    Returns:
+        tuple[str, list[tuple[str, str, str]]]: md5 of the source file, and
+            (protein id, seq_id, fasta record) of every protein of at least
+            min_len. With dedup the record is named by seq_id
+            (seq_<blake2b hash of the sequence>) and has the protein
+            description, otherwise it is named strain_protein and seq_id is
+            empty.
+    """
+    records = []
+    with gzip.open(proteome_p, "rt") as source:
+        for prot in SeqIO.parse(source, "fasta"):
+            if len(prot) < min_len:
+                continue
+            protein_id = prot.id
+            seq_id = ""
+            if dedup:
+                seq_id = (
+                    "seq_"
+                    + hashlib.blake2b(
+                        str(prot.seq).encode(), digest_size=10
+                    ).hexdigest()
+                )
+                prot.description = prot.description[len(prot.id) :].strip()
+                prot.id = seq_id
+            else:
+                prot.id = f"{st}_{prot.id}"
+            records.append((protein_id, seq_id, prot.format("fasta")))
+    return file_md5(proteome_p), records
+
+
+def load_database_manifest(manifest_p: Path) -> dict:
+    if manifest_p.exists():
+        with manifest_p.open() as mf:
+            return json.load(mf)
+    return {}
+
+
+def save_database_manifest(manifest_p: Path, manifest: dict):
+    tmp_p = manifest_p.parent / f"{manifest_p.name}.tmp"
+    with tmp_p.open("w") as mf:
+        json.dump(manifest, mf, indent=1)
+    tmp_p.replace(manifest_p)
+
+
+def is_source_unchanged(record: dict, proteome_p: Path) -> bool:
+    """Size and mtime first, the md5 only when they differ."""
+    stat = proteome_p.stat()
+    if record["size"] != stat.st_size:
+        return False
+    if record["mtime"] == stat.st_mtime:
+        return True
+    if record["md5"] == file_md5(proteome_p):
+        record["mtime"] = stat.st_mtime
+        return True
+    return False
+
+
+def build_database(
+    all_strains: dict[str, Path],
+    db_p: Path = CONCATENATED_PROTEOMES_FILE,
+    manifest_p: Path = DATABASE_MANIFEST,
+    dedup: bool = DEDUP_PROTEOMES,
+    members_p: Path = DEDUP_MEMBERS_FILE,
+    ncpu: int = NCPU,
+):
+    """
+    Make the database fasta, only processing strains that are new or whose
+    proteome changed since the last run.
+    The manifest records per strain its source file (size, mtime, md5) and
+    the byte range of its block in the database. New strains are appended;
+    if strains were removed or changed, the unchanged blocks are copied
+    over byte by byte and only the changed ones are read again.
+    With dedup (see DEDUP_PROTEOMES) a strain only adds sequences not in
+    the database yet, so removing or changing strains rebuilds it.
+    """
+    settings = {"min_protein_len": MIN_PROTEIN_LEN, "dedup": dedup}
+    manifest = load_database_manifest(manifest_p)
+    old_strains: dict[str, dict] = manifest.get("strains", {})
+    db_size = sum(r["length"] for r in old_strains.values())
+    if (
+        manifest.get("settings") != settings
+        or not db_p.exists()
+        or db_p.stat().st_size != db_size
+        or (dedup and not members_p.exists())
+    ):
+        old_strains = {}
+
+    unchanged = {
+        st
+        for st, record in old_strains.items()
+        if st in all_strains
+        and record["source"] == str(all_strains[st].resolve())
+        and is_source_unchanged(record, all_strains[st])
+    }
+    todo = [st for st in all_strains if st not in unchanged]
+    is_append = set(old_strains) == unchanged
+    if dedup and not is_append:
+        unchanged = set()
+        todo = list(all_strains)
+    print(
+        f"{len(unchanged)} strains unchanged, {len(todo)} to process"
+        + ("." if is_append else ", rebuilding.")
+    )
+
+    strains: dict[str, dict] = {st: old_strains[st] for st in unchanged}
+    seen: set[str] = set()
+    if dedup and unchanged:
+        seen = set(
+            pd.read_csv(members_p, sep="\t", usecols=["seq_id"])["seq_id"]
+        )
+    tmp_p = db_p.parent / f"{db_p.name}.tmp"
+    # forkserver, forking from the threads of pipeline.py can deadlock
+    with ProcessPoolExecutor(
+        ncpu, mp_context=multiprocessing.get_context("forkserver")
+    ) as executer:
+        proteomes = executer.map(
+            read_proteome,
+            todo,
+            [all_strains[st] for st in todo],
+            [dedup] * len(todo),
+        )
+        if is_append and unchanged:
+            db_handle = db_p.open("ab")
+            members = gzip.open(members_p, "at") if dedup else None
+        else:
+            db_handle = tmp_p.open("wb")
+            members = gzip.open(members_p, "wt") if dedup else None
+            if members is not None:
+                members.write("seq_id\tstrain\tprotein\n")
+            # Copy unchanged blocks in their old order
+            with db_p.open("rb") if unchanged else nullcontext() as old_db:
+                for st in sorted(
+                    unchanged, key=lambda st: strains[st]["offset"]
+                ):
+                    old_db.seek(strains[st]["offset"])
+                    strains[st] = dict(strains[st], offset=db_handle.tell())
+                    db_handle.write(old_db.read(strains[st]["length"]))
+        with db_handle:
+            for st, (md5, records) in tqdm(
+                zip(todo, proteomes), total=len(todo), desc="Proteomes"
+            ):
+                offset = db_handle.tell()
+                block = []
+                for protein_id, seq_id, record in records:
+                    if dedup:
+                        members.write(f"{seq_id}\t{st}\t{protein_id}\n")
+                        if seq_id in seen:
+                            continue
+                        seen.add(seq_id)
+                    block.append(record)
+                db_handle.write("".join(block).encode())
+                proteome_p = all_strains[st]
+                stat = proteome_p.stat()
+                strains[st] = {
+                    "source": str(proteome_p.resolve()),
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "md5": md5,
+                    "n_proteins": len(records),
+                    "offset": offset,
+                    "length": db_handle.tell() - offset,
+                }
+        if members is not None:
+            members.close()
+    if tmp_p.exists():
+        tmp_p.replace(db_p)
+    save_database_manifest(
+        manifest_p, {"settings": settings, "strains": strains}
+    )
+    if dedup:
+        print(f"{len(seen)} unique sequences, members in {members_p}.")
+
+
+def build_proteome_indexes(
+    all_strains: dict[str, Path],
+    index_dir: Path = PROTEOME_INDEX_DIR,
+    ncpu: int = NCPU,
+):
+    """
+    BGZF copy and index of every proteome (see fasta_index.py), only for
+    strains without an index or with a newer proteome file.
+    """
+    index_dir.mkdir(parents=True, exist_ok=True)
+    todo = [
+        st
+        for st, proteome_p in all_strains.items()
+        if not is_index_current(proteome_p, index_paths(index_dir, st)[1])
+    ]
+    print(f"Indexing {len(todo)} proteomes in {index_dir}.")
+    with ProcessPoolExecutor(
+        ncpu, mp_context=multiprocessing.get_context("forkserver")
+    ) as executer:
+        futures = [
+            executer.submit(
+                build_fasta_index, all_strains[st], *index_paths(index_dir, st)
+            )
+            for st in todo
+        ]
+        for future in tqdm(futures, desc="Indexing"):
+            future.result()
+
+
+# STRAINS_STORE, one row per strain with a proteome:
+#   strain      strain name
+#   proteome    file name of its proteome in TEMP_PROTEOMICS_IN_TABLE_DIR
+#   Phenotype1  value, NaN if the strain has none
+#   ...
+# Read back as
+#   phenotype_strains {"Phenotype1": {"strain1": value, ...}, ...}
+#   all_strains       {"strain1": proteome path, ...}
+# Proteome paths are joined with TEMP_PROTEOMICS_IN_TABLE_DIR when read, the
+# store stays valid when the directories move.
+
+
+def gather_strains(missing_policy: str = MISSING_PROTEOME):
+    """
+    Read the phenotype table, find the proteome of each strain and write
+    STRAINS_STORE.
+
+    Returns:
+        tuple[dict, dict]: phenotype_strains, all_strains
+    """
     # Dictionary to store strains for each phenotype
     # Structure: {"Phenotype1": {"strain1": "", "strain2": ""}, ...}
     phenotype_strains: dict[str, dict[str, float]] = {}
@@ -90,44 +356,41 @@ if __name__ == "__main__":
 
     # Process each phenotype column
     for phenotype in phenotype_names:
-        # Get strains where the phenotype value is > 0 (and not NaN)
-        positive_strains = df[df[phenotype] > 0][phenotype]
-        for strain, value in positive_strains.to_dict().items():
+        # Get all strains with a value (not NaN), zero and negative values
+        # included. Step 3 decides which values it uses.
+        measured_strains = df[phenotype].dropna()
+        for strain, value in measured_strains.to_dict().items():
             phenotype_strains[phenotype][strain] = value
 
     print(f"Total strains in {PHENOTYPE_TABLE_FILE}: {df.shape[0]}")
     print(f"Phenotypes found: {phenotype_names}")
     for phenotype, strains in phenotype_strains.items():
-        print(f"  {phenotype}: {len(strains)} strains")
+        n_positive = sum(value > 0 for value in strains.values())
+        print(f"  {phenotype}: {len(strains)} strains, {n_positive} > 0")
 
     # Find proteome files for each strain in each phenotype
     continue_all_missing = False  # Flag to auto-continue for all missing files
     all_strains: dict[str, Path] = {}  # Store all strains for later use
+    source_index = index_source_dir(SOURCE_DATABASE_DIR)
     for st in list(df.index):
-        found = False
-        for f in SOURCE_DATABASE_DIR.glob("*.faa.gz"):
-            if st in re.split(r"_|\.", f.name):
-                # print(f'Strain {st} path {f}')
-                found = True
-                # Create a symlink in TEMP_PROTEOMICS_IN_TABLE_DIR
-                symlink_path = TEMP_PROTEOMICS_IN_TABLE_DIR / f.name
-                try:
-                    symlink_path.symlink_to(
-                        f.relative_to(
-                            TEMP_PROTEOMICS_IN_TABLE_DIR, walk_up=True
-                        )
-                    )
-                except FileExistsError:
-                    pass
-                all_strains[st] = symlink_path
-                break
-        if not found:
+        f = source_index.get(st)
+        if f is not None:
+            # Create a symlink in TEMP_PROTEOMICS_IN_TABLE_DIR
+            symlink_path = TEMP_PROTEOMICS_IN_TABLE_DIR / f.name
+            try:
+                symlink_path.symlink_to(
+                    f.relative_to(TEMP_PROTEOMICS_IN_TABLE_DIR, walk_up=True)
+                )
+            except FileExistsError:
+                pass
+            all_strains[st] = symlink_path
+        else:
             continue_anyway = True
             if not continue_all_missing:
-                continue_anyway = handle_missing_proteome(st)
+                continue_anyway = handle_missing_proteome(st, missing_policy)
                 if continue_anyway is False:
                     # User chose to exit
-                    exit(1)
+                    sys.exit(1)
                 elif continue_anyway == "all":
                     continue_all_missing = True
             if continue_anyway or continue_all_missing:
@@ -137,27 +400,61 @@ if __name__ == "__main__":
                     if st in strains:
                         phenotype_strains[phenotype].pop(st, None)
 
+    print(f"Writing strains {STRAINS_STORE}.")
+    write_strains(phenotype_strains, all_strains)
+    return phenotype_strains, all_strains
+
+
+def write_strains(
+    phenotype_strains: dict[str, dict[str, float]],
+    all_strains: dict[str, Path],
+    store_p: Path = STRAINS_STORE,
+):
+    reserved = {"strain", "proteome"} & set(phenotype_strains)
+    if reserved:
+        raise ValueError(
+            f"Phenotype names {', '.join(reserved)} are reserved, rename "
+            f"them in {PHENOTYPE_TABLE_FILE}."
+        )
+    strains_df = pd.DataFrame(
+        {
+            "strain": list(all_strains),
+            "proteome": [p.name for p in all_strains.values()],
+        }
+    )
+    for phenotype, strains in phenotype_strains.items():
+        strains_df[phenotype] = (
+            strains_df["strain"].map(strains).astype(float).to_numpy()
+        )
+    write_table(strains_df, store_p)
+
+
+def load_strains(
+    store_p: Path = STRAINS_STORE,
+) -> tuple[dict[str, dict[str, float]], dict[str, Path]]:
+    strains_df = read_table(store_p).astype({"strain": str, "proteome": str})
+    strains_df = strains_df.set_index("strain")
+    all_strains = {
+        st: TEMP_PROTEOMICS_IN_TABLE_DIR / proteome
+        for st, proteome in strains_df.pop("proteome").items()
+    }
+    phenotype_strains = {
+        phenotype: values.dropna().to_dict()
+        for phenotype, values in strains_df.items()
+    }
+    return phenotype_strains, all_strains
+
+
+def main(missing_policy: str = MISSING_PROTEOME):
+    _, all_strains = gather_strains(missing_policy)
     CONCATENATED_PROTEOMES_FILE.parent.mkdir(exist_ok=True)
 
     print("Making database fasta:")
-    if CONCATENATED_PROTEOMES_FILE.exists():
-        print(f"Removing existing {CONCATENATED_PROTEOMES_FILE}.")
-        CONCATENATED_PROTEOMES_FILE.unlink()
-    CONCATENATED_PROTEOMES_FILE.touch()
-    with CONCATENATED_PROTEOMES_FILE.open("at", encoding="utf-8") as db_handle:
-        for st, proteome_p in tqdm(all_strains.items()):
-            with gzip.open(proteome_p, "rt") as source:
-                prots = []
-                for prot in SeqIO.parse(source, "fasta"):
-                    prot.id = f"{st}_{prot.id}"
-                    if len(prot) < MIN_PROTEIN_LEN:
-                        continue
-                    prots.append(prot)
-                SeqIO.write(prots, db_handle, "fasta")
+    build_database(all_strains)
+    build_proteome_indexes(all_strains)
 
     print(f"Database fasta file {CONCATENATED_PROTEOMES_FILE}.")
-    if STRAINS_PICKLE_FILE.exists():
-        STRAINS_PICKLE_FILE.unlink()
-    STRAINS_PICKLE_FILE.touch()
-    with STRAINS_PICKLE_FILE.open("wb") as sp:
-        pickle.dump((phenotype_strains, all_strains), sp)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,727 @@
+# Run jackhmmer for all proteins of the reference proteome (TARGET_STRAIN, or
+# every strain of REFERENCE_STRAINS) against the concatenated proteomes.
+# The reference proteome is split into query shards of JACKHMMER_SHARD_SIZE
+# proteins, JACKHMMER_JOBS jackhmmer processes run at the same time, each
+# writing its own domtblout. A manifest in JACKHMMER_SHARD_DIR records the
+# finished shards, a rerun only redoes failed or missing ones. When all
+# shards are done they are merged into DOMTBLOUT_FILE for step 2.
+# Jobs are admitted against a memory budget (JACKHMMER_MEMORY_GB) using the
+# peak memory and wall time recorded per query in query_stats.json, failed
+# shards are split and retried (see MemoryScheduler).
+# With PREFILTER each shard is searched against its candidate targets only
+# (kmer_prefilter.py), and the recall of that against a full search is
+# checked on a sample of PREFILTER_RECALL_SAMPLE queries.
+
 import gzip
-import pickle
-from subprocess import run
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from io import StringIO
+from pathlib import Path
+from subprocess import DEVNULL, Popen
+from typing import Callable, NamedTuple
+
+import numpy as np
+from Bio import SeqIO
 
+from fasta_index import index_paths, read_fasta_index, read_records
 from load_configs import (
     CONCATENATED_PROTEOMES_FILE,
+    DEDUP_MEMBERS_FILE,
+    DEDUP_PROTEOMES,
     DOMTBLOUT_FILE,
+    JACKHMMER_JOBS,
+    JACKHMMER_MEMORY_GB,
+    JACKHMMER_SHARD_DIR,
+    JACKHMMER_SHARD_SIZE,
+    LEN_DIFF,
     NCPU,
-    STRAINS_PICKLE_FILE,
+    PREFILTER,
+    PREFILTER_K,
+    PREFILTER_MIN_SHARED,
+    PREFILTER_RECALL_SAMPLE,
+    PREFILTER_SAMPLE,
+    PROTEOME_INDEX_DIR,
+    QUERY_MEMBERS_FILE,
+    REFERENCE_STRAINS,
     T_DOME,
     T_E,
     T_INCDOME,
     T_INCE,
-    TARGET_STRAIN,
 )
+from kmer_prefilter import (
+    KmerIndex,
+    count_records,
+    kmer_index,
+    read_hit_pairs,
+    read_queries,
+    select_candidates,
+    write_database,
+)
+
+MANIFEST_NAME = "manifest.json"
+QUERY_STATS_NAME = "query_stats.json"
+
+
+def database_size() -> int | None:
+    """
+    With DEDUP_PROTEOMES the database holds each sequence once. Its size
+    for E-value calculation (-Z) is then the number of proteins before
+    deduplication, so that E-values stay comparable with the full database.
+    A prefiltered search (PREFILTER) gets the size of the full database.
+    """
+    if DEDUP_PROTEOMES:
+        with gzip.open(DEDUP_MEMBERS_FILE, "rt") as members:
+            return sum(1 for _ in members) - 1
+    if PREFILTER:
+        return count_records(CONCATENATED_PROTEOMES_FILE)
+    return None
+
+
+def jackhmmer_params() -> dict:
+    """Everything that changes the search result, recorded per shard."""
+    params = {
+        "T_E": T_E,
+        "T_INCE": T_INCE,
+        "T_DOME": T_DOME,
+        "T_INCDOME": T_INCDOME,
+        "Z": database_size(),
+        "database": str(CONCATENATED_PROTEOMES_FILE),
+        "database_mtime": CONCATENATED_PROTEOMES_FILE.stat().st_mtime,
+    }
+    if PREFILTER:
+        params["prefilter"] = {
+            "k": PREFILTER_K,
+            "sample": PREFILTER_SAMPLE,
+            "min_shared": PREFILTER_MIN_SHARED,
+            "len_diff": LEN_DIFF,
+        }
+    return params
+
+
+def shard_names(n_proteins: int, shard_size: int = JACKHMMER_SHARD_SIZE):
+    return [
+        f"shard_{k:04d}"
+        for k in range((n_proteins + shard_size - 1) // shard_size)
+    ]
+
+
+def write_if_changed(file_p: Path, content: bytes) -> str:
+    """Rewrite file_p only if content changed, return md5 of content."""
+    if not file_p.exists() or file_p.read_bytes() != content:
+        file_p.write_bytes(content)
+    return hashlib.md5(content).hexdigest()
+
+
+def split_ref_proteome(
+    strain: str,
+    shard_dir: Path,
+    shard_size: int = JACKHMMER_SHARD_SIZE,
+    index_dir: Path = PROTEOME_INDEX_DIR,
+) -> dict[str, str]:
+    """
+    Write the reference proteome as query shards shard_0000.fasta, ...
+    Each shard is sliced out of the indexed BGZF copy (see fasta_index.py)
+    with one seek. A shard file is only rewritten if its content changed.
+
+    Returns:
+        dict[str, str]: {shard name: md5 of the shard fasta}
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    bgzf_p, index_p = index_paths(index_dir, strain)
+    index_df = read_fasta_index(index_p)
+    shards = {}
+    for k, name in enumerate(shard_names(len(index_df), shard_size)):
+        i = k * shard_size
+        content = read_records(bgzf_p, index_df, i, i + shard_size)
+        shards[name] = write_if_changed(shard_dir / f"{name}.fasta", content)
+    return shards
+
+
+def split_queries(
+    strains: list[str],
+    shard_dir: Path,
+    shard_size: int = JACKHMMER_SHARD_SIZE,
+    index_dir: Path = PROTEOME_INDEX_DIR,
+    members_p: Path = QUERY_MEMBERS_FILE,
+) -> dict[str, str]:
+    """
+    Query shards for the proteomes of all reference strains.
+    With one reference its proteome is split as is (split_ref_proteome).
+    With several, identical sequences are searched once, named
+    strain|protein after the first reference having it.
+    members_p lists query, strain, protein of every reference protein.
+
+    Returns:
+        dict[str, str]: {shard name: md5 of the shard fasta}
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    members = ["query\tstrain\tprotein\n"]
+    if len(strains) == 1:
+        _, index_p = index_paths(index_dir, strains[0])
+        for protein in read_fasta_index(index_p).index:
+            members.append(f"{protein}\t{strains[0]}\t{protein}\n")
+        write_if_changed(members_p, "".join(members).encode())
+        return split_ref_proteome(strains[0], shard_dir, shard_size, index_dir)
+
+    queries: dict[str, str] = {}  # {sequence: query}
+    for strain in strains:
+        bgzf_p, index_p = index_paths(index_dir, strain)
+        fasta = read_records(bgzf_p, read_fasta_index(index_p)).decode()
+        for r in SeqIO.parse(StringIO(fasta), "fasta"):
+            query = queries.setdefault(str(r.seq), f"{strain}|{r.id}")
+            members.append(f"{query}\t{strain}\t{r.id}\n")
+    write_if_changed(members_p, "".join(members).encode())
+    n_proteins = len(members) - 1
+    print(
+        f"{len(queries)} queries for {n_proteins} proteins of "
+        f"{len(strains)} reference strains."
+    )
+
+    records = [f">{query}\n{seq}\n" for seq, query in queries.items()]
+    shards = {}
+    for k, name in enumerate(shard_names(len(records), shard_size)):
+        content = "".join(records[k * shard_size : (k + 1) * shard_size])
+        shards[name] = write_if_changed(
+            shard_dir / f"{name}.fasta", content.encode()
+        )
+    return shards
+
+
+def load_manifest(shard_dir: Path) -> dict:
+    manifest_p = shard_dir / MANIFEST_NAME
+    if manifest_p.exists():
+        with manifest_p.open() as mf:
+            return json.load(mf)
+    return {}
+
+
+def save_manifest(shard_dir: Path, manifest: dict):
+    # Write then rename, a crash never leaves a broken manifest
+    tmp_p = shard_dir / f"{MANIFEST_NAME}.tmp"
+    with tmp_p.open("w") as mf:
+        json.dump(manifest, mf, indent=1)
+    tmp_p.replace(shard_dir / MANIFEST_NAME)
+
+
+def is_shard_done(
+    name: str, fasta_md5: str, manifest: dict, shard_dir: Path, params: dict
+) -> bool:
+    record = manifest.get(name)
+    return (
+        record is not None
+        and record["fasta_md5"] == fasta_md5
+        and record["params"] == params
+        and (shard_dir / f"{name}.domtblout").exists()
+    )
+
+
+class SearchJob(NamedTuple):
+    shard: str
+    name: str  # file stem of the job fasta/domtblout/log
+    queries: list[str]
+    isolated: bool = False  # run alone, with fewer threads
+    attempt: int = 0
+
+
+class JobResult(NamedTuple):
+    returncode: int
+    wall_s: float
+    peak_rss_mb: float
+
+
+def run_jackhmmer(
+    query_p: Path,
+    domtblout_p: Path,
+    cpu: int,
+    log_p: Path | None = None,
+    z: int | None = None,
+    database_p: Path = CONCATENATED_PROTEOMES_FILE,
+) -> JobResult:
+    """
+    Search one query fasta. The domtblout is written to a temporary file
+    and renamed when jackhmmer finished successfully. Peak memory is the
+    max RSS of the jackhmmer process (from wait4).
+    """
+    tmp_p = domtblout_p.parent / f"{domtblout_p.name}.tmp"
+    if log_p is None:
+        log_p = domtblout_p.parent / f"{domtblout_p.stem}.log"
+    start = time.monotonic()
+    with log_p.open("wb") as log:
+        jackhmmer_proc = Popen(
+            [
+                "jackhmmer",
+                "-E",
+                str(T_E),
+                "--incE",
+                str(T_INCE),
+                "--domE",
+                str(T_DOME),
+                "--incdomE",
+                str(T_INCDOME),
+                "--cpu",
+                str(cpu),
+                "-o",
+                "/dev/null",
+            ]
+            + (["-Z", str(z)] if z is not None else [])
+            + [
+                "--domtblout",
+                str(tmp_p),
+                str(query_p),
+                str(database_p),
+            ],
+            stdout=DEVNULL,
+            stderr=log,
+        )
+        _, status, rusage = os.wait4(jackhmmer_proc.pid, 0)
+        jackhmmer_proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_s = time.monotonic() - start
+    if jackhmmer_proc.returncode == 0:
+        tmp_p.replace(domtblout_p)
+    else:
+        tmp_p.unlink(missing_ok=True)
+    # ru_maxrss is in KB on Linux
+    return JobResult(
+        jackhmmer_proc.returncode, wall_s, rusage.ru_maxrss / 1024
+    )
+
+
+def load_query_stats(shard_dir: Path) -> dict[str, dict]:
+    """
+    {query: {"wall_s", "peak_rss_mb", "exact", "failures"}}
+    exact is True when the query was searched alone, otherwise wall_s is its
+    length share of the job time and peak_rss_mb the job peak (upper bound).
+    """
+    stats_p = shard_dir / QUERY_STATS_NAME
+    if stats_p.exists():
+        with stats_p.open() as sf:
+            return json.load(sf)
+    return {}
+
+
+def save_query_stats(shard_dir: Path, stats: dict[str, dict]):
+    tmp_p = shard_dir / f"{QUERY_STATS_NAME}.tmp"
+    with tmp_p.open("w") as sf:
+        json.dump(stats, sf, indent=1)
+    tmp_p.replace(shard_dir / QUERY_STATS_NAME)
+
+
+def record_job_stats(
+    stats: dict[str, dict], job: SearchJob, result: JobResult, lengths: dict
+):
+    total_len = sum(lengths[q] for q in job.queries)
+    exact = len(job.queries) == 1
+    for q in job.queries:
+        record = stats.setdefault(q, {"failures": 0, "exact": False})
+        if result.returncode != 0:
+            if exact:
+                record["failures"] += 1
+                # At least this much, it died on the way
+                record["peak_rss_mb"] = max(
+                    record.get("peak_rss_mb", 0), result.peak_rss_mb
+                )
+            continue
+        if exact:
+            # Searched alone without a failure, no longer split off first
+            record["failures"] = 0
+        elif record["exact"]:
+            continue
+        record["wall_s"] = result.wall_s * lengths[q] / total_len
+        record["peak_rss_mb"] = result.peak_rss_mb
+        record["exact"] = exact
+
+
+class MemoryScheduler:
+    """
+    Run search jobs within a memory budget.
+    A job is admitted when the expected peak memory of all running jobs
+    stays within budget_mb (at least one job always runs). Expected peak
+    memory of a job is the max recorded for its queries, or a fair share of
+    the budget for unknown ones. Jobs run heaviest first (recorded wall
+    time, then query length).
+    A failed job is split in halves and retried; a single query that fails
+    is retried alone with half the threads, and given up after
+    max_isolated_attempts.
+    shard_database, if given, returns the database a shard is searched
+    against (see PREFILTER); it is called before the shard's first job.
+    """
+
+    def __init__(
+        self,
+        shard_dir: Path,
+        lengths: dict[str, int],
+        stats: dict[str, dict],
+        z: int | None = None,
+        budget_mb: float = JACKHMMER_MEMORY_GB * 1024,
+        jobs: int = JACKHMMER_JOBS,
+        ncpu: int = NCPU,
+        max_isolated_attempts: int = 2,
+        shard_database: Callable[[str], Path] | None = None,
+    ):
+        self.shard_dir = shard_dir
+        self.lengths = lengths
+        self.stats = stats
+        self.z = z
+        self.budget_mb = budget_mb
+        self.jobs = jobs
+        self.cpu = max(1, ncpu // jobs)
+        self.max_isolated_attempts = max_isolated_attempts
+        self.shard_database = shard_database
+        self.databases: dict[str, Path] = {}
+        self.queue: list[SearchJob] = []
+        self.n_parts: dict[str, int] = {}
+
+    def expected_mb(self, job: SearchJob) -> float:
+        known = [
+            self.stats[q]["peak_rss_mb"]
+            for q in job.queries
+            if "peak_rss_mb" in self.stats.get(q, {})
+        ]
+        unknown = len(known) < len(job.queries)
+        fair_share = self.budget_mb / self.jobs
+        return max(known + ([fair_share] if unknown else []))
+
+    def expected_cost(self, job: SearchJob) -> tuple[float, int]:
+        return (
+            sum(self.stats.get(q, {}).get("wall_s", 0.0) for q in job.queries),
+            sum(self.lengths[q] for q in job.queries),
+        )
+
+    def add(self, job: SearchJob):
+        self.queue.append(job)
+        self.queue.sort(key=self.expected_cost, reverse=True)
+
+    def new_part(
+        self, job: SearchJob, queries: list[str], isolated: bool, attempt: int
+    ) -> SearchJob:
+        """Write the fasta of a retry part of a job."""
+        k = self.n_parts.get(job.shard, 0)
+        self.n_parts[job.shard] = k + 1
+        name = f"{job.shard}.part{k:03d}"
+        records = {
+            r.id: r
+            for r in SeqIO.parse(
+                self.shard_dir / f"{job.shard}.fasta", "fasta"
+            )
+        }
+        SeqIO.write(
+            [records[q] for q in queries],
+            self.shard_dir / f"{name}.fasta",
+            "fasta",
+        )
+        return SearchJob(job.shard, name, queries, isolated, attempt)
+
+    def retry(self, job: SearchJob):
+        if len(job.queries) > 1:
+            half = len(job.queries) // 2
+            for queries in (job.queries[:half], job.queries[half:]):
+                self.add(self.new_part(job, queries, False, 0))
+        elif not job.isolated or job.attempt + 1 < self.max_isolated_attempts:
+            self.add(
+                self.new_part(
+                    job,
+                    job.queries,
+                    True,
+                    job.attempt + 1 if job.isolated else 0,
+                )
+            )
+        else:
+            return False
+        return True
+
+    def next_admissible(self, running: dict) -> SearchJob | None:
+        if any(job.isolated for job in running.values()):
+            return None
+        if len(running) >= self.jobs:
+            return None
+        used_mb = sum(self.expected_mb(job) for job in running.values())
+        for i, job in enumerate(self.queue):
+            if job.isolated:
+                if not running:
+                    return self.queue.pop(i)
+                # Drain the running jobs first
+                return None
+            if (
+                not running
+                or used_mb + self.expected_mb(job) <= self.budget_mb
+            ):
+                return self.queue.pop(i)
+        return None
+
+    def run(
+        self, on_shard_done: Callable[[str, list[str]], None] | None = None
+    ) -> tuple[dict[str, list[str]], set[str]]:
+        """
+        Args:
+            on_shard_done: called with the shard and its finished job names
+                as soon as the last job of a shard succeeded
+
+        Returns:
+            tuple[dict[str, list[str]], set[str]]: job names finished per
+                shard, and shards given up
+        """
+        finished: dict[str, list[str]] = {}
+        given_up: set[str] = set()
+        running: dict = {}  # {future: job}
+        with ThreadPoolExecutor(self.jobs) as executer:
+            while self.queue or running:
+                while (job := self.next_admissible(running)) is not None:
+                    if job.shard in given_up:
+                        continue
+                    cpu = max(1, self.cpu // 2) if job.isolated else self.cpu
+                    if job.shard not in self.databases:
+                        self.databases[job.shard] = (
+                            self.shard_database(job.shard)
+                            if self.shard_database is not None
+                            else CONCATENATED_PROTEOMES_FILE
+                        )
+                    future = executer.submit(
+                        run_jackhmmer,
+                        self.shard_dir / f"{job.name}.fasta",
+                        self.shard_dir / f"{job.name}.domtblout",
+                        cpu,
+                        z=self.z,
+                        database_p=self.databases[job.shard],
+                    )
+                    running[future] = job
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    result = future.result()
+                    record_job_stats(self.stats, job, result, self.lengths)
+                    save_query_stats(self.shard_dir, self.stats)
+                    if result.returncode == 0:
+                        finished.setdefault(job.shard, []).append(job.name)
+                        is_pending = any(
+                            j.shard == job.shard
+                            for j in [*self.queue, *running.values()]
+                        )
+                        if on_shard_done is not None and not is_pending:
+                            on_shard_done(job.shard, finished[job.shard])
+                        continue
+                    print(
+                        f"Job {job.name} ({len(job.queries)} queries) failed "
+                        f"after {result.wall_s:.0f} s, "
+                        f"peak {result.peak_rss_mb:.0f} MB."
+                    )
+                    if not self.retry(job):
+                        print(f"Giving up on {job.queries[0]} in {job.shard}.")
+                        given_up.add(job.shard)
+        return finished, given_up
+
+
+def run_shards(
+    shards: dict[str, str],
+    shard_dir: Path = JACKHMMER_SHARD_DIR,
+    jobs: int = JACKHMMER_JOBS,
+    ncpu: int = NCPU,
+    budget_mb: float = JACKHMMER_MEMORY_GB * 1024,
+) -> list[str]:
+    """
+    Run all shards that are not done yet with the MemoryScheduler.
+    Queries that failed alone before are isolated from the start.
+    A shard that needed retries gets the domtblouts of its parts
+    concatenated as its own.
+
+    Returns:
+        list[str]: names of the shards that failed
+    """
+    params = jackhmmer_params()
+    manifest = load_manifest(shard_dir)
+    stats = load_query_stats(shard_dir)
+    todo = [
+        name
+        for name, fasta_md5 in shards.items()
+        if not is_shard_done(name, fasta_md5, manifest, shard_dir, params)
+    ]
+    print(f"{len(shards) - len(todo)} of {len(shards)} shards already done.")
+
+    shard_database = None
+    if PREFILTER and todo:
+        index = kmer_index()
+        if PREFILTER_RECALL_SAMPLE > 0:
+            check_prefilter_recall(
+                list(shards), shard_dir, index, params, ncpu
+            )
+        shard_database = partial(
+            write_shard_database, index, shard_dir=shard_dir
+        )
+
+    lengths = {}
+    scheduler = MemoryScheduler(
+        shard_dir,
+        lengths,
+        stats,
+        params["Z"],
+        budget_mb,
+        jobs,
+        ncpu,
+        shard_database=shard_database,
+    )
+    for name in todo:
+        # Retry parts left from an earlier run
+        for part_p in shard_dir.glob(f"{name}.part*"):
+            part_p.unlink()
+        queries = []
+        for r in SeqIO.parse(shard_dir / f"{name}.fasta", "fasta"):
+            lengths[r.id] = len(r)
+            queries.append(r.id)
+        job = SearchJob(name, name, queries)
+        known_bad = [q for q in queries if stats.get(q, {}).get("failures", 0)]
+        if known_bad:
+            rest = [q for q in queries if q not in known_bad]
+            if rest:
+                scheduler.add(scheduler.new_part(job, rest, False, 0))
+            for q in known_bad:
+                scheduler.add(scheduler.new_part(job, [q], True, 0))
+        else:
+            scheduler.add(job)
+
+    def finish_shard(name: str, parts: list[str]):
+        # Recorded right away, so that a crash later keeps finished shards
+        # and a follower (step_2_live.py) sees them
+        if parts != [name]:
+            merge_domtblouts(parts, shard_dir, shard_dir / f"{name}.domtblout")
+        for part in parts:
+            if part != name:
+                for suffix in (".fasta", ".domtblout", ".log"):
+                    (shard_dir / f"{part}{suffix}").unlink(missing_ok=True)
+        (shard_dir / f"{name}.db.fasta").unlink(missing_ok=True)
+        manifest[name] = {"fasta_md5": shards[name], "params": params}
+        save_manifest(shard_dir, manifest)
+        print(f"Shard {name} done.")
+
+    _, given_up = scheduler.run(on_shard_done=finish_shard)
+    return sorted(given_up)
+
+
+def write_shard_database(index: KmerIndex, name: str, shard_dir: Path) -> Path:
+    """Candidate targets of the queries of a shard, as {shard}.db.fasta."""
+    _, sequences = read_queries(shard_dir / f"{name}.fasta")
+    targets = select_candidates(index, sequences)
+    database_p = shard_dir / f"{name}.db.fasta"
+    write_database(index, targets, database_p)
+    print(
+        f"Shard {name}: {len(targets)} of {len(index.lengths)} targets "
+        "after prefilter."
+    )
+    return database_p
+
+
+def check_prefilter_recall(
+    shards: list[str],
+    shard_dir: Path,
+    index: KmerIndex,
+    params: dict,
+    ncpu: int = NCPU,
+    n_sample: int = PREFILTER_RECALL_SAMPLE,
+):
+    """
+    Search a random sample of the queries against the full and the
+    prefiltered database. Recall is the share of the full search hits that
+    pass the first filter of step 2 (GATHER_T_E, LEN_DIFF) and are found by
+    the prefiltered search as well. Written to prefilter_recall.json, and
+    only checked again when params (database, prefilter settings) changed.
+    """
+    report_p = shard_dir / "prefilter_recall.json"
+    if report_p.exists():
+        with report_p.open() as rf:
+            if json.load(rf)["params"] == params:
+                return
+    names, sequences = [], []
+    for name in shards:
+        shard_names, shard_sequences = read_queries(
+            shard_dir / f"{name}.fasta"
+        )
+        names += shard_names
+        sequences += shard_sequences
+    rng = np.random.default_rng(0)
+    sample = np.sort(
+        rng.choice(len(names), min(n_sample, len(names)), replace=False)
+    )
+    sample_p = shard_dir / "prefilter_sample.fasta"
+    sample_p.write_text(
+        "".join(f">{names[i]}\n{sequences[i].decode()}\n" for i in sample)
+    )
+    targets = select_candidates(index, [sequences[i] for i in sample])
+    database_p = shard_dir / "prefilter_sample.db.fasta"
+    write_database(index, targets, database_p)
+
+    print(f"Checking prefilter recall on {len(sample)} queries.")
+    results = {}
+    for search, search_db_p in (
+        ("full", CONCATENATED_PROTEOMES_FILE),
+        ("prefiltered", database_p),
+    ):
+        results[search] = run_jackhmmer(
+            sample_p,
+            shard_dir / f"prefilter_sample_{search}.domtblout",
+            ncpu,
+            z=params["Z"],
+            database_p=search_db_p,
+        )
+    database_p.unlink()
+    if any(result.returncode != 0 for result in results.values()):
+        print(
+            "Prefilter recall check failed, see "
+            f"{shard_dir}/prefilter_sample_*.log."
+        )
+        return
+    hits = read_hit_pairs(shard_dir / "prefilter_sample_full.domtblout")
+    found = hits & read_hit_pairs(
+        shard_dir / "prefilter_sample_prefiltered.domtblout"
+    )
+    report = {
+        "params": params,
+        "queries": len(sample),
+        "targets": len(targets),
+        "database_share": len(targets) / len(index.lengths),
+        "hits": len(hits),
+        "found": len(found),
+        "recall": len(found) / len(hits) if hits else 1.0,
+        "full_s": results["full"].wall_s,
+        "prefiltered_s": results["prefiltered"].wall_s,
+    }
+    with report_p.open("w") as rf:
+        json.dump(report, rf, indent=1)
+    print(
+        f"Prefilter recall {report['recall']:.4f} ({len(found)} of "
+        f"{len(hits)} hits), {report['database_share']:.1%} of the database, "
+        f"search {report['full_s']:.0f} s -> "
+        f"{report['prefiltered_s']:.0f} s."
+    )
+
+
+def merge_domtblouts(
+    shard_names: list[str], shard_dir: Path, domtblout_p: Path = DOMTBLOUT_FILE
+):
+    print(f"Merging {len(shard_names)} shards into {domtblout_p}")
+    tmp_p = domtblout_p.parent / f"{domtblout_p.name}.tmp"
+    with tmp_p.open("wb") as merged:
+        for name in sorted(shard_names):
+            with (shard_dir / f"{name}.domtblout").open("rb") as shard:
+                while chunk := shard.read(1024**2):
+                    merged.write(chunk)
+    tmp_p.replace(domtblout_p)
+
+
+def main() -> bool:
+    shards = split_queries(REFERENCE_STRAINS, JACKHMMER_SHARD_DIR)
+    failed = run_shards(shards)
+    if failed:
+        print(
+            f"{len(failed)} shards failed: {', '.join(sorted(failed))}. "
+            "Run again to retry them."
+        )
+        return False
+    merge_domtblouts(list(shards), JACKHMMER_SHARD_DIR)
+    return True
 
-REF_NEXT_LOC = 0
-# Used if the program died in the middle. Use `get_location.py`
-# to get where the program lefted out.
 
 if __name__ == "__main__":
-    with STRAINS_PICKLE_FILE.open("rb") as sp:
-        phenotype_strains, all_strains = pickle.load(sp)
-
-    for st in all_strains:
-        if st == TARGET_STRAIN:
-            ref_proteome_p = all_strains[st]
-            break
-    for phenotype, strains in phenotype_strains.items():
-        for st in strains.items():
-            pass
-
-    with gzip.open(ref_proteome_p, "rt") as ref:
-        ref.seek(REF_NEXT_LOC)
-        jackhmmer_run = run(
-            (
-                f"jackhmmer -E {str(T_E)} --incE {str(T_INCE)} "
-                f"--domE {str(T_DOME)}  --incdomE {str(T_INCDOME)} "
-                f"--cpu {str(NCPU)} --domtblout {DOMTBLOUT_FILE} "
-                f"- {CONCATENATED_PROTEOMES_FILE} 1>/dev/null"
-            ),
-            input=ref.read().encode(),
-            shell=True,
-            capture_output=True,
-        )
-
-    if jackhmmer_run.returncode != 0:
-        print(jackhmmer_run.stderr.decode())
+    if not main():
+        exit(1)
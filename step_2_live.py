@@ -0,0 +1,282 @@
+# Step 2 and 3 while step 1 is still searching.
+# All hits of a query are in the domtblout of its shard, and duplicate lines
+# and coverage are per (query, target) pair, so every finished shard can be
+# parsed and matched on its own with the same result as step 2 on its rows
+# of DOMTBLOUT_FILE. This script follows the shard manifest of step 1 and,
+# for each shard done:
+#   1. writes its domain hit and match tables (column stores) to
+#      LIVE_GATHER_DIR,
+#   2. adds the presence rows of its queries,
+#   3. rewrites the correlation tables (named as in step 3) in
+#      LIVE_GATHER_DIR for all genes searched so far. The correlation of a
+#      gene does not depend on the other genes, so these rows are already
+#      final; status.json tells how far it is.
+# When all shards are done and step 1 has merged them into DOMTBLOUT_FILE
+# (the input that keys the step 2 cache entry), the shard tables are joined
+# into GATHER_DOMTBL_STORE and GATHER_MATCH_STORE (kept in the artifact cache
+# as the output of step 2) and step 3 runs.
+# Start it next to step_1_jackhmmer.py, or run `python pipeline.py live`.
+
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+import step_3_calculate_correlation
+from artifact_cache import run_cached
+from column_store import read_table, write_table
+from load_configs import (
+    DEDUP_PROTEOMES,
+    DOMTBLOUT_FILE,
+    GATHER_DOMTBL_STORE,
+    GATHER_DOMTBL_TSV,
+    GATHER_MATCH_STORE,
+    GATHER_MATCH_TSV,
+    JACKHMMER_SHARD_DIR,
+    LIVE_GATHER_DIR,
+    QUANTITATIVE_ASSOCIATION,
+    REFERENCE_STRAINS,
+)
+from step_1_jackhmmer import (
+    is_shard_done,
+    jackhmmer_params,
+    load_manifest,
+    save_manifest,
+    shard_names,
+)
+from step_2_parse_domtbl import (
+    LineHashes,
+    gather_stage,
+    gen_match_table,
+    parse_domtbl_chunk,
+    read_dedup_members,
+    write_gather_table,
+)
+from step_3_calculate_correlation import (
+    cal_correlations,
+    expand_to_reference,
+    gen_phenotype_table,
+    load_experimental_data,
+    presence_from_matches,
+    reference_paths,
+)
+
+
+def shard_queries(shard_p: Path) -> list[str]:
+    with shard_p.open() as sf:
+        return [l[1:].split()[0] for l in sf if l.startswith(">")]
+
+
+def gather_shard(
+    name: str,
+    shard_dir: Path,
+    live_dir: Path,
+    members: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """Step 2 on one shard."""
+    lines = (shard_dir / f"{name}.domtblout").read_text().splitlines()
+    domtbl_df = parse_domtbl_chunk(lines, LineHashes())
+    match_df = gen_match_table(domtbl_df, members=members)
+    assert (
+        match_df.duplicated(
+            subset=["Query", "Target strain", "Target protein"]
+        ).sum()
+        == 0
+    )
+    write_table(domtbl_df, live_dir / f"{name}.domtbl.cols")
+    write_table(match_df, live_dir / f"{name}.matches.cols")
+    return match_df
+
+
+def join_shard_tables(
+    names: list[str], suffix: str, store_p: Path, tsv_p: Path, live_dir: Path
+):
+    """Concatenate shard tables into one table, the same as step 2 writes."""
+    # Categorical columns with different categories become object columns
+    tables = [read_table(live_dir / f"{name}{suffix}") for name in names]
+    write_gather_table(pd.concat(tables, ignore_index=True), store_p, tsv_p)
+
+
+def write_interim(
+    presence_parts: dict[str, pd.DataFrame],
+    query_members: pd.DataFrame,
+    phenotype_df: pd.DataFrame,
+    n_shards: int,
+    live_dir: Path,
+):
+    query_presence = pd.concat(presence_parts.values())
+    searched = query_members[query_members["query"].isin(query_presence.index)]
+    for strain in REFERENCE_STRAINS:
+        presence_df = expand_to_reference(query_presence, searched, strain)
+        _, _, corr_prefix = reference_paths(strain)
+        for phenotype, corr_df in cal_correlations(
+            phenotype_df, presence_df
+        ).items():
+            # Write then rename, readers never see a half written table
+            corr_p = live_dir / f"{corr_prefix}{phenotype}.tsv"
+            tmp_p = live_dir / f"{corr_prefix}{phenotype}.tsv.tmp"
+            corr_df.to_csv(tmp_p, sep="\t")
+            tmp_p.replace(corr_p)
+    with (live_dir / "status.json").open("w") as sf:
+        json.dump(
+            {
+                "shards_done": len(presence_parts),
+                "shards_total": n_shards,
+                "queries_searched": len(query_presence),
+                "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            },
+            sf,
+            indent=1,
+        )
+    print(
+        f"Live: {len(presence_parts)} of {n_shards} shards, "
+        f"{len(query_presence)} queries, correlations in {live_dir}"
+    )
+
+
+def is_merged(
+    names: list[str], shard_dir: Path, merged_p: Path = DOMTBLOUT_FILE
+) -> bool:
+    """
+    Step 1 merged the current shard outputs: merged_p is as large as all of
+    them together and not older than any of them.
+    """
+    if not merged_p.exists():
+        return False
+    shard_stats = [(shard_dir / f"{n}.domtblout").stat() for n in names]
+    merged = merged_p.stat()
+    size = sum(st.st_size for st in shard_stats)
+    mtime_ns = max((st.st_mtime_ns for st in shard_stats), default=0)
+    return merged.st_size == size and merged.st_mtime_ns >= mtime_ns
+
+
+def follow(
+    search_finished: Callable[[], bool] | None = None,
+    poll_s: float = 30,
+    shard_dir: Path = JACKHMMER_SHARD_DIR,
+    live_dir: Path = LIVE_GATHER_DIR,
+) -> bool:
+    """
+    Process shards as step 1 finishes them until all are done with the
+    current search parameters, or search_finished(), then wait for step 1
+    to merge them and write the step 2 and 3 outputs. A shard is only
+    checked again when its manifest entry changed.
+
+    Returns:
+        bool: False if the search finished with shards missing or without
+            merging them
+    """
+    query_members, phenotype_strains, all_strains = load_experimental_data()
+    strains = list(all_strains.keys())
+    phenotype_df = gen_phenotype_table(phenotype_strains, strains)
+    members = read_dedup_members() if DEDUP_PROTEOMES else None
+    names = shard_names(query_members["query"].nunique())
+    params = jackhmmer_params()
+
+    live_dir.mkdir(parents=True, exist_ok=True)
+    live_manifest = load_manifest(live_dir)
+    presence_parts: dict[str, pd.DataFrame] = {}
+    checked: dict[str, dict] = {}  # step 1 manifest entries seen
+    while True:
+        # Checked before the scan, shards finished before it are seen
+        is_finished = search_finished is not None and search_finished()
+        manifest = load_manifest(shard_dir)
+        new = []
+        for name in names:
+            shard_p = shard_dir / f"{name}.fasta"
+            if (
+                name in presence_parts
+                or name not in manifest
+                or checked.get(name) == manifest[name]
+                or not shard_p.exists()
+            ):
+                continue
+            checked[name] = manifest[name]
+            fasta_md5 = hashlib.md5(shard_p.read_bytes()).hexdigest()
+            if not is_shard_done(name, fasta_md5, manifest, shard_dir, params):
+                continue
+            record = {
+                "fasta_md5": fasta_md5,
+                "params": params,
+                "DEDUP_PROTEOMES": DEDUP_PROTEOMES,
+            }
+            if live_manifest.get(name) == record:
+                # Done by an earlier run
+                match_df = read_table(
+                    live_dir / f"{name}.matches.cols",
+                    ["Query", "Target strain"],
+                )
+            else:
+                match_df = gather_shard(name, shard_dir, live_dir, members)
+                live_manifest[name] = record
+                save_manifest(live_dir, live_manifest)
+            presence_parts[name] = presence_from_matches(
+                match_df,
+                shard_queries(shard_p),
+                strains,
+                count_hits=QUANTITATIVE_ASSOCIATION,
+            )
+            new.append(name)
+        if new:
+            write_interim(
+                presence_parts,
+                query_members,
+                phenotype_df,
+                len(names),
+                live_dir,
+            )
+        if is_finished or len(presence_parts) == len(names):
+            break
+        time.sleep(poll_s)
+
+    missing = [name for name in names if name not in presence_parts]
+    if missing:
+        print(
+            f"Search finished without {len(missing)} shards: "
+            f"{', '.join(missing)}."
+        )
+        return False
+
+    # The step 2 cache entry is keyed by DOMTBLOUT_FILE, joined before the
+    # merge it could restore the tables of an earlier search
+    if not is_merged(names, shard_dir):
+        print(f"Waiting for step 1 to merge the shards into {DOMTBLOUT_FILE}")
+    while not is_merged(names, shard_dir):
+        if (
+            search_finished is not None
+            and search_finished()
+            and not is_merged(names, shard_dir)
+        ):
+            print(f"Search finished without merging into {DOMTBLOUT_FILE}.")
+            return False
+        time.sleep(min(poll_s, 5))
+
+    def join_tables():
+        print(f"Write re-formated domain hit table {GATHER_DOMTBL_STORE}")
+        join_shard_tables(
+            names,
+            ".domtbl.cols",
+            GATHER_DOMTBL_STORE,
+            GATHER_DOMTBL_TSV,
+            live_dir,
+        )
+        print(f"Write match table {GATHER_MATCH_STORE}")
+        join_shard_tables(
+            names,
+            ".matches.cols",
+            GATHER_MATCH_STORE,
+            GATHER_MATCH_TSV,
+            live_dir,
+        )
+
+    run_cached(gather_stage(), join_tables)
+    step_3_calculate_correlation.main()
+    return True
+
+
+if __name__ == "__main__":
+    if not follow():
+        exit(1)
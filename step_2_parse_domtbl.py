@@ -10,19 +10,28 @@
 # hmmer search of single protein does not consider domain founction, it could
 # be a good way of taking ** gapped domain hits ** into consideration.
 
-import re
-from collections import OrderedDict, namedtuple
+import json
+import multiprocessing
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from subprocess import run
+from tempfile import TemporaryDirectory
 from threading import Thread
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from tqdm import tqdm
 
+from artifact_cache import Stage, run_cached
+from column_store import read_table, write_table
 from load_configs import (
+    DEDUP_MEMBERS_FILE,
+    DEDUP_PROTEOMES,
     DOMTBLOUT_FILE,
+    EXPORT_TSV,
+    GATHER_DOMTBL_STORE,
     GATHER_DOMTBL_TSV,
+    GATHER_MATCH_STORE,
     GATHER_MATCH_TSV,
     GATHER_T_COV,
     GATHER_T_DOME,
@@ -32,202 +41,513 @@ from load_configs import (
 )
 
 
-def cal_cov(line: dict, dom_cov_regions: list[int]):
+def merged_interval_length(
+    group: np.ndarray, starts: np.ndarray, ends: np.ndarray, n_groups: int
+) -> np.ndarray:
     """
-    Run within each single protein lines
+    Number of positions covered by the union of closed intervals
+    [start, end] in each group, for all groups at once.
+    Intervals are sorted by (group, start); each one adds the part of it
+    right of the running max end of the earlier intervals in its group.
+    O(k log k) for k intervals, no expansion into positions.
+
+    Args:
+        group (np.ndarray): group code (0 ... n_groups - 1) of each interval
+        starts (np.ndarray): 1-based start positions
+        ends (np.ndarray): 1-based end positions, inclusive
+
+    Returns:
+        np.ndarray: covered length of each group (0 for groups without
+            intervals)
+    """
+    if len(group) == 0:
+        return np.zeros(n_groups, dtype=np.int64)
+    order = np.lexsort((starts, group))
+    group = np.asarray(group, dtype=np.int64)[order]
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    ends = np.asarray(ends, dtype=np.int64)[order]
+    # Offset every group above the previous one so that one cumulative
+    # max does not carry over from one group into the next
+    offset = group * (ends.max() + 1)
+    running_end = np.maximum.accumulate(ends + offset) - offset
+    prev_end = np.empty_like(running_end)
+    prev_end[0] = 0
+    prev_end[1:] = running_end[:-1]
+    prev_end[np.r_[True, group[1:] != group[:-1]]] = 0
+    added = np.maximum(0, ends - np.maximum(starts - 1, prev_end))
+    return np.bincount(group, weights=added, minlength=n_groups).astype(
+        np.int64
+    )
+
+
+def cal_cov(
+    domtbl_df: pd.DataFrame, t_dome: float = GATHER_T_DOME
+) -> pd.DataFrame:
+    """
+    Coverage of each (query, target) protein pair.
     Only the alignment of domains with E values lower than threshold
-    will be included in the coverage calculation
-    Each coverage will be converted to range of positions (int)
-    Combine all positions -> deduplicate -> count = lenth of covered region
-
-    """
-    dom_covq = dom_covt = 0
-    is_end_dom = False
-    if line["dom_total"] == 1:  # Single domain
-        is_end_dom = True
-        if line["dom_i_E"] <= GATHER_T_DOME:
-            cov_len = line["ali_to"] - line["ali_from"] + 1
-            dom_covq = cov_len / line["qlen"]
-            dom_covt = cov_len / line["tlen"]
-    else:  # multi domains
-        # if line['dom_n'] == 1:  # first multi domain
-        #     dom_cov_regions = []
-        if line["dom_i_E"] <= GATHER_T_DOME:
-            dom_cov_regions.extend(
-                list(range(line["ali_from"], line["ali_to"] + 1))
+    will be included in the coverage calculation. The aligned regions are
+    merged (overlap removed), length of the union = lenth of covered region.
+    Rows of a pair do not need to be consecutive or complete.
+
+    Returns:
+        pd.DataFrame: one row per pair, in order of first appearance, with
+            the first domain row of the pair plus cov_len, cov_q, cov_t
+    """
+    group = (
+        domtbl_df.groupby(["qp", "tp"], sort=False, observed=True)
+        .ngroup()
+        .to_numpy()
+    )
+    n_groups = int(group.max()) + 1 if len(group) else 0
+    is_dom_pass = (domtbl_df["dom_i_E"] <= t_dome).to_numpy()
+    cov_len = merged_interval_length(
+        group[is_dom_pass],
+        domtbl_df["ali_from"].to_numpy()[is_dom_pass],
+        domtbl_df["ali_to"].to_numpy()[is_dom_pass],
+        n_groups,
+    )
+    _, first_row = np.unique(group, return_index=True)
+    cov_df = domtbl_df.iloc[first_row].reset_index(drop=True)
+    cov_df["cov_len"] = cov_len
+    cov_df["cov_q"] = cov_len / cov_df["qlen"].to_numpy()
+    cov_df["cov_t"] = cov_len / cov_df["tlen"].to_numpy()
+    return cov_df
+
+
+DOMTBL_COLUMNS = {
+    # name: (column in domtblout, dtype)
+    "tp": (0, "category"),
+    "qp": (3, "category"),
+    "tlen": (2, "int32"),
+    "qlen": (5, "int32"),
+    "ali_from": (17, "int32"),
+    "ali_to": (18, "int32"),
+    "dom_i_E": (12, "float64"),
+    "dom_n": (9, "int32"),
+    "dom_total": (10, "int32"),
+    "full_E": (6, "float64"),
+    "anno": (22, "category"),
+}
+CHUNK_BYTES = 64 * 1024**2
+
+
+class LineHashes:
+    """
+    Set of 64 bit line hashes kept in sorted numpy arrays (8 bytes per
+    line instead of the line itself). New arrays are merged into the
+    largest one once there are too many of them.
+    """
+
+    def __init__(self, max_runs: int = 8):
+        self.runs: list[np.ndarray] = []
+        self.max_runs = max_runs
+
+    def add_new(self, hashes: np.ndarray) -> np.ndarray:
+        """Add hashes, return a mask of those not seen before."""
+        is_new = ~pd.Index(hashes).duplicated()
+        for run_hashes in self.runs:
+            pos = np.searchsorted(run_hashes, hashes).clip(
+                max=len(run_hashes) - 1
             )
-        if line["dom_n"] == line["dom_total"]:  # end of all domains
-            is_end_dom = True
-            cov_len = len(set(dom_cov_regions))
-            dom_covq = cov_len / line["qlen"]
-            dom_covt = cov_len / line["tlen"]
-    return is_end_dom, dom_cov_regions, dom_covq, dom_covt
-
-
-def remove_duplicates(file_p: Path) -> Path:
-    no_dup_path = file_p.parent / f"{file_p.stem}_nodup{file_p.suffix}"
-    print(f"Removing duplicates from file {file_p} -> {no_dup_path}")
-    ddup = run(f"awk '!seen[$0]++' {file_p} > {no_dup_path}", shell=True)
-    ddup.check_returncode()
-    return no_dup_path
-
-
-def read_domtbl(domtbl_p: Path) -> pd.DataFrame:
-    def parse_one_line(
-        l,
-        domtbl_dict,
-        t_e=GATHER_T_E,
-        len_diff=LEN_DIFF,
-        splitter=re.compile(r" +"),
-    ):
-        line_list = splitter.split(l.strip())
-
-        full_E = float(line_list[6])
-        if full_E > t_e:
-            return
+            is_new &= run_hashes[pos] != hashes
+        if is_new.any():
+            self.runs.append(np.sort(hashes[is_new]))
+        if len(self.runs) > self.max_runs:
+            self.runs = [np.sort(np.concatenate(self.runs))]
+        return is_new
+
+
+def parse_domtbl_chunk(
+    lines: list[str],
+    seen: LineHashes,
+    t_e: float = GATHER_T_E,
+    len_diff: float = LEN_DIFF,
+) -> pd.DataFrame:
+    """
+    Parse lines of a domtblout into typed columns. Lines with full sequence
+    E-value above t_e or length difference above len_diff are dropped
+    before anything else is converted, and exact duplicate lines (also of
+    previous chunks, recorded in seen) are dropped.
+    """
+    lines = [l for l in lines if l and not l.startswith("#")]
+    fields = pd.DataFrame([l.split(None, 22) for l in lines])
+    if fields.empty:
+        return empty_domtbl()
+    full_E = fields[6].astype("float64").to_numpy()
+    tlen = fields[2].astype("int64").to_numpy()
+    qlen = fields[5].astype("int64").to_numpy()
+    keep = (full_E <= t_e) & (
+        np.abs(tlen - qlen) / np.minimum(tlen, qlen) <= len_diff
+    )
+    keep_idx = np.flatnonzero(keep)
+    hashes = pd.util.hash_array(np.array(lines, dtype=object)[keep_idx])
+    keep_idx = keep_idx[seen.add_new(hashes)]
+
+    fields = fields.iloc[keep_idx]
+    columns = {}
+    for h, (col, dtype) in DOMTBL_COLUMNS.items():
+        if h == "anno":
+            # Same as joining the split description with single spaces
+            values = (
+                fields[col].fillna("").str.replace(r"\s+", " ", regex=True)
+            )
+        else:
+            values = fields[col]
+        columns[h] = values.astype(dtype).array
+    return pd.DataFrame(columns)
+
+
+def empty_domtbl() -> pd.DataFrame:
+    return pd.DataFrame(
+        {h: pd.Series(dtype=dtype) for h, (_, dtype) in DOMTBL_COLUMNS.items()}
+    )
+
+
+def concat_domtbl_chunks(chunks: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate chunks keeping categorical columns categorical."""
+    chunks = [c for c in chunks if not c.empty]
+    if not chunks:
+        return empty_domtbl()
+    columns = {}
+    for h, (_, dtype) in DOMTBL_COLUMNS.items():
+        if dtype == "category":
+            columns[h] = union_categoricals([c[h] for c in chunks])
         else:
-            tlen = int(line_list[2])
-            qlen = int(line_list[5])
-            if abs(tlen - qlen) / min(tlen, qlen) > len_diff:
-                return
-            try:
-                domtbl_dict["tp"].append(line_list[0])
-                domtbl_dict["qp"].append(line_list[3])
-                domtbl_dict["tlen"].append(tlen)
-                domtbl_dict["qlen"].append(qlen)
-                domtbl_dict["ali_from"].append(int(line_list[17]))
-                domtbl_dict["ali_to"].append(int(line_list[18]))
-                domtbl_dict["dom_i_E"].append(float(line_list[12]))
-                domtbl_dict["dom_n"].append(int(line_list[9]))
-                domtbl_dict["dom_total"].append(int(line_list[10]))
-                domtbl_dict["full_E"].append(full_E)
-                domtbl_dict["anno"].append(" ".join(line_list[22:]))
-            except ValueError as ve:
-                print(l)
-                raise ve
-
-    print(f"Counting lines in domtblout from jackhmmer: {domtbl_p}")
-    domtbl_len = int(
-        run(["wc", "-l", domtbl_p], capture_output=True)
-        .stdout.decode()
-        .split(" ")[0]
-    )
-    print(f"{domtbl_len} lines in total.")
-    domtbl_dict = {}
-    header = [
-        "tp",
-        "qp",
-        "tlen",
-        "qlen",
-        "ali_from",
-        "ali_to",
-        "dom_i_E",
-        "dom_n",
-        "dom_total",
-        "full_E",
-        "anno",
-    ]
-    for h in header:
-        domtbl_dict[h] = []
-    with domtbl_p.open("rt") as dt:
-        for l in tqdm(dt, desc="Reading file", total=domtbl_len):
-            if l.startswith("#"):
-                continue
-            parse_one_line(l, domtbl_dict)
-    print("Converting data to dataframe...", end="")
-    domtbl_df = pd.DataFrame(domtbl_dict)
-    print("Done.")
+            columns[h] = np.concatenate([c[h].to_numpy() for c in chunks])
+    return pd.DataFrame(columns)
+
+
+def iter_domtbl_chunks(
+    domtbl_p: Path,
+    t_e: float = GATHER_T_E,
+    len_diff: float = LEN_DIFF,
+    chunk_bytes: int = CHUNK_BYTES,
+):
+    """
+    Read the domtblout in one pass, chunk_bytes at a time (cut at line
+    ends), yielding filtered, deduplicated, typed DataFrames.
+    """
+    seen = LineHashes()
+    with domtbl_p.open("rb") as dt, tqdm(
+        total=domtbl_p.stat().st_size,
+        desc="Reading file",
+        unit="B",
+        unit_scale=True,
+    ) as pbar:
+        rest = b""
+        while True:
+            data = dt.read(chunk_bytes)
+            pbar.update(len(data))
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            data, rest = data[:cut], data[cut:]
+            yield parse_domtbl_chunk(
+                data.decode().splitlines(), seen, t_e=t_e, len_diff=len_diff
+            )
+        if rest:
+            yield parse_domtbl_chunk(
+                rest.decode().splitlines(), seen, t_e=t_e, len_diff=len_diff
+            )
+
+
+def read_domtbl(
+    domtbl_p: Path, t_e: float = GATHER_T_E, len_diff: float = LEN_DIFF
+) -> pd.DataFrame:
+    print(f"Reading domtblout from jackhmmer: {domtbl_p}")
+    chunks = list(iter_domtbl_chunks(domtbl_p, t_e=t_e, len_diff=len_diff))
+    domtbl_df = concat_domtbl_chunks(chunks)
+    print(f"{domtbl_df.shape[0]} domain hits after filtering.")
     return domtbl_df
 
 
-def process_single_query(domtbl_q: list[OrderedDict]):
-    qp = domtbl_q[0]["qp"]
-    dom_cov_regions = []
-    match_dict = {
-        "Query": [],
-        "Target strain": [],
-        "Target protein": [],
-        "Coverage on Query": [],
-        "Coverage on Target": [],
-        "Expect protein": [],
-        "Target description": [],
-    }
-    for row in domtbl_q:
-        is_end_dom, dom_cov_regions, dom_covq, dom_covt = cal_cov(
-            row, dom_cov_regions
+def save_hit_store(domtbl_df: pd.DataFrame, store_dir: Path, source_p: Path):
+    """
+    Hit table as uncompressed column store (see column_store.py) in one row
+    group, so that load_hit_store memory-maps the numeric columns, with the
+    size and mtime of the source domtblout in source.json to tell when it is
+    stale.
+    """
+    write_table(
+        domtbl_df[list(DOMTBL_COLUMNS)],
+        store_dir,
+        row_group_size=max(len(domtbl_df), 1),
+        compress=False,
+    )
+    stat = source_p.stat()
+    with (store_dir / "source.json").open("w") as sf:
+        json.dump(
+            {
+                "source": str(source_p),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            },
+            sf,
         )
-        if is_end_dom:
-            if dom_covq < GATHER_T_COV or dom_covt < GATHER_T_COV:
-                continue
-            dom_cov_regions = []
-        else:
-            continue
-
-        target_strain = row["tp"].split("_")[0]
-        target_protein = row["tp"][len(target_strain) + 1 :]
-        match_dict["Query"].append(qp)
-        match_dict["Target strain"].append(target_strain)
-        match_dict["Target protein"].append(target_protein)
-        match_dict["Coverage on Query"].append(dom_covq)
-        match_dict["Coverage on Target"].append(dom_covt)
-        match_dict["Expect protein"].append(row["full_E"])
-        match_dict["Target description"].append(
-            row["anno"].replace(target_protein, "").strip()
+
+
+def is_hit_store_current(store_dir: Path, source_p: Path) -> bool:
+    source_json = store_dir / "source.json"
+    if not source_json.exists() or not (store_dir / "schema.json").exists():
+        # Stores written before the column store format have no schema
+        return False
+    with source_json.open() as sf:
+        source = json.load(sf)
+    stat = source_p.stat()
+    return source["size"] == stat.st_size and source["mtime"] == stat.st_mtime
+
+
+def load_hit_store(store_dir: Path) -> pd.DataFrame:
+    """Numeric columns are memory-mapped."""
+    return read_table(store_dir, list(DOMTBL_COLUMNS))
+
+
+def read_dedup_members(members_p: Path = DEDUP_MEMBERS_FILE) -> pd.DataFrame:
+    """seq_id, strain, protein of every protein in the deduplicated database"""
+    return pd.read_csv(members_p, sep="\t", dtype=str)
+
+
+def expand_dedup_targets(
+    cov_df: pd.DataFrame, members: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    With DEDUP_PROTEOMES the targets are unique sequences (seq_id). Replace
+    each row by one row per protein having that sequence, with tp as
+    strain_protein like in the full database. Coverage and E-values are the
+    same for all of them.
+    """
+    member_tp = pd.DataFrame(
+        {
+            "seq_id": members["seq_id"],
+            "member_tp": members["strain"] + "_" + members["protein"],
+        }
+    )
+    expanded = cov_df.assign(seq_id=cov_df["tp"].astype(str)).merge(
+        member_tp, on="seq_id", how="inner"
+    )
+    expanded["tp"] = expanded.pop("member_tp")
+    return expanded.drop(columns="seq_id")
+
+
+def format_match_table(
+    cov_df: pd.DataFrame, members: pd.DataFrame | None = None
+) -> pd.DataFrame:
+    """
+    Match table layout from rows of cal_cov output.
+    members: expand unique sequence targets, see expand_dedup_targets
+    """
+    if members is not None:
+        cov_df = expand_dedup_targets(cov_df, members)
+    # strain_protein, reindex for the empty table
+    target = (
+        cov_df["tp"].astype(str).str.partition("_").reindex(columns=[0, 1, 2])
+    )
+    target_protein = target[2].to_numpy()
+    return pd.DataFrame(
+        {
+            "Query": cov_df["qp"].astype(str).to_numpy(),
+            "Target strain": target[0].to_numpy(),
+            "Target protein": target_protein,
+            "Coverage on Query": cov_df["cov_q"].to_numpy(),
+            "Coverage on Target": cov_df["cov_t"].to_numpy(),
+            "Expect protein": cov_df["full_E"].to_numpy(),
+            "Target description": [
+                anno.replace(tp, "").strip()
+                for anno, tp in zip(cov_df["anno"].astype(str), target_protein)
+            ],
+        }
+    )
+
+
+def gen_match_table(
+    domtbl_df: pd.DataFrame,
+    t_dome: float = GATHER_T_DOME,
+    t_cov: float = GATHER_T_COV,
+    members: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Matches are (query, target) pairs with coverage on both proteins of at
+    least t_cov.
+    """
+    cov_df = cal_cov(domtbl_df, t_dome=t_dome)
+    cov_df = cov_df[(cov_df["cov_q"] >= t_cov) & (cov_df["cov_t"] >= t_cov)]
+    return format_match_table(cov_df, members)
+
+
+# Columns of the hit table, memory-mapped in each worker process
+_block_columns: dict[str, np.ndarray] = {}
+
+
+def _open_block_columns(column_dir: Path):
+    for f in column_dir.glob("*.npy"):
+        _block_columns[f.stem] = np.load(f, mmap_mode="r")
+
+
+def _match_block(
+    start: int, stop: int, n_tp: int, t_cov: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Coverage of all (query, target) pairs in rows start:stop of the query
+    sorted hit table.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: first row (in the sorted table) and
+            covered length of the pairs passing t_cov
+    """
+    c = {k: np.asarray(v[start:stop]) for k, v in _block_columns.items()}
+    pair = c["qp"].astype(np.int64) * n_tp + c["tp"]
+    _, first, group = np.unique(pair, return_index=True, return_inverse=True)
+    group = group.ravel()
+    is_dom_pass = c["dom_pass"]
+    cov_len = merged_interval_length(
+        group[is_dom_pass],
+        c["ali_from"][is_dom_pass],
+        c["ali_to"][is_dom_pass],
+        len(first),
+    )
+    is_match = (cov_len / c["qlen"][first] >= t_cov) & (
+        cov_len / c["tlen"][first] >= t_cov
+    )
+    return first[is_match] + start, cov_len[is_match]
+
+
+def parse_dom_table_mt(
+    domtbl_df: pd.DataFrame,
+    t_dome: float = GATHER_T_DOME,
+    t_cov: float = GATHER_T_COV,
+    ncpu: int = NCPU,
+    blocks_per_cpu: int = 4,
+    members: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Same result as gen_match_table, computed by ncpu processes.
+    The hit table is sorted by query and cut into large contiguous blocks
+    on query boundaries. The columns needed are written once as .npy files
+    that every worker memory-maps, so a task is only (start, stop) and a
+    result only two arrays; the match table is assembled at the end.
+    """
+    qp_codes = domtbl_df["qp"].cat.codes.to_numpy()
+    tp_codes = domtbl_df["tp"].cat.codes.to_numpy()
+    order = np.argsort(qp_codes, kind="stable")
+    qp_sorted = qp_codes[order]
+
+    # Block edges snapped to the next query start
+    query_starts = np.r_[0, np.flatnonzero(np.diff(qp_sorted)) + 1]
+    targets = np.linspace(0, len(order), ncpu * blocks_per_cpu + 1)[1:-1]
+    snap = np.searchsorted(query_starts, targets).clip(
+        max=len(query_starts) - 1
+    )
+    edges = np.unique(np.r_[0, query_starts[snap], len(order)])
+
+    n_tp = len(domtbl_df["tp"].cat.categories)
+    match_rows = []
+    match_cov_len = []
+    with TemporaryDirectory(dir=GATHER_MATCH_TSV.parent) as column_dir:
+        column_dir = Path(column_dir)
+        columns = {
+            "qp": qp_sorted,
+            "tp": tp_codes[order],
+            "ali_from": domtbl_df["ali_from"].to_numpy()[order],
+            "ali_to": domtbl_df["ali_to"].to_numpy()[order],
+            "qlen": domtbl_df["qlen"].to_numpy()[order],
+            "tlen": domtbl_df["tlen"].to_numpy()[order],
+            "dom_pass": (domtbl_df["dom_i_E"].to_numpy() <= t_dome)[order],
+        }
+        for name, values in columns.items():
+            np.save(column_dir / f"{name}.npy", values)
+        del columns
+        # forkserver, forking from the threads of pipeline.py can deadlock
+        with ProcessPoolExecutor(
+            ncpu,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_open_block_columns,
+            initargs=(column_dir,),
+        ) as executer:
+            futures = [
+                executer.submit(_match_block, start, stop, n_tp, t_cov)
+                for start, stop in zip(edges[:-1], edges[1:])
+            ]
+            for future in tqdm(futures, desc="Processing query blocks"):
+                rows, cov_len = future.result()
+                match_rows.append(order[rows])
+                match_cov_len.append(cov_len)
+
+    match_rows = (
+        np.concatenate(match_rows) if match_rows else np.array([], int)
+    )
+    match_cov_len = (
+        np.concatenate(match_cov_len) if match_cov_len else np.array([], int)
+    )
+    # Back to the order of the hit table
+    file_order = np.argsort(match_rows, kind="stable")
+    cov_df = domtbl_df.iloc[match_rows[file_order]].reset_index(drop=True)
+    cov_df["cov_len"] = match_cov_len[file_order]
+    cov_df["cov_q"] = cov_df["cov_len"] / cov_df["qlen"]
+    cov_df["cov_t"] = cov_df["cov_len"] / cov_df["tlen"]
+    return format_match_table(cov_df, members)
+
+
+def gather_stage() -> Stage:
+    return Stage(
+        "step_2",
+        inputs=[DOMTBLOUT_FILE]
+        + ([DEDUP_MEMBERS_FILE] if DEDUP_PROTEOMES else []),
+        config_keys=[
+            "GATHER_T_E",
+            "GATHER_T_DOME",
+            "GATHER_T_COV",
+            "LEN_DIFF",
+            "DEDUP_PROTEOMES",
+        ],
+        # step_2_live.py joins the same tables from shards
+        code=[
+            Path(__file__),
+            Path(__file__).parent / "column_store.py",
+            Path(__file__).parent / "step_2_live.py",
+        ],
+        outputs=[GATHER_DOMTBL_STORE, GATHER_MATCH_STORE]
+        + ([GATHER_DOMTBL_TSV, GATHER_MATCH_TSV] if EXPORT_TSV else []),
+    )
+
+
+def write_gather_table(df: pd.DataFrame, store_p: Path, tsv_p: Path):
+    """Column store of a step 2 table, and the TSV with EXPORT_TSV."""
+    write_table(df, store_p)
+    if EXPORT_TSV:
+        df.to_csv(tsv_p, sep="\t")
+
+
+def main():
+    def run():
+        domtbl_df = read_domtbl(DOMTBLOUT_FILE)
+        print(f"Write re-formated domain hit table {GATHER_DOMTBL_STORE}")
+
+        def write_reformated_domtbl():
+            write_gather_table(
+                domtbl_df, GATHER_DOMTBL_STORE, GATHER_DOMTBL_TSV
+            )
+
+        write_reformated_domtbl_thread = Thread(target=write_reformated_domtbl)
+        write_reformated_domtbl_thread.start()
+        members = None
+        if DEDUP_PROTEOMES:
+            print(f"Reading unique sequence members {DEDUP_MEMBERS_FILE}")
+            members = read_dedup_members()
+        match_df = parse_dom_table_mt(domtbl_df, members=members)
+        assert (
+            match_df.duplicated(
+                subset=["Query", "Target strain", "Target protein"]
+            ).sum()
+            == 0
         )
-    return pd.DataFrame(match_dict)
-
-
-def parse_dom_table_mt(domtbl_df):
-    previous_qp = ""
-    domtbl_q: list[OrderedDict] = []
-    with ProcessPoolExecutor(NCPU) as executer:
-        futures = []
-        for domrow in tqdm(
-            domtbl_df.itertuples(),
-            desc="Submitting jobs",
-            total=domtbl_df.shape[0],
-        ):
-            dom_dict = domrow._asdict()
-            if domrow.qp == previous_qp:
-                domtbl_q.append(dom_dict)
-            else:
-                # submit previous one
-                if len(domtbl_q) > 0:
-                    futures.append(
-                        executer.submit(process_single_query, domtbl_q)
-                    )
-                # empty q
-                domtbl_q = [dom_dict]
-                previous_qp = domrow.qp
-        # submit the last one
-        if len(domtbl_q) > 0:
-            futures.append(executer.submit(process_single_query, domtbl_q))
-        results = []
-        for future in tqdm(futures, desc="Processing per protein hits"):
-            results.append(future.result())
-    return pd.concat(results, ignore_index=True)
+        write_reformated_domtbl_thread.join()
+        print(f"Write match table {GATHER_MATCH_STORE}")
+        write_gather_table(match_df, GATHER_MATCH_STORE, GATHER_MATCH_TSV)
+
+    run_cached(gather_stage(), run)
 
 
 if __name__ == "__main__":
-    if "nodup" in str(DOMTBLOUT_FILE):
-        nodup_domtbl = DOMTBLOUT_FILE
-    else:
-        nodup_domtbl = remove_duplicates(DOMTBLOUT_FILE)
-    domtbl_df = read_domtbl(nodup_domtbl)
-    print(f"Write re-formated domain hit table {GATHER_DOMTBL_TSV}")
-
-    def write_reformated_domtbl():
-        domtbl_df.to_csv(GATHER_DOMTBL_TSV, sep="\t")
-
-    write_reformated_domtbl_thread = Thread(target=write_reformated_domtbl)
-    write_reformated_domtbl_thread.start()
-    match_df = parse_dom_table_mt(domtbl_df)
-    assert (
-        match_df.duplicated(
-            subset=["Query", "Target strain", "Target protein"]
-        ).sum()
-        == 0
-    )
-    write_reformated_domtbl_thread.join()
-    print(f"Write match table {GATHER_MATCH_TSV}")
-    match_df.to_csv(GATHER_MATCH_TSV, sep="\t")
+    main()
@@ -1,64 +1,305 @@
-import gzip
-import pickle
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
-from scipy.stats import pearsonr, pointbiserialr
+from scipy.special import betainc
 from tqdm import tqdm
 
+from artifact_cache import Stage, content_key, run_cached
+from column_store import read_table
 from load_configs import (
+    ARTIFACT_CACHE_DIR,
+    EXPORT_TSV,
+    GATHER_MATCH_STORE,
     GATHER_MATCH_TSV,
+    LMM_ASSOCIATION,
+    N_PERMUTATIONS,
+    NCPU,
+    PERMUTATION_BLOCK,
+    PERMUTATION_SEED,
+    PRESENCE_KIND,
+    PRESENCE_STORE,
     PRESENCE_TSV,
-    STRAINS_PICKLE_FILE,
+    QUANTITATIVE_ASSOCIATION,
+    QUERY_MEMBERS_FILE,
+    REFERENCE_STRAINS,
+    STRAINS_STORE,
     TARGET_STRAIN,
 )
+from presence_store import (
+    PresencePatterns,
+    dedup_presence,
+    read_presence_store,
+    write_presence_store,
+)
+from step_0_gather_proteome import load_strains
 
 
 def load_experimental_data():
     # Load experimental data:
-    with open(STRAINS_PICKLE_FILE, "rb") as handle:
-        phenotype_strains, all_strains = pickle.load(handle)
+    phenotype_strains, all_strains = load_strains()
     phenotype_strains: dict[str, dict[str, float]]
     all_strains: dict[str, Path]
-    with gzip.open(all_strains[TARGET_STRAIN], "rt") as handle:
-        all_ref_prots: list[str] = [s.id for s in SeqIO.parse(handle, "fasta")]
+    query_members = load_query_members()
 
-    return all_ref_prots, phenotype_strains, all_strains
+    return query_members, phenotype_strains, all_strains
 
 
-def gen_presense_absence_table(
-    ref_prots: list[str], strains: list[str], match_table_p=GATHER_MATCH_TSV
+def load_query_members(members_p: Path = QUERY_MEMBERS_FILE) -> pd.DataFrame:
+    """query, strain, protein of every reference protein (from step 1)"""
+    return pd.read_csv(members_p, sep="\t", dtype=str)
+
+
+def expand_to_reference(
+    query_presence: pd.DataFrame, query_members: pd.DataFrame, strain: str
 ) -> pd.DataFrame:
-    print(f"Reading match data {match_table_p}.")
-    match_df = pd.read_csv(match_table_p, sep="\t", index_col=0, header=0)
-    df_presence = pd.DataFrame(
-        np.zeros((len(ref_prots), len(strains)), dtype=int),
-        index=pd.Index(sorted(ref_prots), name="gene"),
-        columns=sorted(strains),
+    """
+    Rows of a queries x strains table for the proteins of one reference
+    strain (identical proteins share their query), genes sorted.
+    """
+    is_ref = query_members["strain"] == strain
+    ref_queries = (
+        query_members[is_ref].set_index("protein")["query"].sort_index()
     )
-    presence_dict: dict[str, set[str]] = {}
-    for _, row in tqdm(
-        match_df.iterrows(), desc="Reading table", total=match_df.shape[0]
-    ):
-        gene = row["Query"]
-        strain = row["Target strain"]
-        if gene not in presence_dict:
-            presence_dict[gene] = set()
-        presence_dict[gene].add(strain)
-
-    def fill_one_gene(target_row) -> pd.Series:
-        gene = target_row.name
-        if gene in presence_dict:
-            for strain in strains:
-                if strain in presence_dict[gene]:
-                    target_row[strain] = 1
-        return target_row
+    presence_df = query_presence.loc[ref_queries.to_numpy()]
+    presence_df.index = pd.Index(ref_queries.index, name="gene")
+    return presence_df
+
 
+def gen_presense_absence_table(
+    ref_prots: list[str],
+    strains: list[str],
+    match_store_p=GATHER_MATCH_STORE,
+    count_hits: bool = False,
+) -> pd.DataFrame:
+    """
+    Genes x strains table, 1 if the gene has a match in the strain.
+
+    Args:
+        count_hits (bool): Keep the number of matched proteins per cell
+            (copy number) instead of presence/absence.
+    """
+    print(f"Reading match data {match_store_p}.")
+    # Only the two columns and the rows of these genes are read
+    match_df = read_table(
+        match_store_p, ["Query", "Target strain"], {"Query": ref_prots}
+    )
     print("Making presence/absence table.")
-    df_presence = df_presence.apply(fill_one_gene, axis=1)
-    return df_presence
+    return presence_from_matches(match_df, ref_prots, strains, count_hits)
+
+
+def _positions(index: pd.Index, values: pd.Series) -> np.ndarray:
+    """index.get_indexer(values), for categorical values per category."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        positions = index.get_indexer(values.cat.categories)
+        return np.where(codes >= 0, positions[codes], -1)
+    return index.get_indexer(values)
+
+
+def presence_from_matches(
+    match_df: pd.DataFrame,
+    ref_prots: list[str],
+    strains: list[str],
+    count_hits: bool = False,
+) -> pd.DataFrame:
+    """
+    Query and target strain names are mapped to integer positions in the
+    sorted index/columns, then all matches are counted with one bincount.
+    """
+    genes = pd.Index(sorted(ref_prots), name="gene")
+    strain_cols = pd.Index(sorted(strains))
+    gene_codes = _positions(genes, match_df["Query"])
+    strain_codes = _positions(strain_cols, match_df["Target strain"])
+    # Matches to genes or strains outside the table are dropped
+    is_known = (gene_codes >= 0) & (strain_codes >= 0)
+
+    counts = np.bincount(
+        gene_codes[is_known] * len(strain_cols) + strain_codes[is_known],
+        minlength=len(genes) * len(strain_cols),
+    ).reshape(len(genes), len(strain_cols))
+    if not count_hits:
+        counts = (counts > 0).astype(int)
+    return pd.DataFrame(counts, index=genes, columns=strain_cols)
+
+
+def gen_phenotype_table(
+    phenotype_strains: dict[str, dict[str, float]],
+    strains: list[str],
+    quantitative: bool = QUANTITATIVE_ASSOCIATION,
+) -> pd.DataFrame:
+    """
+    Strains x phenotypes matrix with the strains sorted like the columns of
+    the presence table.
+
+    Args:
+        quantitative (bool): Keep all values, strains without a value are
+            NaN (left out of the tests of that phenotype). Otherwise only
+            values > 0 are kept and all other strains get 0.0, the same as
+            the per phenotype vector used before.
+    """
+    phenotype_df = pd.DataFrame(
+        {
+            ph: pd.Series(st, dtype=float)
+            for ph, st in phenotype_strains.items()
+        },
+        index=pd.Index(sorted(strains)),
+    )
+    if quantitative:
+        return phenotype_df.astype(float)
+    return phenotype_df.where(phenotype_df > 0).fillna(0.0).astype(float)
+
+
+def mask_groups(phenotypes: np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Group phenotypes by the strains having a value, so that each group is
+    tested with one matrix product over its strains. Without missing values
+    this is one group of all phenotypes.
+
+    Args:
+        phenotypes (np.ndarray): strains x phenotypes, NaN for no value
+
+    Returns:
+        list[tuple[np.ndarray, np.ndarray]]: (strain mask, phenotype
+            columns) per group
+    """
+    masks, group = np.unique(
+        ~np.isnan(phenotypes.T), axis=0, return_inverse=True
+    )
+    group = group.ravel()
+    return [(mask, np.flatnonzero(group == k)) for k, mask in enumerate(masks)]
+
+
+def standardise_rows(data: np.ndarray) -> np.ndarray:
+    """
+    Center each row and scale it to unit length, so that the dot product of
+    two standardised rows is their Pearson correlation.
+    Constant rows become NaN.
+    """
+    centred = data - data.mean(axis=1, keepdims=True)
+    norm = np.sqrt(np.einsum("ij,ij->i", centred, centred))[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return centred / np.where(norm > 0, norm, np.nan)
+
+
+def pvalue_from_r(r: np.ndarray, n: int) -> np.ndarray:
+    """
+    Two sided p-value of Pearson r with n observations, the same value
+    scipy.stats.pearsonr gives (t test with n - 2 degrees of freedom,
+    written as the regularised incomplete beta function).
+    """
+    r = np.clip(r, -1.0, 1.0)
+    df = n - 2
+    return betainc(df / 2, 0.5, 1.0 - r**2)
+
+
+def correlation_matrix(
+    presence: np.ndarray, phenotypes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Correlation of every gene with every phenotype in one matrix product.
+
+    Args:
+        presence (np.ndarray): genes x strains
+        phenotypes (np.ndarray): strains x phenotypes
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: r and p, both genes x phenotypes
+    """
+    z_genes = standardise_rows(np.asarray(presence, dtype=float))
+    z_phenotypes = standardise_rows(np.asarray(phenotypes, dtype=float).T)
+    r = np.clip(z_genes @ z_phenotypes.T, -1.0, 1.0)
+    return r, pvalue_from_r(r, presence.shape[1])
+
+
+def variable_patterns(
+    presence: PresencePatterns,
+) -> tuple[np.ndarray, pd.Index, np.ndarray]:
+    """
+    Drop patterns with the same value in all strains.
+
+    Returns:
+        tuple[np.ndarray, pd.Index, np.ndarray]: the remaining patterns, the
+            genes having one of them (original order) and the row of each of
+            these genes in the remaining patterns
+    """
+    patterns = presence.patterns
+    is_variable = patterns.min(axis=1) != patterns.max(axis=1)
+    new_row = np.cumsum(is_variable) - 1
+    gene_pattern = presence.gene_pattern.to_numpy()
+    gene_is_variable = is_variable[gene_pattern]
+    return (
+        patterns[is_variable],
+        presence.gene_pattern.index[gene_is_variable],
+        new_row[gene_pattern[gene_is_variable]],
+    )
+
+
+def cal_correlations(
+    phenotype_df: pd.DataFrame, presence: pd.DataFrame | PresencePatterns
+) -> dict[str, pd.DataFrame]:
+    """
+    Batched version of cal_correlation for all phenotypes at once.
+    Genes with the same presence/absence value in all strains are skipped.
+    Each distinct presence pattern is calculated once, then the result is
+    expanded to all genes with that pattern.
+    Point biserial correlation is Pearson correlation with one binary
+    variable, so both are calculated the same way here; the column name
+    tells which one applies. Hit count tables (QUANTITATIVE_ASSOCIATION) can
+    have both kinds of genes, then the column is "Corr." and the test of
+    each gene is in the column "test".
+    Phenotypes with missing values (NaN) are tested on the strains having a
+    value; genes constant on those strains get NaN.
+
+    Args:
+        phenotype_df (pd.DataFrame): strains x phenotypes
+        presence (pd.DataFrame | PresencePatterns): genes x strains table, or
+            its distinct patterns (see presence_store.py)
+
+    Returns:
+        dict[str, pd.DataFrame]: {phenotype: correlation_df}, same layout as
+            cal_correlation
+    """
+    if isinstance(presence, pd.DataFrame):
+        presence = dedup_presence(presence)
+    patterns, genes, rows = variable_patterns(presence)
+    is_binary = np.isin(patterns, (0, 1)).all(axis=1)
+    if is_binary.all():
+        stat_name = "point_biserial_Corr."
+    elif not is_binary.any():
+        stat_name = "pearson_Corr."
+    else:
+        stat_name = "Corr."
+
+    phenotypes = phenotype_df.loc[presence.strains].to_numpy(dtype=float)
+    r = np.full((len(patterns), phenotypes.shape[1]), np.nan)
+    p = np.full_like(r, np.nan)
+    for mask, columns in mask_groups(phenotypes):
+        if mask.sum() < 3:
+            # Too few strains with a value for a test
+            continue
+        r[:, columns], p[:, columns] = correlation_matrix(
+            patterns[:, mask], phenotypes[mask][:, columns]
+        )
+    correlations = {}
+    for i, phenotype in enumerate(phenotype_df.columns):
+        correlation_df = pd.DataFrame(
+            {stat_name: r[rows, i], "p": p[rows, i]}, index=genes
+        )
+        if stat_name == "Corr.":
+            correlation_df["test"] = np.where(
+                is_binary[rows], "point_biserial", "pearson"
+            )
+        correlation_df.index.name = "gene"
+        correlations[phenotype] = correlation_df
+    return correlations
 
 
 def cal_correlation(
@@ -67,64 +308,411 @@ def cal_correlation(
     all_strains: dict[str, Path],
     presence_df: pd.DataFrame,
 ) -> pd.DataFrame:
-    phenotype_vector = (
-        pd.Series(phenotype_strains[phenotype], index=sorted(list(all_strains.keys())))
-        .fillna(0.0)
-        .to_numpy(dtype=float)
+    print(f"\nCalculating correlation for {phenotype} phenotype.")
+    phenotype_df = gen_phenotype_table(
+        {phenotype: phenotype_strains[phenotype]}, list(all_strains.keys())
     )
+    return cal_correlations(phenotype_df, presence_df)[phenotype]
 
-    correlation_dict = {}
-    is_binary = False
-    print(f"\nCalculating correlation for {phenotype} phenotype.")
-    # Columns already sorted but just to be sure
-    presence_df = presence_df[sorted(presence_df.columns)]
-
-    for gene, presence_data in tqdm(
-        presence_df.iterrows(), desc="Processing genes", total=presence_df.shape[0]
-    ):
-        unique_presence = set(presence_data)
-        if len(unique_presence) == 1:
-            # If all strains have the same presence/absence value, skip this gene
+
+# Standardised presence rows, set once per worker process
+_perm_z_patterns: np.ndarray = np.empty((0, 0))
+
+
+def _init_permutation_worker(z_patterns: np.ndarray):
+    global _perm_z_patterns
+    _perm_z_patterns = z_patterns
+
+
+def _permutation_block(
+    z_phenotype: np.ndarray,
+    abs_r: np.ndarray,
+    n_perm: int,
+    seed_seq: np.random.SeedSequence,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Correlate all presence patterns with n_perm shuffled phenotype vectors
+    at once.
+    A permuted standardised vector is still standardised, so the shuffled
+    phenotypes go straight into the matrix product.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: per pattern counts of permutations
+            with |r_perm| >= |r| for the same pattern, and with max |r_perm|
+            over all patterns >= |r| (max-T)
+    """
+    rng = np.random.default_rng(seed_seq)
+    z_perm = rng.permuted(np.tile(z_phenotype, (n_perm, 1)), axis=1)
+    abs_r_perm = np.abs(_perm_z_patterns @ z_perm.T)  # patterns x n_perm
+    # Tolerance so that ties from floating point noise count as exceeding
+    threshold = abs_r[:, None] - 1e-12
+    exceed = (abs_r_perm >= threshold).sum(axis=1)
+    max_exceed = (abs_r_perm.max(axis=0)[None, :] >= threshold).sum(axis=1)
+    return exceed, max_exceed
+
+
+def add_permutation_pvalues(
+    correlations: dict[str, pd.DataFrame],
+    phenotype_df: pd.DataFrame,
+    presence: pd.DataFrame | PresencePatterns,
+    n_permutations: int = N_PERMUTATIONS,
+    block_size: int = PERMUTATION_BLOCK,
+    seed: int = PERMUTATION_SEED,
+    ncpu: int = NCPU,
+) -> dict[str, pd.DataFrame]:
+    """
+    Empirical p-values from shuffling each phenotype vector n_permutations
+    times. Adds two columns to every correlation table:
+        p_perm: per gene empirical p-value, (1 + #|r_perm| >= |r|) / (N + 1)
+        p_maxT: family-wise adjusted p-value from the max |r| over all genes
+            of each permutation
+    Permutations are done in blocks of block_size and only per gene counts
+    are kept, so memory does not grow with n_permutations. Each block has its
+    own seed spawned from `seed`, the result does not depend on ncpu.
+    Genes sharing a presence pattern are permuted once; the max over
+    patterns is the same as the max over genes.
+    Phenotypes with missing values are shuffled among the strains having a
+    value, per group of phenotypes with the same strains (mask_groups).
+    """
+    if isinstance(presence, pd.DataFrame):
+        presence = dedup_presence(presence)
+    patterns, genes, rows = variable_patterns(presence)
+    phenotypes = phenotype_df.loc[presence.strains].to_numpy(dtype=float)
+    block_sizes = [block_size] * (n_permutations // block_size)
+    if n_permutations % block_size:
+        block_sizes.append(n_permutations % block_size)
+    phenotype_seeds = np.random.SeedSequence(seed).spawn(phenotype_df.shape[1])
+
+    for phenotype in phenotype_df.columns:
+        correlations[phenotype] = correlations[phenotype].loc[genes]
+        correlations[phenotype]["p_perm"] = np.nan
+        correlations[phenotype]["p_maxT"] = np.nan
+    for mask, columns in mask_groups(phenotypes):
+        if mask.sum() < 3:
             continue
+        z_patterns = standardise_rows(patterns[:, mask].astype(float))
+        # Patterns constant on these strains have no p-value, as r = 0 they
+        # do not change the max over patterns
+        is_constant = np.isnan(z_patterns[:, 0])
+        z_patterns[is_constant] = 0.0
+        z_phenotypes = standardise_rows(phenotypes[mask][:, columns].T)
+        # forkserver, the references (and pipeline.py nodes) run in threads
+        with ProcessPoolExecutor(
+            ncpu,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_permutation_worker,
+            initargs=(z_patterns,),
+        ) as executer:
+            for i, z_phenotype in zip(columns, z_phenotypes):
+                phenotype = phenotype_df.columns[i]
+                correlation_df = correlations[phenotype]
+                if np.isnan(z_phenotype).any():
+                    # Constant phenotype, nothing to permute
+                    continue
+                abs_r = np.abs(z_patterns @ z_phenotype)
+                exceed = np.zeros(len(patterns), dtype=np.int64)
+                max_exceed = np.zeros(len(patterns), dtype=np.int64)
+                blocks = zip(
+                    block_sizes, phenotype_seeds[i].spawn(len(block_sizes))
+                )
+                running: dict = {}  # {future: n_perm}
+                with tqdm(
+                    total=n_permutations, desc=f"Permuting {phenotype}"
+                ) as pbar:
+                    for n_perm, seed_seq in blocks:
+                        future = executer.submit(
+                            _permutation_block,
+                            z_phenotype,
+                            abs_r,
+                            n_perm,
+                            seed_seq,
+                        )
+                        running[future] = n_perm
+                        # Keep a bounded number of blocks in flight
+                        if len(running) < 2 * ncpu and len(running) < len(
+                            block_sizes
+                        ):
+                            continue
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            block_exceed, block_max_exceed = future.result()
+                            exceed += block_exceed
+                            max_exceed += block_max_exceed
+                            pbar.update(running.pop(future))
+                    for future in running:
+                        block_exceed, block_max_exceed = future.result()
+                        exceed += block_exceed
+                        max_exceed += block_max_exceed
+                        pbar.update(running[future])
+                p_perm = (exceed + 1) / (n_permutations + 1)
+                p_max_t = (max_exceed + 1) / (n_permutations + 1)
+                p_perm[is_constant] = np.nan
+                p_max_t[is_constant] = np.nan
+                correlation_df["p_perm"] = p_perm[rows]
+                correlation_df["p_maxT"] = p_max_t[rows]
+    return correlations
+
+
+def kinship_eigh(
+    presence: PresencePatterns, cache_p: Path | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Strain kinship from the presence of all variable genes,
+    K = Z^T Z / mean(diag), Z the standardised genes x strains table, and
+    its eigendecomposition K = U diag(s) U^T. A pattern counts once for
+    every gene having it. The decomposition is kept in cache_p (.npz), which
+    the caller keys by the content of the presence store.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: eigenvalues s, eigenvectors U
+            (strains x strains, strains in presence.strains order)
+    """
+    if cache_p is not None and cache_p.exists():
+        with np.load(cache_p) as eigh:
+            if list(eigh["strains"]) == list(presence.strains):
+                return eigh["s"], eigh["u"]
+    patterns, _, rows = variable_patterns(presence)
+    counts = np.bincount(rows, minlength=len(patterns))
+    z = standardise_rows(patterns.astype(float))
+    kinship = (z.T * counts) @ z
+    kinship /= np.mean(np.diag(kinship))
+    s, u = np.linalg.eigh(kinship)
+    # Round off makes some of the zero eigenvalues slightly negative
+    s = np.clip(s, 0.0, None)
+    if cache_p is not None:
+        cache_p.parent.mkdir(parents=True, exist_ok=True)
+        tmp_p = cache_p.parent / f"{cache_p.stem}.tmp.npz"
+        np.savez(tmp_p, s=s, u=u, strains=np.array(presence.strains))
+        tmp_p.replace(cache_p)
+    return s, u
+
+
+def fit_null_delta(
+    s: np.ndarray,
+    y_rot: np.ndarray,
+    one_rot: np.ndarray,
+    log_deltas: np.ndarray = np.linspace(-5, 5, 201),
+) -> np.ndarray:
+    """
+    REML estimate of delta = sigma_e^2 / sigma_g^2 of the model without
+    gene (intercept and kinship only), for every phenotype at once, by
+    grid search over log_deltas. In rotated space the covariance is
+    diagonal, s + delta, so every grid point costs O(strains).
+
+    Args:
+        s (np.ndarray): kinship eigenvalues
+        y_rot (np.ndarray): U^T y, strains x phenotypes
+        one_rot (np.ndarray): U^T 1
+
+    Returns:
+        np.ndarray: delta per phenotype
+    """
+    n = len(s)
+    delta = np.exp(log_deltas)[:, None]
+    w = 1.0 / (s[None, :] + delta)  # grid x strains
+    a = w @ one_rot**2
+    b = w @ (one_rot[:, None] * y_rot)
+    rss = w @ y_rot**2 - b**2 / a[:, None]  # grid x phenotypes
+    reml = -0.5 * (
+        (n - 1) * np.log(rss / (n - 1))
+        + np.log(s[None, :] + delta).sum(axis=1)[:, None]
+        + np.log(a)[:, None]
+    )
+    return np.exp(log_deltas[reml.argmax(axis=0)])
+
+
+def add_lmm_columns(
+    correlations: dict[str, pd.DataFrame],
+    phenotype_df: pd.DataFrame,
+    presence: pd.DataFrame | PresencePatterns,
+    eigh_cache_p: Path | None = None,
+) -> dict[str, pd.DataFrame]:
+    """
+    Linear mixed model association, corrected for population structure
+    (strain relatedness from kinship_eigh). With delta of the null model
+    fixed per phenotype, the model y = a + b x + g + e is a weighted least
+    squares problem after rotating by U, so all genes and phenotypes are
+    done with a few matrix products. Adds two columns:
+        lmm_beta: effect of the gene presence on the phenotype
+        lmm_p: two sided p-value of lmm_beta (t test, strains - 2 df)
+    Phenotypes with missing values are fitted on the strains having a value,
+    with the kinship of these strains (mask_groups).
+    """
+    if isinstance(presence, pd.DataFrame):
+        presence = dedup_presence(presence)
+    patterns, genes, rows = variable_patterns(presence)
+    s_all, u_all = kinship_eigh(presence, eigh_cache_p)
+    phenotypes = phenotype_df.loc[presence.strains].to_numpy(dtype=float)
+    beta = np.full((len(patterns), phenotypes.shape[1]), np.nan)
+    p = np.full_like(beta, np.nan)
+    for mask, columns in mask_groups(phenotypes):
+        n = int(mask.sum())
+        if n < 3:
+            continue
+        if mask.all():
+            s, u = s_all, u_all
         else:
-            if len(unique_presence) == 2 and unique_presence.issubset({0, 1}):
-                is_binary = True
-        # Calculate point biserial correlation
-        if is_binary:
-            # If the presence data is binary (0/1), use point biserial correlation
-            statistic, pvalue = pointbiserialr(presence_data, phenotype_vector)
-        else:
-            # If the presence data is continuous, use Pearson correlation
-            statistic, pvalue = pearsonr(presence_data, phenotype_vector)
-        correlation_dict[gene] = [statistic, pvalue]
+            # Kinship of the strains with a value, from the full one
+            s, u = np.linalg.eigh((u_all[mask] * s_all) @ u_all[mask].T)
+            s = np.clip(s, 0.0, None)
+        y_rot = u.T @ phenotypes[mask][:, columns]
+        one_rot = u.T @ np.ones(n)
+        x_rot = patterns[:, mask].astype(float) @ u  # patterns x strains
+        delta = fit_null_delta(s, y_rot, one_rot)
+        for i, d in zip(columns, delta):
+            print(
+                f"{phenotype_df.columns[i]}: LMM heritability {1 / (1 + d):.3f}"
+            )
 
-    correlation_df = pd.DataFrame(correlation_dict).T
-    correlation_df.columns = [
-        ("point_biserial_Corr." if is_binary else "pearson_Corr."),
-        "p",
-    ]
-    correlation_df.index.name = "gene"
+        w = 1.0 / (s[:, None] + delta[None, :])  # strains x phenotypes
+        # Weighted sums, then the intercept projected out of x and y
+        a = one_rot**2 @ w
+        one_y = (one_rot[:, None] * y_rot * w).sum(axis=0)
+        yy = (y_rot**2 * w).sum(axis=0) - one_y**2 / a
+        x_one = x_rot @ (one_rot[:, None] * w)
+        xx = x_rot**2 @ w - x_one**2 / a
+        xy = x_rot @ (y_rot * w) - x_one * one_y / a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            beta[:, columns] = xy / xx
+            df = n - 2
+            t2 = beta[:, columns] * xy / ((yy - beta[:, columns] * xy) / df)
+            p[:, columns] = betainc(
+                df / 2, 0.5, df / (df + np.clip(t2, 0.0, None))
+            )
 
-    return correlation_df
+    for i, phenotype in enumerate(phenotype_df.columns):
+        correlation_df = correlations[phenotype].loc[genes]
+        correlation_df["lmm_beta"] = beta[rows, i]
+        correlation_df["lmm_p"] = p[rows, i]
+        correlations[phenotype] = correlation_df
+    return correlations
 
 
-if __name__ == "__main__":
-    all_ref_prots, phenotype_strains, all_strains = load_experimental_data()
-    if not PRESENCE_TSV.exists():
-        presence_df = gen_presense_absence_table(
-            all_ref_prots, list(all_strains.keys())
+def reference_paths(strain: str) -> tuple[Path, Path, str]:
+    """
+    Presence (or hit count) table, its store and correlation file prefix of
+    a reference strain. Without REFERENCE_STRAINS the usual names are kept.
+    """
+    if REFERENCE_STRAINS == [TARGET_STRAIN]:
+        return PRESENCE_TSV, PRESENCE_STORE, "corr_"
+    presence_tsv = PRESENCE_TSV.parent / (
+        f"{PRESENCE_KIND}_{strain}_{GATHER_MATCH_TSV.stem}.tsv"
+    )
+    return (
+        presence_tsv,
+        presence_tsv.parent / f"{presence_tsv.stem}.bitstore",
+        f"corr_{strain}_",
+    )
+
+
+def correlate_reference(
+    strain: str, phenotype_strains: dict[str, dict[str, float]]
+):
+    _, presence_store, corr_prefix = reference_paths(strain)
+    presence = read_presence_store(presence_store)
+    print(
+        f"{strain}: {len(presence.gene_pattern)} genes, "
+        f"{len(presence.patterns)} distinct {PRESENCE_KIND} patterns."
+    )
+    phenotype_df = gen_phenotype_table(phenotype_strains, presence.strains)
+    corr_paths = {
+        phenotype: GATHER_MATCH_TSV.parent / f"{corr_prefix}{phenotype}.tsv"
+        for phenotype in phenotype_df.columns
+    }
+
+    def run_correlation():
+        print(
+            f"\n{strain}: calculating correlation for "
+            f"{phenotype_df.shape[1]} phenotypes."
         )
-        print(f"Writing presence table {PRESENCE_TSV}.")
-        presence_df.to_csv(PRESENCE_TSV, sep="\t")
-    else:
-        print(f"Found presence table, read from {PRESENCE_TSV}")
-        presence_df = pd.read_csv(PRESENCE_TSV, sep="\t", index_col=0)
+        correlations = cal_correlations(phenotype_df, presence)
+        if N_PERMUTATIONS > 0:
+            correlations = add_permutation_pvalues(
+                correlations, phenotype_df, presence
+            )
+        if LMM_ASSOCIATION:
+            # Not in the presence store, which is an input of other stages
+            eigh_key = content_key([presence_store])
+            correlations = add_lmm_columns(
+                correlations,
+                phenotype_df,
+                presence,
+                ARTIFACT_CACHE_DIR / "kinship_eigh" / f"{eigh_key}.npz",
+            )
+        for phenotype, corr_df in correlations.items():
+            corr_df.to_csv(corr_paths[phenotype], sep="\t")
 
-    correlations = {}
-    for phenotype in phenotype_strains:
-        correlations[phenotype] = cal_correlation(
-            phenotype, phenotype_strains, all_strains, presence_df
+    correlation_stage = Stage(
+        "step_3_correlation",
+        inputs=[presence_store, STRAINS_STORE],
+        config_keys=[
+            "N_PERMUTATIONS",
+            "PERMUTATION_BLOCK",
+            "PERMUTATION_SEED",
+            "LMM_ASSOCIATION",
+            "QUANTITATIVE_ASSOCIATION",
+        ],
+        code=[
+            Path(__file__),
+            Path(__file__).parent / "presence_store.py",
+            Path(__file__).parent / "column_store.py",
+        ],
+        outputs=list(corr_paths.values()),
+    )
+    run_cached(correlation_stage, run_correlation)
+
+
+def main():
+    query_members, phenotype_strains, all_strains = load_experimental_data()
+    query_presence = []  # made once, only if a reference needs it
+
+    for strain in REFERENCE_STRAINS:
+        presence_tsv, presence_store, _ = reference_paths(strain)
+
+        def run_presence():
+            if not query_presence:
+                query_presence.append(
+                    gen_presense_absence_table(
+                        query_members["query"].unique().tolist(),
+                        list(all_strains.keys()),
+                        count_hits=QUANTITATIVE_ASSOCIATION,
+                    )
+                )
+            presence_df = expand_to_reference(
+                query_presence[0], query_members, strain
+            )
+            if EXPORT_TSV:
+                print(f"Writing presence table {presence_tsv}.")
+                presence_df.to_csv(presence_tsv, sep="\t")
+            print(f"Writing presence store {presence_store}.")
+            write_presence_store(dedup_presence(presence_df), presence_store)
+
+        presence_stage = Stage(
+            "step_3_presence",
+            inputs=[GATHER_MATCH_STORE, STRAINS_STORE, QUERY_MEMBERS_FILE],
+            config_keys=[
+                "TARGET_STRAIN",
+                "REFERENCE_STRAINS",
+                "QUANTITATIVE_ASSOCIATION",
+            ],
+            code=[
+                Path(__file__),
+                Path(__file__).parent / "presence_store.py",
+                Path(__file__).parent / "column_store.py",
+            ],
+            outputs=[presence_store] + ([presence_tsv] if EXPORT_TSV else []),
         )
+        run_cached(presence_stage, run_presence)
+
+    # The references are independent, their correlations run together
+    with ThreadPoolExecutor(len(REFERENCE_STRAINS)) as executer:
+        futures = [
+            executer.submit(correlate_reference, strain, phenotype_strains)
+            for strain in REFERENCE_STRAINS
+        ]
+        for future in futures:
+            future.result()
 
-    for phenotype, corr_df in correlations.items():
-        corr_df.to_csv(GATHER_MATCH_TSV.parent / f"corr_{phenotype}.tsv", sep="\t")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# Threshold sweep.
+# The domtblout is parsed once without any filter into a columnar hit store
+# (HIT_STORE_DIR), then presence tables and correlations are made for every
+# combination of SWEEP_GATHER_T_E x SWEEP_GATHER_T_DOME x SWEEP_GATHER_T_COV x
+# SWEEP_LEN_DIFF. Work is shared between grid points:
+# 1. Pair level values (full E, length difference, lengths) are taken once.
+# 2. Coverage depends only on T_DOME, it is calculated once per T_DOME.
+# 3. For one (T_DOME, T_COV, LEN_DIFF), each gene x strain cell keeps the
+#    lowest full E of its passing pairs. The cell is present at threshold E
+#    if that value <= E, so all T_E values come from one pass.
+# Each grid point gets its own correlation tables in SWEEP_DIR, plus a summary
+# per phenotype of how often each gene is among the top SWEEP_TOP_N.
+# Genes are the proteins of the first of REFERENCE_STRAINS.
+
+from itertools import combinations, product
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from load_configs import (
+    DEDUP_PROTEOMES,
+    DOMTBLOUT_FILE,
+    HIT_STORE_DIR,
+    REFERENCE_STRAINS,
+    SWEEP_DIR,
+    SWEEP_GATHER_T_COV,
+    SWEEP_GATHER_T_DOME,
+    SWEEP_GATHER_T_E,
+    SWEEP_LEN_DIFF,
+    SWEEP_TOP_N,
+)
+from step_2_parse_domtbl import (
+    is_hit_store_current,
+    load_hit_store,
+    merged_interval_length,
+    read_dedup_members,
+    read_domtbl,
+    save_hit_store,
+)
+from step_3_calculate_correlation import (
+    cal_correlations,
+    expand_to_reference,
+    gen_phenotype_table,
+    load_experimental_data,
+)
+
+
+class SweepPairs(NamedTuple):
+    full_E: np.ndarray  # per (query, target) pair
+    len_diff: np.ndarray  # per pair
+    max_len: np.ndarray  # per pair, max(qlen, tlen)
+    cov_len: dict[float, np.ndarray]  # T_DOME -> covered length per pair
+    cell_pair: np.ndarray  # pair of each (pair, cell) row
+    cell: np.ndarray  # gene * n_strains + strain of each row
+
+
+def grid_name(t_e: float, t_dome: float, t_cov: float, len_diff: float):
+    """Same naming as the step 2 output files."""
+    return f"E{str(t_e)}_DOME{str(t_dome)}_COV{str(t_cov)}_LDIF{str(len_diff)}"
+
+
+def load_hits() -> pd.DataFrame:
+    if is_hit_store_current(HIT_STORE_DIR, DOMTBLOUT_FILE):
+        print(f"Found hit store, read from {HIT_STORE_DIR}")
+        return load_hit_store(HIT_STORE_DIR)
+    domtbl_df = read_domtbl(DOMTBLOUT_FILE, t_e=np.inf, len_diff=np.inf)
+    print(f"Writing hit store {HIT_STORE_DIR}.")
+    save_hit_store(domtbl_df, HIT_STORE_DIR, DOMTBLOUT_FILE)
+    return domtbl_df
+
+
+def target_strains(
+    tp_categories: pd.Index,
+    strains: pd.Index,
+    members: pd.DataFrame | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (target, strain) relation as two code arrays. Targets are
+    strain_protein, or unique sequences found in several strains with
+    DEDUP_PROTEOMES (members, see step 2 expand_dedup_targets).
+    """
+    if members is None:
+        tp_code = np.arange(len(tp_categories))
+        strain = pd.Series(tp_categories.astype(str)).str.partition("_")[0]
+    else:
+        tp_code = tp_categories.get_indexer(members["seq_id"])
+        strain = members["strain"]
+    strain_code = strains.get_indexer(strain)
+    is_known = (tp_code >= 0) & (strain_code >= 0)
+    return tp_code[is_known], strain_code[is_known]
+
+
+def prepare_pairs(
+    domtbl_df: pd.DataFrame,
+    genes: pd.Index,
+    strains: pd.Index,
+    t_domes: list[float],
+    members: pd.DataFrame | None = None,
+) -> SweepPairs:
+    qp_codes = domtbl_df["qp"].cat.codes.to_numpy()
+    tp_codes = domtbl_df["tp"].cat.codes.to_numpy()
+    n_tp = len(domtbl_df["tp"].cat.categories)
+    pair_key = qp_codes.astype(np.int64) * n_tp + tp_codes
+    _, first, group = np.unique(
+        pair_key, return_index=True, return_inverse=True
+    )
+    group = group.ravel()
+    # full E and lengths are the same on every domain row of a pair
+    full_E = domtbl_df["full_E"].to_numpy()[first]
+    qlen = domtbl_df["qlen"].to_numpy()[first].astype(np.int64)
+    tlen = domtbl_df["tlen"].to_numpy()[first].astype(np.int64)
+    len_diff = np.abs(tlen - qlen) / np.minimum(tlen, qlen)
+
+    print(f"Coverage of {len(first)} pairs for {len(t_domes)} T_DOME.")
+    dom_i_E = domtbl_df["dom_i_E"].to_numpy()
+    ali_from = domtbl_df["ali_from"].to_numpy()
+    ali_to = domtbl_df["ali_to"].to_numpy()
+    cov_len = {}
+    for t_dome in t_domes:
+        is_dom_pass = dom_i_E <= t_dome
+        cov_len[t_dome] = merged_interval_length(
+            group[is_dom_pass],
+            ali_from[is_dom_pass],
+            ali_to[is_dom_pass],
+            len(first),
+        )
+
+    # Pairs -> gene x strain cells, one row per strain having the target
+    gene_code = genes.get_indexer(domtbl_df["qp"].cat.categories)[
+        qp_codes[first]
+    ]
+    rel_tp, rel_strain = target_strains(
+        pd.Index(domtbl_df["tp"].cat.categories), strains, members
+    )
+    order = np.argsort(rel_tp, kind="stable")
+    rel_tp, rel_strain = rel_tp[order], rel_strain[order]
+    rel_start = np.searchsorted(rel_tp, np.arange(n_tp))
+    rel_count = np.bincount(rel_tp, minlength=n_tp)
+
+    pair_tp = tp_codes[first]
+    n_rows = np.where(gene_code >= 0, rel_count[pair_tp], 0)
+    cell_pair = np.repeat(np.arange(len(first)), n_rows)
+    # Position of each row within its pair
+    row_in_pair = np.arange(len(cell_pair)) - np.repeat(
+        np.cumsum(n_rows) - n_rows, n_rows
+    )
+    cell_strain = rel_strain[rel_start[pair_tp[cell_pair]] + row_in_pair]
+    cell = gene_code[cell_pair].astype(np.int64) * len(strains) + cell_strain
+    return SweepPairs(
+        full_E, len_diff, np.maximum(qlen, tlen), cov_len, cell_pair, cell
+    )
+
+
+def iter_presence(
+    pairs: SweepPairs,
+    genes: pd.Index,
+    strains: pd.Index,
+    t_es: list[float],
+    t_domes: list[float],
+    t_covs: list[float],
+    len_diffs: list[float],
+):
+    """Yield (t_e, t_dome, t_cov, len_diff), presence_df for the grid."""
+    cell_E = pairs.full_E[pairs.cell_pair]
+    for t_dome, t_cov, len_diff in product(t_domes, t_covs, len_diffs):
+        # Same test as cov_q >= t_cov and cov_t >= t_cov
+        is_pair_pass = (pairs.len_diff <= len_diff) & (
+            pairs.cov_len[t_dome] / pairs.max_len >= t_cov
+        )
+        is_row_pass = is_pair_pass[pairs.cell_pair]
+        cell_min_E = np.full(len(genes) * len(strains), np.inf)
+        np.minimum.at(cell_min_E, pairs.cell[is_row_pass], cell_E[is_row_pass])
+        cell_min_E = cell_min_E.reshape(len(genes), len(strains))
+        for t_e in t_es:
+            presence_df = pd.DataFrame(
+                (cell_min_E <= t_e).astype(int), index=genes, columns=strains
+            )
+            yield (t_e, t_dome, t_cov, len_diff), presence_df
+
+
+def summarise_top_genes(
+    ranks: dict[str, pd.Series], top_n: int
+) -> tuple[pd.DataFrame, float]:
+    """
+    How stable the top genes of one phenotype are across grid points.
+
+    Args:
+        ranks (dict[str, pd.Series]): {grid point: rank of each gene by p}
+
+    Returns:
+        tuple[pd.DataFrame, float]: one row per gene that is in the top
+            top_n of any grid point, and the mean Jaccard index of the top
+            sets of all pairs of grid points
+    """
+    rank_df = pd.DataFrame(ranks)
+    # Genes without a correlation (constant at that grid point) rank last
+    rank_df = rank_df.fillna(len(rank_df))
+    is_top = rank_df <= top_n
+    is_top = is_top[is_top.any(axis=1)]
+    top_ranks = rank_df.loc[is_top.index]
+    summary_df = pd.DataFrame(
+        {
+            "n_top": is_top.sum(axis=1),
+            "frac_top": is_top.mean(axis=1),
+            "median_rank": top_ranks.median(axis=1),
+            "best_rank": top_ranks.min(axis=1),
+            "worst_rank": top_ranks.max(axis=1),
+        }
+    ).sort_values(["n_top", "median_rank"], ascending=[False, True])
+    summary_df.index.name = "gene"
+
+    top_sets = [set(is_top.index[is_top[c]]) for c in is_top.columns]
+    jaccard = [
+        len(a & b) / len(a | b) if a | b else 1.0
+        for a, b in combinations(top_sets, 2)
+    ]
+    return summary_df, float(np.mean(jaccard)) if jaccard else 1.0
+
+
+def main():
+    query_members, phenotype_strains, all_strains = load_experimental_data()
+    queries = pd.Index(sorted(query_members["query"].unique()))
+    strains = pd.Index(sorted(all_strains.keys()))
+    phenotype_df = gen_phenotype_table(phenotype_strains, strains.tolist())
+
+    domtbl_df = load_hits()
+    members = read_dedup_members() if DEDUP_PROTEOMES else None
+    pairs = prepare_pairs(
+        domtbl_df, queries, strains, SWEEP_GATHER_T_DOME, members
+    )
+    del domtbl_df
+
+    SWEEP_DIR.mkdir(parents=True, exist_ok=True)
+    n_grid = (
+        len(SWEEP_GATHER_T_E)
+        * len(SWEEP_GATHER_T_DOME)
+        * len(SWEEP_GATHER_T_COV)
+        * len(SWEEP_LEN_DIFF)
+    )
+    ranks = {phenotype: {} for phenotype in phenotype_df.columns}
+    grid_rows = []
+    for thresholds, presence_df in tqdm(
+        iter_presence(
+            pairs,
+            queries,
+            strains,
+            SWEEP_GATHER_T_E,
+            SWEEP_GATHER_T_DOME,
+            SWEEP_GATHER_T_COV,
+            SWEEP_LEN_DIFF,
+        ),
+        total=n_grid,
+        desc="Threshold grid",
+    ):
+        presence_df = expand_to_reference(
+            presence_df, query_members, REFERENCE_STRAINS[0]
+        )
+        name = grid_name(*thresholds)
+        grid_rows.append((name, *thresholds, int(presence_df.values.sum())))
+        correlations = cal_correlations(phenotype_df, presence_df)
+        for phenotype, corr_df in correlations.items():
+            corr_df.to_csv(
+                SWEEP_DIR / f"corr_{phenotype}_{name}.tsv", sep="\t"
+            )
+            ranks[phenotype][name] = corr_df["p"].rank(method="min")
+
+    pd.DataFrame(
+        grid_rows,
+        columns=["grid", "T_E", "T_DOME", "T_COV", "LEN_DIFF", "n_present"],
+    ).to_csv(SWEEP_DIR / "sweep_grid.tsv", sep="\t", index=False)
+    for phenotype, phenotype_ranks in ranks.items():
+        summary_df, jaccard = summarise_top_genes(phenotype_ranks, SWEEP_TOP_N)
+        summary_df.to_csv(
+            SWEEP_DIR / f"sweep_summary_{phenotype}.tsv", sep="\t"
+        )
+        print(
+            f"{phenotype}: {len(summary_df)} genes in any top {SWEEP_TOP_N}, "
+            f"mean Jaccard of top sets {jaccard:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+import epistasis_scan
+from presence_store import dedup_presence, write_presence_store
+
+
+def test_scan_reference_copy_number_of_core_gene(tmp_path, monkeypatch):
+    # Hit counts: core_gene is in every strain with a varying copy number,
+    # so it varies as a count pattern but not as presence/absence
+    rng = np.random.default_rng(0)
+    strains = [f"S{i:02d}" for i in range(30)]
+    counts = (rng.random((12, len(strains))) < 0.5).astype(int)
+    counts[:, :2] = [0, 1]
+    counts[3] *= 2
+    core = rng.integers(1, 4, len(strains))
+    core[:2] = [1, 2]
+    presence_df = pd.DataFrame(
+        np.vstack([counts, core]),
+        index=[f"gene_{i}" for i in range(len(counts))] + ["core_gene"],
+        columns=strains,
+    )
+    store_p = tmp_path / "presence.bitstore"
+    write_presence_store(dedup_presence(presence_df), store_p)
+    out_p = tmp_path / "epistasis_A.tsv"
+    monkeypatch.setattr(
+        epistasis_scan, "reference_paths", lambda strain: (None, store_p, "")
+    )
+    monkeypatch.setattr(
+        epistasis_scan,
+        "epistasis_paths",
+        lambda strain, phenotypes: {"A": out_p},
+    )
+    monkeypatch.setattr(epistasis_scan, "run_cached", lambda stage, run: run())
+    phenotype = counts[0] & counts[1]
+    epistasis_scan.scan_reference(
+        "REF", {"A": {st: float(v) for st, v in zip(strains, phenotype)}}
+    )
+
+    pairs_df = pd.read_csv(out_p, sep="\t")
+    assert len(pairs_df)
+    genes = pd.concat([pairs_df["genes_a"], pairs_df["genes_b"]])
+    gene_sets = genes.str.split(",")
+    assert not any("core_gene" in g for g in gene_sets)
+    assert (
+        gene_sets.str.len().to_numpy()
+        == np.r_[pairs_df["n_genes_a"], pairs_df["n_genes_b"]]
+    ).all()
+    best = pairs_df.iloc[0]
+    assert {best["genes_a"], best["genes_b"]} == {"gene_0", "gene_1"}
+    assert best["interaction"] == "and"
+    assert np.isclose(best["phi_Corr."], 1.0)